@@ -0,0 +1,162 @@
+# description: asyncio interface to usbdm. Every probe gets an I/O thread which runs its commands
+#              in the order they were awaited, the event loop waits for their futures:
+#                  usbdm = AsyncUsbdm(Usbdm(SimulatedTransport("MC9S12DJ64")))
+#                  chip = await AsyncChip.open(MC9S12DJ64, usbdm)
+#                  await chip.load("image.s19"); await chip.program()
+#              The flash waits of program(), erase() and verify() sleep in the I/O thread, so one loop
+#              drives many probes. python asyncusbdm.py <chip> <file> <count> programs simulated probes
+
+import asyncio
+import functools
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from usbdm import Usbdm
+from helpers import *
+
+
+class AsyncUsbdm():
+    NAME = "ASYNCUSBDM"
+    def __init__(self, usbdm=None):
+        self.usbdm = usbdm if usbdm != None else Usbdm()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usbdm")
+
+    # Run a call in the I/O thread of the probe
+    def run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def openBdm(self):
+        return await self.run(self.usbdm.openBdm)
+
+    async def closeBdm(self):
+        return await self.run(self.usbdm.closeBdm)
+
+    async def connect(self):
+        return await self.run(self.usbdm.connect)
+
+    async def getBdmStatus(self):
+        return await self.run(self.usbdm.getBdmStatus)
+
+    async def readBdmStatusRegister(self):
+        return await self.run(self.usbdm.readBdmStatusRegister)
+
+    async def setBdmTarget(self, target):
+        return await self.run(self.usbdm.setBdmTarget, target)
+
+    async def resetTarget(self):
+        return await self.run(self.usbdm.resetTarget)
+
+    async def haltTarget(self):
+        return await self.run(self.usbdm.haltTarget)
+
+    async def runTarget(self):
+        return await self.run(self.usbdm.runTarget)
+
+    async def writeRegister(self, register, pc):
+        return await self.run(self.usbdm.writeRegister, register, pc)
+
+    async def writeBdmBlock(self, address, data):
+        return await self.run(self.usbdm.writeBdmBlock, address, data)
+
+    async def readBdmBlock(self, address, size):
+        return await self.run(self.usbdm.readBdmBlock, address, size)
+
+    async def writeBdmByte(self, address, byte):
+        return await self.run(self.usbdm.writeBdmByte, address, byte)
+
+    async def writeBdmWord(self, address, word):
+        return await self.run(self.usbdm.writeBdmWord, address, word)
+
+    async def readBdmByte(self, address):
+        return await self.run(self.usbdm.readBdmByte, address)
+
+    # Commands queued between the two run in one batch, see Usbdm.beginBatch
+    async def beginBatch(self):
+        return await self.run(self.usbdm.beginBatch)
+
+    async def endBatch(self):
+        return await self.run(self.usbdm.endBatch)
+
+
+# A chip driven through the I/O thread of its probe, the chip attributes are set on chip.chip
+class AsyncChip():
+    def __init__(self, chip, usbdm):
+        self.chip = chip                    # ChipInterface
+        self.usbdm = usbdm                  # AsyncUsbdm of the chip
+
+    # Opening the chip opens the probe, it runs in the I/O thread as well
+    @classmethod
+    async def open(cls, chipclass, usbdm):
+        return cls(await usbdm.run(chipclass, usbdm.usbdm), usbdm)
+
+    async def load(self, fname, base=None):
+        return await self.usbdm.run(self.chip.load, fname, base)
+
+    async def connect(self):
+        return await self.usbdm.run(self.chip.connect)
+
+    async def disconnect(self):
+        return await self.usbdm.run(self.chip.disconnect)
+
+    async def reset(self):
+        return await self.usbdm.run(self.chip.reset)
+
+    async def halt(self):
+        return await self.usbdm.run(self.chip.halt)
+
+    async def identify(self):
+        return await self.usbdm.run(self.chip.identify)
+
+    async def program(self):
+        return await self.usbdm.run(self.chip.program)
+
+    async def erase(self):
+        return await self.usbdm.run(self.chip.erase)
+
+    async def blankcheck(self):
+        return await self.usbdm.run(self.chip.blankcheck)
+
+    async def verify(self):
+        return await self.usbdm.run(self.chip.verifyimage)
+
+    async def readmemory(self, address, size):
+        return await self.usbdm.run(self.chip.readmemory, address, size)
+
+    async def writememory(self, address, data):
+        return await self.usbdm.run(self.chip.writememory, address, data)
+
+
+# Program the image with count simulated probes from one event loop
+async def programsimulated(chipclass, fname, count):
+    from simulator import SimulatedTransport
+    async def programone(slot):
+        usbdm = AsyncUsbdm(Usbdm(SimulatedTransport(chipclass.NAME)))
+        try:
+            chip = await AsyncChip.open(chipclass, usbdm)
+            chip.chip.imagecache = None
+            await chip.load(fname)
+            await chip.program()
+            usbdm.usbdm.transport.report()
+        finally:
+            usbdm.close()
+
+    start = time.time()
+    await asyncio.gather(*[programone(slot) for slot in range(count)])
+    log("time: %s s"%str(time.time()-start), level=LOGL_NORMAL, tag=AsyncUsbdm.NAME)
+
+
+if __name__ == "__main__":
+    from control import chips
+    if len(sys.argv) > 3:
+        setlogginglevel(LOGL_NORMAL)
+        try:
+            asyncio.run(programsimulated(chips[sys.argv[1]], sys.argv[2], int(sys.argv[3])))
+        except Exception as e:
+            log(e, level=LOGL_NORMAL)
+            sys.exit(1)
+    else:
+        print("Arguments:")
+        print("%-30s :%s"%("\t<chipname> <file> <count>","program the file with count simulated probes from one event loop"))
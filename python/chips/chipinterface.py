@@ -4,6 +4,15 @@ from helpers import *
 # Override the routines to specify behavior
 class ChipInterface():
     NAME = "STUB"
+    # Typical duration of the flash/eeprom commands in seconds, used until completions were observed
+    # bootloader, crc: per byte of the chunk
+    COMMAND_TIMES = {"program":0.00004, "blank":0.002, "erasesector":0.02, "erasemass":0.1, "eepromprogram":0.00004, "eepromerase":0.1,
+                     "bootloader":0.00002, "crc":0.000003, "pingpong":0.00004}
+    COMMAND_HISTORY = 32                    # observed completion times kept per command type
+    IMAGE_TAG_LENGTH = 8                    # bytes of the image hash written to the tag address
+    PROGRAM_UNIT = 2                        # bytes programmed by one flash command
+    VOLATILE_RANGES = [[0x0000,0x03FF]]     # [first, last] register blocks, never cached
+    ADDRESS_SPACE_END = 0x10000             # end of the local memory map
     def __init__(self,usbdm, target, pages, idlocation,ids):
         self.usbdm = usbdm                  # usbdm handle
         self.target = target                # HCS12 = 0x00 HCS08 = 0x01
@@ -12,8 +21,27 @@ class ChipInterface():
         self.ChipIds = ids                  # ids for identification of the chip
         self.memory = []                    # file contents
         self.memorypages = {}               # page assignemts
+        self.pingpongloader = None          # double buffered bootloader, if the chip provides one
+        self.usepingpong = False            # flash with the double buffered bootloader
+        self.pingpongsizes = [0, 0]         # bytes handed to each buffer of the double buffered bootloader, 0 when it is free
+        self.pingpongstarts = [0.0, 0.0]    # handover time of the chunk in each buffer
+        self.crcloader = None               # checksum loader, if the chip provides one
+        self.usecrcverify = True            # verify by checksum, read back only the pages that differ
+        self.failfast = False               # stop verifying at the first mismatch
+        self.usedifferential = False        # erase and program only the sectors that differ from the image
+        self.tagaddress = None              # flash address reserved for the image tag, None disables it
+        self.tagcheck = False               # confirm a matching tag with the checksum verify
+        self.imagetag = None                # tag of the loaded image
+        self.userepair = True               # program the mismatching words again after a failed verify
+        self.mismatches = []                # [address, expected, read] ranges of the last verify
+        self.commandtimes = {}              # command type -> observed completion times
+        self.polltime = 0.0                 # duration of the last status poll
+        self.pagecrcs = {}                  # page -> crc read by the last checksum verify
+        self.imagecache = IMAGE_CACHE_DIR   # directory of the prepared images, None disables the cache
+        self.readbuffers = {}               # block length -> reused read buffer
 
-        # Open Target
+        # Open Target, the cached memory of a previous chip is dropped
+        self.usbdm.memorycache = None
         self.usbdm.setBdmTarget(self.target)
         log("Opening %s for target %s ..."%(self.usbdm.NAME, self.NAME),level=LOGL_NORMAL,tag = self.NAME)
         if not self.usbdm.openBdm():
@@ -34,6 +62,7 @@ class ChipInterface():
         log("Disconnecting target",level=LOGL_NORMAL,tag = self.NAME)
         self.usbdm.closeBdm()
 
+    @traced("connect")
     def connect(self):
         status = 0
         self.reset()
@@ -56,89 +85,563 @@ class ChipInterface():
     def verify(self):
         log("STUB-verify",level=LOGL_INF)
 
+    def selectpage(self, pageaddress):
+        log("STUB-selectpage",level=LOGL_INF)
+
+    @traced("reset")
     def reset(self):
         log("Resetting device", level=LOGL_NORMAL,tag = self.NAME)
         self.usbdm.resetTarget()
 
     def writememory(self, address, data):
         size = len(data)
-        log("Writing Memory %8X %d"%(address,size),level=LOGL_VERBOSE, tag = self.NAME)
+        log("Writing Memory %8X %d",level=LOGL_VERBOSE, tag = self.NAME, args=(address,size))
         off = 0
+        data = memoryview(data)
+        self.usbdm.beginBatch()
+        blocksize = self.usbdm.maxwritesize
         while(size>0):
-            if size > 0x88:
-                result = self.usbdm.writeBdmBlock(address,data[off:off+0x88])
+            if size > blocksize:
+                result = self.usbdm.writeBdmBlock(address,data[off:off+blocksize])
             else:
                 result = self.usbdm.writeBdmBlock(address,data[off:off+size])
 
-            off = off + 0x88
-            size = size - 0x88
-            address = address + 0x88
-
-    def readmemory(self, address, size):
-        log("Reading Memory",level=LOGL_VERBOSE, tag = self.NAME)
-        memory = []
-        while(size>0):
-            if size > 0x90:
-                result = self.usbdm.readBdmBlock(address,0x90)
-            else:
-                result = self.usbdm.readBdmBlock(address,size)
+            off = off + blocksize
+            size = size - blocksize
+            address = address + blocksize
+        self.usbdm.endBatch()
 
+    # Read memory in the largest blocks the probe supports, yields (offset, block) as each block arrives
+    # The blocks are read into reused buffers: a block is only valid until the next one is read
+    def readblocks(self, address, size):
+        offset = 0
+        while offset < size:
+            length = min(size-offset, self.usbdm.maxreadsize)
+            result = self.readbuffers.get(length)
+            if result == None:
+                result = self.readbuffers[length] = array("B", bytes(length+1))
+            self.usbdm.readBdmBlockInto(address+offset, result)
+            block = memoryview(result)[1:]
             if not result[0]:
-                log((address,result[1:]),level=LOGL_VERBOSE, conv="mem", tag = self.NAME)
+                log((address+offset,block),level=LOGL_VERBOSE, conv="mem", tag = self.NAME)
             else:
                  raise ValueError("Error while reading memory")
 
-            memory.extend(result[1:])
-            size = size - 0x90
-            address = address + 0x90
+            yield offset, block
+            offset = offset + length
+
+    def readmemory(self, address, size):
+        log("Reading Memory",level=LOGL_VERBOSE, tag = self.NAME)
+        cache = self.usbdm.memorycache
+        if cache != None:
+            return self.readcached(cache, address, size)
+        memory = bytearray(size)
+        for offset, block in self.readblocks(address, size):
+            memory[offset:offset+len(block)] = block
         return bytes(memory)
 
+    # Read memory through the cache, whole blocks are read and kept unless they are volatile
+    # The last block of the memory map is only read up to its end, unless the read goes past it
+    def readcached(self, cache, address, size):
+        memory = bytearray(size)
+        blocksize = cache.BLOCK_SIZE
+        for blockaddress in range(address-address%blocksize, address+size, blocksize):
+            first = max(blockaddress, address)
+            last = min(blockaddress+blocksize, address+size)
+            if cache.isvolatile(blockaddress, blocksize):
+                for offset, block in self.readblocks(first, last-first):
+                    memory[first-address+offset:first-address+offset+len(block)] = block
+                continue
+            data = cache.get(blockaddress)
+            if data == None or len(data) < last-blockaddress:
+                length = blocksize
+                if blockaddress < self.ADDRESS_SPACE_END:
+                    length = max(min(blocksize, self.ADDRESS_SPACE_END-blockaddress), last-blockaddress)
+                data = bytearray(length)
+                for offset, block in self.readblocks(blockaddress, length):
+                    data[offset:offset+len(block)] = block
+                cache.put(blockaddress, data)
+            memory[first-address:last-address] = data[first-blockaddress:last-blockaddress]
+        return bytes(memory)
+
+    # Cache the reads of readmemory() until the target runs again, for inspecting a halted target
+    def setmemorycache(self, enabled):
+        if enabled:
+            if self.usbdm.memorycache == None:
+                self.usbdm.memorycache = MemoryCache(self.VOLATILE_RANGES)
+        else:
+            self.usbdm.memorycache = None
+
+    # Read memory and compare each block with the expected bytes as it arrives
+    # Returns the mismatching ranges with the addresses of the image starting at imageaddress
+    # failfast stops at the first block that differs
+    def verifymemory(self, address, expected, imageaddress, failfast=False):
+        log("Verifying Memory %8X %d",level=LOGL_VERBOSE, tag = self.NAME, args=(address, len(expected)))
+        mismatches = []
+        expected = memoryview(expected)
+        for offset, block in self.readblocks(address, len(expected)):
+            comparememory(block, expected[offset:offset+len(block)], imageaddress+offset, mismatches)
+            if failfast and mismatches:
+                break
+        return mismatches
+
+    # Wait until poll() returns (done, value) with done set
+    # The first poll is due shortly before the command is expected to be done: the typical time
+    # until completions were observed, then the fastest recent one. Later polls back off.
+    # size scales the expected time, e.g. the bytes handed to a bootloader
+    # start is when the command was started, if the host did something else since
+    def waitforcompletion(self, kind, poll, size=1, timeout=5.0, message="Error: command timed out", start=None):
+        if start == None:
+            start = time.monotonic()
+        observed = self.commandtimes.get(kind)
+        expected = (min(observed) if observed else self.COMMAND_TIMES.get(kind, 0.0))*size
+        delay = expected*0.9 - self.polltime - (time.monotonic()-start)     # the poll itself takes a usb round trip
+        step = max(expected/8, 0.0001)
+        with tracespan("wait "+kind, polls=0) as span:
+            while True:
+                if delay > 0:
+                    with tracespan("sleep"):
+                        time.sleep(delay)
+                polled = time.monotonic()
+                done, value = poll()
+                self.polltime = time.monotonic()-polled
+                span["polls"] += 1
+
+                elapsed = time.monotonic()-start
+                if done:
+                    break
+                elif elapsed > timeout:
+                    raise ValueError(message)
+                delay = step
+                step = min(step*2, 0.010)
+
+        history = self.commandtimes.setdefault(kind, [])
+        history.append(elapsed/size)
+        del history[:-self.COMMAND_HISTORY]
+        return value
+
+    # Wait for a flash/eeprom command to complete by polling its status register
+    def waitforcommand(self, kind, address, readybit, errors, timeout=5.0):
+        def poll():
+            readstatus = self.usbdm.readBdmByte(address)[1]
+            for bits, message in errors:
+                if readstatus & bits == bits:
+                    raise ValueError(message)
+            return readstatus & readybit == readybit, readstatus
+        return self.waitforcompletion(kind, poll, timeout=timeout)
+
+    # The bootloaders end with BGND: the chunk is done when the target is back in background mode
+    # The target is halted then, the memory cache is used again
+    def waitforbootloader(self, size, timeout=5.0, kind="bootloader", message="Error: flashing timed out"):
+        def poll():
+            status = self.usbdm.readBdmStatusRegister()
+            return not status[0] and status[4] & self.usbdm.BDMSTS_BDMACT == self.usbdm.BDMSTS_BDMACT, status
+        status = self.waitforcompletion(kind, poll, size, timeout, message)
+        self.usbdm.setTargetRunning(False)
+        return status
+
+    def logcommandtimes(self):
+        for kind, history in self.commandtimes.items():
+            ordered = sorted(history)
+            log("%-12s n=%d min=%.2f ms median=%.2f ms max=%.2f ms"%(kind, len(ordered), ordered[0]*1000, ordered[len(ordered)//2]*1000, ordered[-1]*1000),
+                level=LOGL_VERBOSE, tag = self.NAME)
+
+    # Double buffered flashing: the resident loop in RAM programs one buffer while
+    # the next chunk is uploaded into the other one. The mailbox holds for each buffer
+    # the destination and the byte count, the loop clears the count when it is done
+    @traced("flash pingpong")
+    def flashpingpong(self):
+        log("Loading double buffered bootloader into RAM",level=LOGL_VERBOSE,tag = self.NAME)
+        self.halt()
+        with tracespan("bootloader upload"):
+            self.writememory(self.PINGPONG_MAILBOX, bytes(8))
+            self.writememory(self.PINGPONG_ENTRY, b"".join(self.pingpongloader))
+
+        log("Executing bootloader ", level=LOGL_VERBOSE,tag = self.NAME)
+        self.usbdm.writeRegister(self.REGISTER_PC, self.PINGPONG_ENTRY)   # set PC Counter
+        self.usbdm.runTarget()
+
+        self.pingpongsizes = [0, 0]
+        self.pingpongstarts = [0.0, 0.0]
+        slot = 0
+        for pageaddress in self.ChipPages:
+            if len(self.memorypages[pageaddress]) == 0:
+                log("Skipping Page %X"%(pageaddress), level=LOGL_NORMAL,tag = self.NAME)
+                continue
+
+            log("Flashing Page %X"%(pageaddress), level=LOGL_NORMAL,tag = self.NAME)
+            pagestart = self.ChipPages[pageaddress][0]
+
+            # The page window can only be moved when both buffers are flashed
+            self.waitforpingpong(0)
+            self.waitforpingpong(1)
+            self.selectpage(pageaddress)
+
+            for segment in self.memorypages[pageaddress]:
+                written = 0
+                dataleft = segment.getlength()
+                memorystart = segment.address-pagestart
+                while dataleft > 0:
+                    sztowrite = min(dataleft, self.PINGPONG_BUFFER_SIZE)
+                    destination = self.ADDRESS_MAPPED_PAGE + memorystart + written
+                    self.waitforpingpong(slot)
+
+                    log("Flashing %d Bytes, Address: %x Buffer: %d", level=LOGL_VERBOSE,tag = self.NAME, args=(sztowrite, destination, slot))
+                    with tracespan("chunk", address="%X"%destination, bytes=sztowrite):
+                        self.usbdm.beginBatch()
+                        self.writememory(self.PINGPONG_BUFFERS[slot], segment.data[written:written+sztowrite])
+                        self.usbdm.writeBdmWord(self.PINGPONG_MAILBOX+slot*4, destination)
+                        self.usbdm.writeBdmWord(self.PINGPONG_MAILBOX+slot*4+2, sztowrite)    # count last, this starts the flashing
+                        self.usbdm.endBatch()
+                    self.pingpongsizes[slot] = sztowrite
+                    self.pingpongstarts[slot] = time.monotonic()
+
+                    slot = slot ^ 1
+                    written = written + sztowrite
+                    dataleft = dataleft - sztowrite
+
+        self.waitforpingpong(0)
+        self.waitforpingpong(1)
+        log("Halting bootloader ", level=LOGL_VERBOSE,tag = self.NAME)
+        self.usbdm.haltTarget()
+
+    # Checksum verify: the crc loader computes the CRC-16 of each page on the target (CCITT, as
+    # binascii.crc_hqx) and only the result is read back. Returns the pages differing from the image
+    @traced("crc verify")
+    def verifycrc(self, pages=None):
+        log("Loading crc loader into RAM",level=LOGL_VERBOSE,tag = self.NAME)
+        self.halt()
+        with tracespan("crc loader upload"):
+            self.usbdm.beginBatch()
+            self.writememory(self.CRC_TABLE, crc16table())
+            self.writememory(self.CRC_ENTRY, b"".join(self.crcloader))
+            self.usbdm.endBatch()
+
+        differing = []
+        for pageaddress in (self.ChipPages if pages == None else pages):
+            log("Checking Page %X"%(pageaddress), level=LOGL_NORMAL,tag = self.NAME)
+            image = pageimage(self.memorypages[pageaddress], self.ChipPages[pageaddress][0], self.PAGE_LENGTH)
+
+            self.usbdm.beginBatch()
+            self.selectpage(pageaddress)
+            self.usbdm.writeBdmWord(self.CRC_MAILBOX, self.ADDRESS_MAPPED_PAGE)
+            self.usbdm.writeBdmWord(self.CRC_MAILBOX+2, (self.ADDRESS_MAPPED_PAGE+self.PAGE_LENGTH)&0xFFFF)
+            self.usbdm.writeRegister(self.REGISTER_PC, self.CRC_ENTRY)
+            self.usbdm.runTarget()
+            self.usbdm.endBatch()
+            self.waitforbootloader(self.PAGE_LENGTH, kind="crc", message="Error: crc loader timed out")
+
+            result = self.usbdm.readBdmBlock(self.CRC_MAILBOX+4, 2)
+            if result[0]:
+                raise ValueError("Error while reading memory")
+            crc = int.from_bytes(bytes(result[1:3]), "little")     # the loader keeps the crc bytes swapped
+            self.pagecrcs[pageaddress] = crc
+            if crc != binascii.crc_hqx(image, 0xFFFF):
+                log("Page %X crc %04X expected %04X"%(pageaddress, crc, binascii.crc_hqx(image, 0xFFFF)), level=LOGL_NORMAL,tag = self.NAME)
+                differing.append(pageaddress)
+        return differing
+
+    # Differential programming: only the sectors differing from the image are erased and programmed
+    # Pages with a matching checksum are skipped, the others are read back and compared sector by sector
+    # Erased pages are not read back, their changed sectors are the ones the image has data in
+    @traced("flash differential")
+    def flashdifferential(self):
+        pages = list(self.ChipPages.keys())
+        self.pagecrcs = {}
+        if self.crcloader != None:
+            pages = self.verifycrc()
+        erasedcrc = binascii.crc_hqx(b"\xff"*self.PAGE_LENGTH, 0xFFFF)
+
+        changed = {}
+        erased = set()
+        for pageaddress in pages:
+            pagestart = self.ChipPages[pageaddress][0]
+            image = pageimage(self.memorypages[pageaddress], pagestart, self.PAGE_LENGTH)
+            if self.pagecrcs.get(pageaddress) == erasedcrc:
+                erased.add(pageaddress)
+                mismatches = comparememory(b"\xff"*self.PAGE_LENGTH, image, pagestart)
+            else:
+                log("Comparing Page %X"%(pageaddress), level=LOGL_NORMAL,tag = self.NAME)
+                self.selectpage(pageaddress)
+                mismatches = self.verifymemory(self.ADDRESS_MAPPED_PAGE, image, pagestart)
+            sectors = set()
+            for address, expected, read in mismatches:
+                first = (address-pagestart)//self.SECTOR_LENGTH
+                last = (address-pagestart+len(read)-1)//self.SECTOR_LENGTH
+                sectors.update(range(first, last+1))
+            if sectors:
+                changed[pageaddress] = sorted(sectors)
+            log("Page %X: %d sectors changed"%(pageaddress, len(sectors)), level=LOGL_NORMAL,tag = self.NAME)
+
+        # the image clipped to the changed sectors, flashed like a whole image
+        clippedpages = {}
+        for pageaddress in self.ChipPages:
+            clippedpages[pageaddress] = []
+        for pageaddress, sectors in changed.items():
+            pagestart = self.ChipPages[pageaddress][0]
+            for sector in sectors:
+                if pageaddress not in erased:
+                    self.erasesector(pageaddress, sector*self.SECTOR_LENGTH)
+                start = pagestart+sector*self.SECTOR_LENGTH
+                end = start+self.SECTOR_LENGTH
+                for segment in self.memorypages[pageaddress]:
+                    first = max(start, segment.address)
+                    last = min(end, segment.getsegmentend()+1)
+                    if first >= last:
+                        continue
+                    clipped = clippedpages[pageaddress]
+                    if clipped and clipped[-1].getsegmentend()+1 == first:
+                        clipped[-1].append(segment.data[first-segment.address:last-segment.address])
+                    else:
+                        clipped.append(Segment(first, bytes(segment.data[first-segment.address:last-segment.address])))
+        self.flashsegments(clippedpages)
+
+    # Flash page assignments other than the image's with the chip's flash routine
+    def flashsegments(self, memorypages):
+        imagepages = self.memorypages
+        self.memorypages = memorypages
+        try:
+            self.flash()
+        finally:
+            self.memorypages = imagepages
+
+    # Image byte at an address, erased flash where the image has no data
+    def imagebyte(self, address):
+        segment = self.memory.findsegment(address)
+        if segment == None:
+            return 0xFF
+        return segment.data[address-segment.address]
+
+    # Repair plan for the mismatches of a verify: the words whose wrong bits are still set are
+    # programmed again, flash bits only change from 1 to 0 without an erase
+    # Returns the page assignments of the repairable words and the number of words needing an erase
+    def repairplan(self, mismatches):
+        repairpages = {}
+        for pageaddress in self.ChipPages:
+            repairpages[pageaddress] = []
+        unrepairable = 0
+        for address, expected, read in mismatches:
+            start = address-address%self.PROGRAM_UNIT
+            for word in range(start, address+len(read), self.PROGRAM_UNIT):
+                # bytes outside the mismatch matched the image
+                want = bytes(self.imagebyte(word+idx) for idx in range(self.PROGRAM_UNIT))
+                have = bytes(read[word+idx-address] if 0 <= word+idx-address < len(read) else want[idx] for idx in range(self.PROGRAM_UNIT))
+                if any(w & h != w for w, h in zip(want, have)):
+                    unrepairable += 1
+                    continue
+                words = repairpages[self.findpage(word)]
+                if words and words[-1].getsegmentend()+1 == word:
+                    words[-1].append(want)
+                elif not words or words[-1].getsegmentend() < word:
+                    words.append(Segment(word, want))
+        return repairpages, unrepairable
+
+    # Verify, repairing the mismatching words that don't need an erase
+    # Returns False when a word needs an erase, raises if the repaired words still don't match
+    @traced("verify and repair")
+    def verifyandrepair(self):
+        self.mismatches = []
+        try:
+            self.verify()
+            return True
+        except ValueError:
+            if not self.userepair or self.failfast or not self.mismatches:
+                raise
+        repairpages, unrepairable = self.repairplan(self.mismatches)
+        if unrepairable:
+            log("%d words need an erase, reprogramming the device"%unrepairable, level=LOGL_NORMAL,tag = self.NAME)
+            return False
+
+        log("Repairing %d mismatches"%len(self.mismatches), level=LOGL_NORMAL,tag = self.NAME)
+        self.flashsegments(repairpages)
+        mismatches = []
+        for pageaddress, words in repairpages.items():
+            pagestart = self.ChipPages[pageaddress][0]
+            for segment in words:
+                self.selectpage(pageaddress)
+                mismatches.extend(self.verifymemory(self.ADDRESS_MAPPED_PAGE+segment.address-pagestart, segment.data, segment.address))
+        self.checkmismatches(mismatches)
+        return True
+
+    # Log the [address, expected, read] ranges that did not match
+    def checkmismatches(self, mismatches):
+        self.mismatches = mismatches
+        if mismatches:
+            for address, expected, read in mismatches:
+                shown = "" if len(read) <= 16 else ".."
+                log("Memory did not match at %10X-%10X expected: %s%s read: %s%s"%(address, address+len(read)-1, expected[:16].hex(), shown, read[:16].hex(), shown),level=LOGL_VERBOSE,tag = self.NAME)
+            raise ValueError("Error: Contents don't match the file")
+        else:
+            log("Verified. Contents are good",level=LOGL_NORMAL,tag = self.NAME)
+
+    # Wait until the bootloader has cleared the count of the buffer, a buffer never filled is free
+    # The loop keeps running, so the count is the done signal. The expected time counts from the
+    # handover of the chunk, the upload of the other buffer is part of it
+    def waitforpingpong(self, slot):
+        size = self.pingpongsizes[slot]
+        if size == 0:
+            return
+        def poll():
+            mem = self.usbdm.readBdmBlock(self.PINGPONG_MAILBOX+slot*4+2,2)
+            return not mem[0] and bytes(mem[1:]) == b"\x00\x00", mem
+        self.waitforcompletion("pingpong", poll, size, message="Error: flashing timed out", start=self.pingpongstarts[slot])
+        self.pingpongsizes[slot] = 0
+
     def close(self):
         log("Closing target...",level=LOGL_NORMAL,tag = self.NAME)
         self.usbdm.closeBdm()
 
     # This routine loads memory and assigns the segments to the corresponding pages
-    def load(self, fname):
+    # base: linear start address of a .bin image
+    # Images loaded before come from the cache already assigned
+    @traced("load")
+    def load(self, fname, base=None):
         log("Loading file %s"%fname,level=LOGL_NORMAL,tag = self.NAME)
-        self.memory = loadprogramfile(fname)
-        self.memorypages = {}
-        for pgaddr in self.ChipPages:
-            self.memorypages[pgaddr] = []
+        cachename = None
+        if self.imagecache != None and fname != "-":
+            cachename = imagecachename(self.imagecache, fname, self.NAME, base)
+            cached = readimagecache(cachename, self.ChipPages)
+            if cached != None:
+                self.memory, self.memorypages = cached
+                log("Loaded prepared image %s: %d Bytes %d Segments"%(cachename, self.memory.gettotalbytes(), len(self.memory.segments)),level=LOGL_VERBOSE, tag = self.NAME)
+                self.makeimagetag()
+                return
 
-        splitneeded = False
-        # check which segments need to be written to
-        for pgaddr in self.ChipPages:
-            pagestart = self.ChipPages[pgaddr][0]
-            pageend = self.ChipPages[pgaddr][1]
-            contains = 0
-
-            length = len(self.memory.segments)
-            idx = 0
-            while idx<length:
-                segment = self.memory.segments[idx]
-                if pagestart<=segment.address and segment.address<=pageend:
-                    if segment.getsegmentend()<=pageend:
-                        self.memorypages[pgaddr].append(segment)
-                    else:
-                        splitneeded = True
-                        self.memorypages[pgaddr].append(self.memory.splitsegment(idx,pageend))
-                        length = len(self.memory.segments)
-                        break
-                idx +=1
-        if splitneeded:
+        self.memory = loadprogramfile(fname, self.ChipPages, base)
+        self.assignpages()
+
+        for pgaddr in self.memorypages:
+            log("Page %x contains %d segments"%(pgaddr, len(self.memorypages[pgaddr])),level=LOGL_NORMAL, tag = self.NAME)
+        log("All Segments were assigned",level=LOGL_VERBOSE, tag = self.NAME)
+
+        if cachename != None:
+            try:
+                writeimagecache(cachename, self.memorypages)
+            except OSError as e:
+                log("Couldn't cache the image: %s"%e,level=LOGL_VERBOSE, tag = self.NAME)
+        self.makeimagetag()
+
+    # The flash blocks (FLASH_BLOCKS of the chip) are erased and blank checked as a whole
+    # Returns the blocks holding image data and the ones which only have to be blank
+    def blockplan(self):
+        used = []
+        empty = []
+        for block in self.FLASH_BLOCKS:
+            if any(self.memorypages.get(pgaddr) for pgaddr in block):
+                used.append(block)
+            else:
+                empty.append(block)
+        return used, empty
+
+    # Pages to verify: the pages of the blocks holding data, and of empty blocks which aren't blank
+    def verifypages(self):
+        used, empty = self.blockplan()
+        blocks = used + [block for block in empty if not self.isblank(block)]
+        return [pgaddr for pgaddr in self.ChipPages if any(pgaddr in block for block in blocks)]
+
+    # Assign the segments to the pages, see pageassignments
+    def assignpages(self):
+        count = len(self.memory.segments)
+        self.memorypages = pageassignments(self.memory, self.ChipPages)
+        if len(self.memory.segments) != count:
             log("Segments after split",level=LOGL_VERBOSE, tag = self.NAME)
             self.memory.printsegments()
 
+    # page containing the image address
+    def findpage(self, address):
+        for pgaddr in self.ChipPages:
+            if self.ChipPages[pgaddr][0] <= address <= self.ChipPages[pgaddr][1]:
+                return pgaddr
+        raise ValueError("Error: address %X is not in the flash pages"%address)
 
-        assignedsegments = 0
-        for pgaddr in self.memorypages:
-            assignedsegments +=len(self.memorypages[pgaddr])
-            log("Page %x contains %d segments"%(pgaddr, len(self.memorypages[pgaddr])),level=LOGL_NORMAL, tag = self.NAME)
+    # The image tag, a hash of the image, is programmed at tagaddress once the image is flashed and verified
+    # It stays out of memorypages: a run failing before leaves no tag over a partial image
+    def makeimagetag(self):
+        self.imagetag = None
+        if self.tagaddress == None:
+            return
+        end = self.tagaddress+self.IMAGE_TAG_LENGTH-1
+        if self.tagaddress%2 != 0:
+            raise ValueError("Error: the tag address has to be even")
+        pgaddr = self.findpage(self.tagaddress)
+        if self.findpage(end) != pgaddr:
+            raise ValueError("Error: the tag has to be inside one page")
+        for segment in self.memory.segments:
+            if segment.address <= end and self.tagaddress <= segment.getsegmentend():
+                raise ValueError("Error: the tag at %X overlaps the image"%self.tagaddress)
 
-        if assignedsegments != len(self.memory.segments):
-            raise ValueError("Error: some of the segments were not assigned")
-        else:
-            log("All Segments were assigned",level=LOGL_VERBOSE, tag = self.NAME)
+        digest = hashlib.sha256()
+        for segment in self.memory.segments:
+            digest.update(segment.address.to_bytes(4,"big") + segment.getlength().to_bytes(4,"big"))
+            digest.update(segment.data)
+        self.imagetag = digest.digest()[:self.IMAGE_TAG_LENGTH]
+        log("Image tag %s at %X"%(self.imagetag.hex(), self.tagaddress),level=LOGL_VERBOSE, tag = self.NAME)
+
+    # The page assignments with the tag segment, as program() leaves the chip
+    def taggedpages(self):
+        if self.imagetag == None:
+            return self.memorypages
+        pgaddr = self.findpage(self.tagaddress)
+        pages = dict(self.memorypages)
+        pagesegments = list(pages[pgaddr])
+        pagesegments.insert(sum(1 for segment in pagesegments if segment.address < self.tagaddress), Segment(self.tagaddress, self.imagetag))
+        pages[pgaddr] = pagesegments
+        return pages
+
+    # Checks of a programmed chip compare against the image with its tag
+    @contextlib.contextmanager
+    def taggedimage(self):
+        imagepages = self.memorypages
+        self.memorypages = self.taggedpages()
+        try:
+            yield
+        finally:
+            self.memorypages = imagepages
+
+    # Verify the chip as program() leaves it
+    def verifyimage(self):
+        with self.taggedimage():
+            return self.verify()
+
+    # Program the tag after flash and verify succeeded, the erase or differential flash before
+    # cleared a stale tag: the image has erased flash there
+    @traced("image tag")
+    def writeimagetag(self):
+        if self.imagetag == None:
+            return
+        log("Programming image tag at %X"%self.tagaddress,level=LOGL_VERBOSE, tag = self.NAME)
+        tagpages = {pgaddr: [] for pgaddr in self.ChipPages}
+        tagpages[self.findpage(self.tagaddress)] = [Segment(self.tagaddress, self.imagetag)]
+        self.flashsegments(tagpages)
+        if not self.readimagetag():
+            raise ValueError("Error: the image tag doesn't verify")
+
+    # Tag on the chip matches the loaded image, read with a single block read
+    def readimagetag(self):
+        pgaddr = self.findpage(self.tagaddress)
+        self.selectpage(pgaddr)
+        result = self.usbdm.readBdmBlock(self.ADDRESS_MAPPED_PAGE+self.tagaddress-self.ChipPages[pgaddr][0], self.IMAGE_TAG_LENGTH)
+        return not result[0] and bytes(result[1:]) == self.imagetag
+
+    # The chip holds the loaded image already if its tag matches
+    # tagcheck confirms it by checksum, where the chip has a crc loader
+    @traced("image tag check")
+    def checkimagetag(self):
+        if self.imagetag == None:
+            return False
+        if not self.readimagetag():
+            log("Image tag differs, programming",level=LOGL_VERBOSE, tag = self.NAME)
+            return False
+
+        log("Image tag matches the loaded image",level=LOGL_NORMAL, tag = self.NAME)
+        if self.tagcheck and self.crcloader != None:
+            with self.taggedimage():
+                differs = self.verifycrc()
+            if differs:
+                log("Checksums differ from the image, programming",level=LOGL_NORMAL, tag = self.NAME)
+                return False
+        log("Verified. Contents are good",level=LOGL_NORMAL,tag = self.NAME)
+        return True
 
 
     def identify(self):
@@ -1,8 +1,6 @@
 from helpers import *
 from usbdm import*
 from chips.chipinterface import ChipInterface
-import threading
-from queue import Queue
 
 # Note: D64-Flash can only write word-length
 # Chip Clock is 40 Mhz, Bus Clock is 20 Mhz
@@ -11,6 +9,9 @@ from queue import Queue
 class MC9S08DZ128(ChipInterface):
     NAME = "MC9S08DZ128"
     ADDRESS_MAPPED_PAGE = 0x8000
+    PAGES = {0:[0x2180,0x217F], 1:[0x4000,0x7FFF], 2:[0x8000,0xBFFF], 3:[0xC000,0xFFFF],4:[0x48000,0x4BFFF],5:[0x58000,0x5BFFF],6:[0x68000,0x6BFFF],7:[0x78000,0x7BFFF]}   # page -> [first, last] linear address
+    PROGRAM_UNIT = 1
+    VOLATILE_RANGES = [[0x0000,0x007F],[0x1800,0x18FF]]    # direct page and high page registers
     ADDRESS_SECURITY = 0xFFBF
 
     VALUE_SECURITY_UNSECURE = 0xFFFE
@@ -56,7 +57,7 @@ class MC9S08DZ128(ChipInterface):
 
     def __init__(self,usbdm):
         # Note: linear access addresses differ from addresses used in .hex or .s19 files
-        ChipInterface.__init__(self, usbdm, 0x01, {0:[0x2180,0x217F], 1:[0x4000,0x7FFF], 2:[0x8000,0xBFFF], 3:[0xC000,0xFFFF],4:[0x48000,0x4BFFF],5:[0x58000,0x5BFFF],6:[0x68000,0x6BFFF],7:[0x78000,0x7BFFF]}, 0x1806, [0x0119,0x2019])
+        ChipInterface.__init__(self, usbdm, 0x01, self.PAGES, 0x1806, [0x0119,0x2019])
 
         # Because bootloader is loaded in RAM area which can be
         # addressed with one byte the locations of variables are addressed as such
@@ -94,7 +95,7 @@ class MC9S08DZ128(ChipInterface):
         #B0+3  \xc4\x18\x25         # [anda opr16a] check if CBCCF bit is set
         #B3+2  \x27\xf9\             # [beq rel] branch until CBCCF is set
         #B5+2  \x3c\x86             # [inc $0x86] set "flashing done flag"
-        #B7+2  \x20\xfe              # loop
+        #B7+1  \x82                  # [bgnd] enter background mode, the host waits for BDMACT
 
 
         self.bootloader =  [b"\xa6\x80",\
@@ -120,10 +121,11 @@ class MC9S08DZ128(ChipInterface):
                             b"\xc4\x18\x25",\
                             b"\x27\xf9",\
                             b"\x3c\x86",\
-                            b"\x20\xfe",\
+                            b"\x82",\
                             ]
 
 
+    @traced("unsecure")
     def unsecure(self):
         protection = self.usbdm.readBdmByte(MC9S08DZ128.REG_FPROT)[1]
 
@@ -139,6 +141,7 @@ class MC9S08DZ128(ChipInterface):
             self.blankcheck()
 
 
+    @traced("setup")
     def setup(self):
         # After Reset the MCGOUT defaults to 16 Mhz(wrong): using Internal Clock + FLL
         # if Clock Defaults to 32 - 40 Mhz so need to clear the DRS bit
@@ -160,12 +163,14 @@ class MC9S08DZ128(ChipInterface):
 
 
         # Set Flash CLock to <~200 Khz for 8 Mhz bus
+        self.usbdm.beginBatch()
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FCLKDIV, 0x2e) # 2e?
 
         # Setup flash registers
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FCNFG, 0x00)
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FPROT, 0xFF)
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FSTAT, 0xFF)    # Reset FSTAT
+        self.usbdm.endBatch()
 
         # TODO add FLL and PLL examples here to check if clock is working
         # Required Clock Generator Mode PBE: PLL bypassex external Page.189
@@ -185,6 +190,7 @@ class MC9S08DZ128(ChipInterface):
         #self.usbdm.writeBdmByte(MC9S08DZ128.REG_MCGC2, 0x38)
 
     # Need to connect to program
+    @traced("program")
     def program(self):
         # During Burst Programming the sequential flash accesses are faster than singular
         start = time.time()
@@ -198,24 +204,36 @@ class MC9S08DZ128(ChipInterface):
                     self.unsecure()
                     self.erase()
                     retries +=1
+                elif retries == 0 and self.checkimagetag():
+                    break
                 elif self.blankcheck():
                     self.unsecure()
                     self.erase()
                     retries +=1
                 else:
                     self.flash()
-                    self.verify()
-                    break
+                    if self.verifyandrepair():
+                        self.writeimagetag()
+                        break
+                    self.unsecure()
+                    self.erase()
+                    retries +=1
 
+        self.logcommandtimes()
         log("time: %s s"%str(time.time()-start), level=LOGL_NORMAL,tag = self.NAME)
 
+    def selectpage(self, pageaddress):
+        self.usbdm.writeBdmByte(MC9S08DZ128.REG_PAGE_MAP, pageaddress)
+
+    @traced("flash")
     def flash(self):
         log("Loading bootloader into RAM",level=LOGL_VERBOSE,tag = self.NAME)
         self.halt()
 
         jbootloader = b"".join(self.bootloader)
         dataoffset = len(jbootloader)+7
-        self.writememory(MC9S08DZ128.RAM_START+7, jbootloader)
+        with tracespan("bootloader upload"):
+            self.writememory(MC9S08DZ128.RAM_START+7, jbootloader)
 
         pagenumbers = list(self.ChipPages.keys())  # are the keys
 
@@ -245,40 +263,39 @@ class MC9S08DZ128(ChipInterface):
                         else:
                             sztowrite = dataleft
 
-                        log("Flashing %d Bytes, Address: %x "%(sztowrite,MC9S08DZ128.ADDRESS_MAPPED_PAGE + memorystart + written), level=LOGL_VERBOSE,tag = self.NAME)
-                        self.writememory(MC9S08DZ128.RAM_START+dataoffset,segment.data[written:written+sztowrite])
-
-                        self.usbdm.writeBdmByte(MC9S08DZ128.REG_FSTAT, 0xFF)    # Reset FSTAT
-                        self.usbdm.writeBdmWord(MC9S08DZ128.RAM_START, MC9S08DZ128.ADDRESS_MAPPED_PAGE + memorystart + written)
-                        self.usbdm.writeBdmWord(MC9S08DZ128.RAM_START+2, (MC9S08DZ128.RAM_START+sztowrite+dataoffset).to_bytes(2,"big"))
-                        self.usbdm.writeBdmWord(MC9S08DZ128.RAM_START+4, (MC9S08DZ128.RAM_START+dataoffset).to_bytes(2,"big"))
-                        self.usbdm.writeBdmByte(MC9S08DZ128.RAM_START+6, 0x00)
-
-                        log("Executing bootloader ", level=LOGL_VERBOSE,tag = self.NAME)
-                        self.usbdm.writeRegister(0x0B, MC9S08DZ128.RAM_START+7)   # set PC Counter
-                        self.usbdm.runTarget()               # execute boot loader
-                        timeout = time.time() * 1000  + 5000
-                        while True:
-                            if time.time()*1000<timeout:
-                                flashingdone = self.usbdm.readBdmByte(MC9S08DZ128.RAM_START+6)
-                                #self.readmemory(0x4000, 50)
-                                if flashingdone[1] == 0x01:
-                                    break
-                            else:
-                                raise ValueError("Error: flashing timed out")
-
-                        log("Halting bootloader ", level=LOGL_VERBOSE,tag = self.NAME)
-                        self.usbdm.haltTarget()
+                        log("Flashing %d Bytes, Address: %x ", level=LOGL_VERBOSE,tag = self.NAME, args=(sztowrite,MC9S08DZ128.ADDRESS_MAPPED_PAGE + memorystart + written))
+                        with tracespan("chunk", address="%X"%(MC9S08DZ128.ADDRESS_MAPPED_PAGE + memorystart + written), bytes=sztowrite):
+                            self.usbdm.beginBatch()
+                            self.writememory(MC9S08DZ128.RAM_START+dataoffset,segment.data[written:written+sztowrite])
+
+                            self.usbdm.writeBdmByte(MC9S08DZ128.REG_FSTAT, 0xFF)    # Reset FSTAT
+                            self.usbdm.writeBdmWord(MC9S08DZ128.RAM_START, MC9S08DZ128.ADDRESS_MAPPED_PAGE + memorystart + written)
+                            self.usbdm.writeBdmWord(MC9S08DZ128.RAM_START+2, (MC9S08DZ128.RAM_START+sztowrite+dataoffset).to_bytes(2,"big"))
+                            self.usbdm.writeBdmWord(MC9S08DZ128.RAM_START+4, (MC9S08DZ128.RAM_START+dataoffset).to_bytes(2,"big"))
+                            self.usbdm.writeBdmByte(MC9S08DZ128.RAM_START+6, 0x00)
+
+                            log("Executing bootloader ", level=LOGL_VERBOSE,tag = self.NAME)
+                            self.usbdm.writeRegister(0x0B, MC9S08DZ128.RAM_START+7)   # set PC Counter
+                            self.usbdm.runTarget()               # execute boot loader
+                            self.usbdm.endBatch()
+                            self.waitforbootloader(sztowrite)
+                            flashingdone = self.usbdm.readBdmByte(MC9S08DZ128.RAM_START+6)
+                            if flashingdone[1] != 0x01:
+                                raise ValueError("Error: bootloader stopped before flashing was done")
                         written = written + sztowrite
                         dataleft = dataleft - sztowrite
 
+    @traced("erase")
     def erase(self):
         log("Mass Erasing flash" , level=LOGL_NORMAL,tag = self.NAME)
+        self.usbdm.beginBatch()
         self.usbdm.writeBdmByte(0x3bf0, 0xFF) #
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FCMD, MC9S08DZ128.CMD_ERASE_MASS)
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FSTAT, MC9S08DZ128.BITS_FSTAT_CBEIF)
-        self.waitForFlash()
+        self.usbdm.endBatch()
+        self.waitForFlash("erasemass")
 
+    @traced("blank check")
     def blankcheck(self):
         status = 0
         log("Blank check ",level=LOGL_VERBOSE,tag = self.NAME)
@@ -286,7 +303,7 @@ class MC9S08DZ128(ChipInterface):
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FCMD, MC9S08DZ128.CMD_BLANK)
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FSTAT, MC9S08DZ128.BITS_FSTAT_CBEIF)
 
-        readstatus = self.waitForFlash()
+        readstatus = self.waitForFlash("blank")
         if readstatus & MC9S08DZ128.BITS_FSTAT_BLANK == MC9S08DZ128.BITS_FSTAT_BLANK:
             log("Device is blank",level=LOGL_NORMAL,tag = self.NAME)
         else:
@@ -295,9 +312,9 @@ class MC9S08DZ128(ChipInterface):
         self.usbdm.writeBdmByte(MC9S08DZ128.REG_FSTAT, 0x30)    # Reset FSTAT
         return status
 
+    @traced("verify")
     def verify(self):
-       threads = []
-       errorQueue = Queue()
+       mismatches = []
 
        # compare segment addresses
        for segment in self.memory.segments:
@@ -310,40 +327,17 @@ class MC9S08DZ128(ChipInterface):
                if segaddress>= pagestart and segaddress<=pageend:
                     log("Verifying Segment %X"%(segaddress), level=LOGL_NORMAL,tag = self.NAME)
                     self.usbdm.writeBdmByte(MC9S08DZ128.REG_PAGE_MAP, pagenumber)
-                    flashmemory = self.readmemory(MC9S08DZ128.ADDRESS_MAPPED_PAGE+(segaddress-pagestart), segment.getlength())
-                    thread = threading.Thread(target=comparememorytosegment, args=(segment, flashmemory, errorQueue,))
-                    threads.append(thread)
-                    thread.start()
+                    mismatches.extend(self.verifymemory(MC9S08DZ128.ADDRESS_MAPPED_PAGE+(segaddress-pagestart), segment.data, segaddress, self.failfast))
                     found = True
            if not found:
                raise ValueError("Error: segment address not assigned to pages")
+           if mismatches and self.failfast:
+               break
 
-       for t in threads:
-           t.join()
-
-       if not errorQueue.empty():
-           while not errorQueue.empty():
-               result = errorQueue.get()
-               log("Memory did not match at %10X expected: %2s read: %2s"%(result[0], result[1], result[2]),level=LOGL_VERBOSE,tag = self.NAME)
-
-           raise ValueError("Error: Contents don't match the file")
-       else:
-           log("Verified. Contents are good",level=LOGL_NORMAL,tag = self.NAME)
-
-
-    def waitForFlash(self):
-        timeout = time.time()*1000  + 5000 # 5 seconds
-        readstatus = 0x00
-        while True:
-            if time.time()*1000<timeout:
-                time.sleep(0.010)
-                readstatus = self.usbdm.readBdmByte(MC9S08DZ128.REG_FSTAT)[1]
-                if readstatus & MC9S08DZ128.BITS_FSTAT_ACCER == MC9S08DZ128.BITS_FSTAT_ACCER:
-                    raise ValueError("Error: couldn't access flash")
-                elif readstatus & MC9S08DZ128.BITS_FSTAT_PVIOL == MC9S08DZ128.BITS_FSTAT_PVIOL:
-                    raise ValueError("Error: protection violation flash")
-                elif readstatus & MC9S08DZ128.BITS_FSTAT_CCIF == MC9S08DZ128.BITS_FSTAT_CCIF:
-                   break
-            else:
-                raise ValueError("Error: command timed out")
-        return readstatus
+       self.checkmismatches(mismatches)
+
+
+    def waitForFlash(self, kind="program"):
+        return self.waitforcommand(kind, MC9S08DZ128.REG_FSTAT, MC9S08DZ128.BITS_FSTAT_CCIF,
+                                   [(MC9S08DZ128.BITS_FSTAT_ACCER, "Error: couldn't access flash"),
+                                    (MC9S08DZ128.BITS_FSTAT_PVIOL, "Error: protection violation flash")])
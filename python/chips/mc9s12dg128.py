@@ -1,20 +1,32 @@
 from helpers import *
 from usbdm import*
 from chips.chipinterface import ChipInterface
-import threading
-from queue import Queue
 
 # Note: DJ64-Flash can only write word-length
 # Chip standard Clock is 8Mhz
 class MC9S12DG128(ChipInterface):
     NAME = "MC9S12DG128"
     ADDRESS_MAPPED_PAGE = 0x8000
+    PAGES = {0x38:[0x388000,0x38BFFF], 0x39:[0x398000,0x39BFFF], 0x3A:[0x3A8000,0x3ABFFF], 0x3B:[0x3B8000,0x3BBFFF], 0x3E:[0x4000,0x7FFF], 0x3F:[0xC000,0xFFFF], 0x3C:[0x3C8000,0x3CBFFF], 0x3D:[0x3D8000,0x3DBFFF]}   # page -> [first, last] linear address
     ADDRESS_PROTECTION_FLASH0 = 0xFF0D
     ADDRESS_PROTECTION_FLASH1 = 0xFF0E
     ADDRESS_SECURITY_FLASH   = 0xFF0F
     RAM_START = 0x4000
     RAM_END   = 0x5000
     PAGE_LENGTH = 0x4000
+    SECTOR_LENGTH = 0x200
+    FLASH_BLOCKS = [[0x3C,0x3D,0x3E,0x3F], [0x38,0x39,0x3A,0x3B]]     # BLKSEL 0 and 1
+    REGISTER_PC = 0x03
+
+    # Double buffered bootloader: mailbox, code and two buffers in RAM
+    PINGPONG_MAILBOX = RAM_START             # DEST0 COUNT0 DEST1 COUNT1
+    PINGPONG_ENTRY   = RAM_START+0x08
+    PINGPONG_BUFFER_SIZE = (RAM_END - (RAM_START+0x60))//2
+    PINGPONG_BUFFERS = [RAM_START+0x60, RAM_START+0x60+PINGPONG_BUFFER_SIZE]
+    # Checksum loader: mailbox START END CRC, code behind the bootloader, crc tables
+    CRC_MAILBOX = RAM_START
+    CRC_ENTRY   = RAM_START+0x40
+    CRC_TABLE   = RAM_START+0x100
     VALUE_SECURITY_UNSECURE = 0xFFFE
     VALUE_SECURITY_SECURE = 0xFFFF
 
@@ -59,7 +71,7 @@ class MC9S12DG128(ChipInterface):
     CMD_ERASE_PAGE     = 0x41
 
     def __init__(self,usbdm):
-        ChipInterface.__init__(self, usbdm, {0x38:[0x388000,0x38BFFF], 0x39:[0x398000,0x39BFFF], 0x3A:[0x3A8000,0x3ABFFF], 0x3B:[0x3B8000,0x3BBFFF], 0x3E:[0x4000,0x7FFF], 0x3F:[0xC000,0xFFFF], 0x3C:[0x3C8000,0x3CBFFF], 0x3D:[0x3D8000,0x3DBFFF]}, 0x1A, [0x0111, 0x0112, 0x0113, 0x0114, 0x0115])
+        ChipInterface.__init__(self, usbdm, 0x00, self.PAGES, 0x1A, [0x0111, 0x0112, 0x0113, 0x0114, 0x0115])
 
         # Note: postbytes X=0x00 Y=0x40 SP= 0x80
         # D = counter X = source Y = destination S = value16
@@ -78,8 +90,8 @@ class MC9S12DG128(ChipInterface):
         # \x08\x08\x02\x02           #+35 inx 2 iny 2
         # \xbc\x40\x02               #+38 cmp D $4002
         # \x26\xe1                   #+40 bne to start
-        # \x7c\x40\x04               #+43 std $4002
-        # \x2a\xfe"                  #+45 loop
+        # \x7c\x40\x04               #+43 std $4004
+        # \x00                       #+44 bgnd, the host waits for BDMACT
         self.bootloader =  [b"\xce\x40\x60",\
                             b"\xfd\x40\x00",\
                             b"\xcc\x00\x00",\
@@ -93,8 +105,90 @@ class MC9S12DG128(ChipInterface):
                             b"\xbc\x40\x02",\
                             b"\x26\xe1",\
                             b"\x7c\x40\x04",\
-                            b"\x2a\xfe"]
-
+                            b"\x00"]
+
+        # Double buffered bootloader, runs until halted
+        # Mailbox at 4000: DEST0 COUNT0 DEST1 COUNT1, buffers at 4060 and 4830
+        # The host fills a buffer, writes DEST and then COUNT. COUNT is cleared when the buffer is flashed
+        # \xcf\x40\x60              #4008 lds #4060          stack below the buffers
+        # \xce\x40\x60              #400B ldx #4060          buffer 0
+        # \xcd\x40\x00              #400E ldy #4000          mailbox 0
+        # \x07\x0a                  #4011 bsr 401D
+        # \xce\x48\x30              #4013 ldx #4830          buffer 1
+        # \xcd\x40\x04              #4016 ldy #4004          mailbox 1
+        # \x07\x02                  #4019 bsr 401D
+        # \x20\xee                  #401B bra 400B
+        # \xec\x42                  #401D ldd 2,Y            wait for COUNT
+        # \x27\xfc                  #401F beq 401D
+        # \x35                      #4021 pshy
+        # \xed\x40                  #4022 ldy 0,Y            load DEST
+        # \x18\x02\x31\x71          #4024 movw 2,X+ 2,Y+     word into flash
+        # \x18\x0b\x20\x01\x06      #4028 movb #20, $0x106
+        # \x18\x0b\x80\x01\x05      #402D movb #80, $0x105
+        # \x1f\x01\x05\x40\xfb      #4032 loop if CCIF clear in $105
+        # \x83\x00\x02              #4037 subd 2
+        # \x26\xe8                  #403A bne 4024
+        # \x31                      #403C puly
+        # \xcc\x00\x00              #403D ldd 0
+        # \x6c\x42                  #4040 std 2,Y            clear COUNT
+        # \x3d                      #4042 rts
+        self.pingpongloader = [b"\xcf\x40\x60",\
+                               b"\xce\x40\x60",\
+                               b"\xcd\x40\x00",\
+                               b"\x07\x0a",\
+                               b"\xce\x48\x30",\
+                               b"\xcd\x40\x04",\
+                               b"\x07\x02",\
+                               b"\x20\xee",\
+                               b"\xec\x42",\
+                               b"\x27\xfc",\
+                               b"\x35",\
+                               b"\xed\x40",\
+                               b"\x18\x02\x31\x71",\
+                               b"\x18\x0b\x20\x01\x06",\
+                               b"\x18\x0b\x80\x01\x05",\
+                               b"\x1f\x01\x05\x40\xfb",\
+                               b"\x83\x00\x02",\
+                               b"\x26\xe8",\
+                               b"\x31",\
+                               b"\xcc\x00\x00",\
+                               b"\x6c\x42",\
+                               b"\x3d"]
+
+        # Checksum loader, CRC-16 CCITT of START..END-1 (even length) into CRC
+        # Mailbox at 4000: START END CRC, tables of the high and low crc bytes at 4100 and 4200
+        # A and B swap their roles with every byte, so two bytes are done per loop
+        # \xfe\x40\x00              #4040 ldx $4000          source
+        # \xcf\x42\x00              #4043 lds #4200          low bytes table
+        # \xcd\x41\x00              #4046 ldy #4100          high bytes table
+        # \xcc\xff\xff              #4049 ldd #ffff          crc, B = high A = low
+        # \xe8\x30                  #404C eorb 1,X+          index = high ^ data
+        # \xa8\xed                  #404E eora B,Y           new high = low ^ high table
+        # \xe6\xf5                  #4050 ldab B,SP          new low from the low table
+        # \xa8\x30                  #4052 eora 1,X+          same with A = high B = low
+        # \xe8\xec                  #4054 eorb A,Y
+        # \xa6\xf4                  #4056 ldaa A,SP
+        # \xbe\x40\x02              #4058 cpx $4002
+        # \x26\xef                  #405B bne 404C
+        # \x7c\x40\x04              #405D std $4004          crc low byte first
+        # \x00                      #4060 bgnd
+        self.crcloader = [b"\xfe\x40\x00",\
+                          b"\xcf\x42\x00",\
+                          b"\xcd\x41\x00",\
+                          b"\xcc\xff\xff",\
+                          b"\xe8\x30",\
+                          b"\xa8\xed",\
+                          b"\xe6\xf5",\
+                          b"\xa8\x30",\
+                          b"\xe8\xec",\
+                          b"\xa6\xf4",\
+                          b"\xbe\x40\x02",\
+                          b"\x26\xef",\
+                          b"\x7c\x40\x04",\
+                          b"\x00"]
+        self.usepingpong = False
+
+    @traced("unsecure")
     def unsecure(self):
         log("Unsecuring chip by erasing protection configuration",level=LOGL_NORMAL,tag = self.NAME)
         self.setup()
@@ -118,7 +212,7 @@ class MC9S12DG128(ChipInterface):
         self.usbdm.writeBdmWord(0x10a,0xffff) #EDATA HI
         self.usbdm.writeBdmByte(MC9S12DG128.REG_FCMD, MC9S12DG128.CMD_ERASE_PAGE)
         self.usbdm.writeBdmByte(MC9S12DG128.REG_FSTAT, MC9S12DG128.BITS_FSTAT_CBEIF)
-        self.waitForFlash()
+        self.waitForFlash("erasemass")
         # write 105 30
         # write 102 00
         # write 105 02
@@ -129,8 +223,10 @@ class MC9S12DG128(ChipInterface):
         # write 105 80
         # self.reset()
 
+    @traced("setup")
     def setup(self):
         log("Setting up registers and flash access",level=LOGL_NORMAL,tag = self.NAME)
+        self.usbdm.beginBatch()
         self.usbdm.writeBdmByte(MC9S12DG128.REG_MODE, 0xe0)      # Single mode
         self.usbdm.writeBdmByte(0x3C, 0x40)                      # Stop watchdog
         self.usbdm.writeBdmByte(MC9S12DG128.REG_INITRM, 0x40)    # map the ram at 0x4000
@@ -149,8 +245,10 @@ class MC9S12DG128(ChipInterface):
         self.usbdm.writeBdmByte(MC9S12DG128.REG_ECLKDIV, 0x2A)  # ECLK
         self.usbdm.writeBdmByte(MC9S12DG128.REG_ESTAT,   0xff)  # EPROT
         self.usbdm.writeBdmByte(MC9S12DG128.REG_INITEE,  0x01)  # Enable EEPROM
+        self.usbdm.endBatch()
 
     # Need to connect to program
+    @traced("program")
     def program(self):
         start = time.time()
         if self.memory.gettotalbytes()>0:
@@ -163,22 +261,51 @@ class MC9S12DG128(ChipInterface):
                     self.unsecure()
                     self.erase()
                     retries +=1
+                elif retries == 0 and self.checkimagetag():
+                    break
+                elif self.usedifferential and retries == 0:
+                    self.flashdifferential()
+                    if self.verifyandrepair():
+                        self.writeimagetag()
+                        break
+                    self.unsecure()
+                    self.erase()
+                    retries +=1
                 elif self.blankcheck():
                     self.unsecure()
                     self.erase()
                     retries +=1
                 else:
                     self.flash()
-                    self.verify()
-                    break
+                    if self.verifyandrepair():
+                        self.writeimagetag()
+                        break
+                    self.unsecure()
+                    self.erase()
+                    retries +=1
 
+        self.logcommandtimes()
         log("time: %s s"%str(time.time()-start), level=LOGL_NORMAL,tag = self.NAME)
 
+    def selectpage(self, pageaddress):
+        # Select Flash: 0 or 1
+        if pageaddress<0x3C:
+            self.usbdm.writeBdmByte(MC9S12DG128.REG_FCNFG, MC9S12DG128.BITS_CNFG_BLKSEL)
+        else:
+            self.usbdm.writeBdmByte(MC9S12DG128.REG_FCNFG,0x00)
+        self.usbdm.writeBdmByte(MC9S12DG128.REG_PAGE_MAP, pageaddress)
+
     # Flash
+    @traced("flash")
     def flash(self):
+        if self.usepingpong:
+            self.flashpingpong()
+            return
+
         log("Loading bootloader into RAM",level=LOGL_VERBOSE,tag = self.NAME)
         self.halt()
-        self.writememory(MC9S12DG128.RAM_START+6, b"".join(self.bootloader))
+        with tracespan("bootloader upload"):
+            self.writememory(MC9S12DG128.RAM_START+6, b"".join(self.bootloader))
 
         pagenumbers = list(self.ChipPages.keys())  # are the keys
         for pageaddress in pagenumbers:
@@ -212,67 +339,89 @@ class MC9S12DG128(ChipInterface):
                         else:
                             sztowrite = dataleft
 
-                        log("Flashing %d Bytes, Address: %x "%(sztowrite,MC9S12DG128.ADDRESS_MAPPED_PAGE + memorystart + written), level=LOGL_VERBOSE,tag = self.NAME)
-                        self.writememory(MC9S12DG128.RAM_START+0x60,segment.data[written:written+sztowrite])
-
-                        fcondition = sztowrite.to_bytes(2,"big")
-                        self.usbdm.writeBdmWord(MC9S12DG128.RAM_START, MC9S12DG128.ADDRESS_MAPPED_PAGE + memorystart + written)
-                        self.usbdm.writeBdmWord(MC9S12DG128.RAM_START+2, fcondition)
-                        self.usbdm.writeBdmWord(MC9S12DG128.RAM_START+4, 0)
-
-                        log("Executing bootloader ", level=LOGL_VERBOSE,tag = self.NAME)
-                        self.usbdm.writeRegister(0x03, MC9S12DG128.RAM_START+6)   # set PC Counter
-                        self.usbdm.runTarget()               # execute boot loader
-                        timeout = time.time() * 1000  + 5000
-                        while True:
-                            if time.time()*1000<timeout:
-                                mem = self.usbdm.readBdmBlock(MC9S12DG128.RAM_START+4,2)
-                                #self.readmemory(0x4000, 50)
-                                if bytes(mem[1:]) == fcondition:
-                                    break
-                            else:
-                                raise ValueError("Error: flashing timed out")
-
-                        log("Halting bootloader ", level=LOGL_VERBOSE,tag = self.NAME)
-                        self.usbdm.haltTarget()
+                        log("Flashing %d Bytes, Address: %x ", level=LOGL_VERBOSE,tag = self.NAME, args=(sztowrite,MC9S12DG128.ADDRESS_MAPPED_PAGE + memorystart + written))
+                        with tracespan("chunk", address="%X"%(MC9S12DG128.ADDRESS_MAPPED_PAGE + memorystart + written), bytes=sztowrite):
+                            self.usbdm.beginBatch()
+                            self.writememory(MC9S12DG128.RAM_START+0x60,segment.data[written:written+sztowrite])
+
+                            fcondition = sztowrite.to_bytes(2,"big")
+                            self.usbdm.writeBdmWord(MC9S12DG128.RAM_START, MC9S12DG128.ADDRESS_MAPPED_PAGE + memorystart + written)
+                            self.usbdm.writeBdmWord(MC9S12DG128.RAM_START+2, fcondition)
+                            self.usbdm.writeBdmWord(MC9S12DG128.RAM_START+4, 0)
+
+                            log("Executing bootloader ", level=LOGL_VERBOSE,tag = self.NAME)
+                            self.usbdm.writeRegister(0x03, MC9S12DG128.RAM_START+6)   # set PC Counter
+                            self.usbdm.runTarget()               # execute boot loader
+                            self.usbdm.endBatch()
+                            self.waitforbootloader(sztowrite)
+                            mem = self.usbdm.readBdmBlock(MC9S12DG128.RAM_START+4,2)
+                            if bytes(mem[1:]) != fcondition:
+                                raise ValueError("Error: bootloader stopped before flashing was done")
                         written = written + sztowrite
                         dataleft = dataleft - sztowrite
 
+    # Erases the blocks holding image data, and the other blocks unless they are blank already
+    @traced("erase")
     def erase(self):
-        for pageaddress in self.ChipPages:
-            log("Erasing Page %X"%(pageaddress), level=LOGL_NORMAL,tag = self.NAME)
-            # Select Flash: 0 or 1
-            if pageaddress<0x3C:
-                self.usbdm.writeBdmByte(MC9S12DG128.REG_FCNFG, MC9S12DG128.BITS_CNFG_BLKSEL)
-            else:
-                self.usbdm.writeBdmByte(MC9S12DG128.REG_FCNFG,0x00)
-
-            self.usbdm.writeBdmByte(MC9S12DG128.REG_PAGE_MAP, pageaddress)
+        used, empty = self.blockplan()
+        for block in used + [block for block in empty if not self.isblank(block)]:
+            log("Erasing Pages %X-%X"%(min(block), max(block)), level=LOGL_NORMAL,tag = self.NAME)
+            self.usbdm.beginBatch()
+            self.selectpage(block[0])
             self.usbdm.writeBdmWord(MC9S12DG128.ADDRESS_MAPPED_PAGE, 0xFFFF) #
-            self.usbdm.writeBdmByte(MC9S12DG128.REG_FCMD, MC9S12DG128.CMD_ERASE_PAGE)
+            self.usbdm.writeBdmByte(MC9S12DG128.REG_FCMD, MC9S12DG128.CMD_ERASE_PAGE)     # erases the whole block
             self.usbdm.writeBdmByte(MC9S12DG128.REG_FSTAT, MC9S12DG128.BITS_FSTAT_CBEIF)
-            self.waitForFlash()
+            self.usbdm.endBatch()
+            self.waitForFlash("erasemass")
+
+    @traced("erase sector")
+    def erasesector(self, pageaddress, offset):
+        log("Erasing Sector %X:%04X"%(pageaddress, offset), level=LOGL_VERBOSE,tag = self.NAME)
+        self.usbdm.beginBatch()
+        self.selectpage(pageaddress)
+        self.usbdm.writeBdmWord(MC9S12DG128.ADDRESS_MAPPED_PAGE+offset, 0xFFFF)
+        self.usbdm.writeBdmByte(MC9S12DG128.REG_FCMD, MC9S12DG128.CMD_ERASE_SECTOR)
+        self.usbdm.writeBdmByte(MC9S12DG128.REG_FSTAT, MC9S12DG128.BITS_FSTAT_CBEIF)
+        self.usbdm.endBatch()
+        self.waitForFlash("erasesector")
+
+    # The blank command checks the whole block of the selected page
+    @traced("blank check block")
+    def isblank(self, block):
+        self.usbdm.beginBatch()
+        self.selectpage(block[0])
+        self.usbdm.writeBdmWord(MC9S12DG128.ADDRESS_MAPPED_PAGE, 0xFFFF) #
+        self.usbdm.writeBdmByte(MC9S12DG128.REG_FCMD, MC9S12DG128.CMD_BLANK)
+        self.usbdm.writeBdmByte(MC9S12DG128.REG_FSTAT, MC9S12DG128.BITS_FSTAT_CBEIF)
+        self.usbdm.endBatch()
 
+        readstatus = self.waitForFlash("blank")
+        return readstatus & MC9S12DG128.BITS_FSTAT_BLANK == MC9S12DG128.BITS_FSTAT_BLANK
 
+    @traced("blank check")
     def blankcheck(self):
         status = 0
         log("Blank check ",level=LOGL_VERBOSE,tag = self.NAME)
-        self.usbdm.writeBdmWord(MC9S12DG128.ADDRESS_MAPPED_PAGE, 0xFFFF) #
-        self.usbdm.writeBdmByte(MC9S12DG128.REG_FCMD, MC9S12DG128.CMD_BLANK)
-        self.usbdm.writeBdmByte(MC9S12DG128.REG_FSTAT, MC9S12DG128.BITS_FSTAT_CBEIF)
+        for block in MC9S12DG128.FLASH_BLOCKS:
+            if not self.isblank(block):
+                status = 1
 
-        readstatus = self.waitForFlash()
-        if readstatus & MC9S12DG128.BITS_FSTAT_BLANK == MC9S12DG128.BITS_FSTAT_BLANK:
+        if status == 0:
             log("Device is blank",level=LOGL_NORMAL,tag = self.NAME)
         else:
-            status = 1
             log("Device is not blank",level=LOGL_NORMAL,tag = self.NAME)
         return status
 
+    @traced("verify")
     def verify(self):
-       threads = []
-       errorQueue = Queue()
-       for pageaddress in list(self.ChipPages.keys()):
+       mismatches = []
+       # blank blocks without image data are not read
+       pages = self.verifypages()
+       # only the pages with a wrong checksum are read back, to locate the differences
+       if self.usecrcverify and self.crcloader != None:
+           pages = self.verifycrc(pages)
+
+       for pageaddress in pages:
            log("Verifying Page %X"%(pageaddress), level=LOGL_NORMAL,tag = self.NAME)
            # Select Flash: 0 or 1
            if pageaddress<0x3C:
@@ -281,57 +430,21 @@ class MC9S12DG128(ChipInterface):
                self.usbdm.writeBdmByte(MC9S12DG128.REG_FCNFG,0x00)
            self.usbdm.writeBdmByte(MC9S12DG128.REG_PAGE_MAP, pageaddress)
 
-           flashmemory = self.readmemory(MC9S12DG128.ADDRESS_MAPPED_PAGE, MC9S12DG128.PAGE_LENGTH)
-
-           # compare memory
-           thread = threading.Thread(target=comparepagetosegments, args=(self.memorypages[pageaddress],flashmemory,self.ChipPages[pageaddress][0],self.ChipPages[pageaddress][1],errorQueue,))
-           threads.append(thread)
-           thread.start()
-
-       # Wait for threads to finish
-       for t in threads:
-           t.join()
-
-       if not errorQueue.empty():
-           while not errorQueue.empty():
-               result = errorQueue.get()
-               log("Memory did not match at %10X expected: %2s read: %2s"%(result[0], result[1], result[2]),level=LOGL_VERBOSE,tag = self.NAME)
-
-           raise ValueError("Error: Contents don't match the file")
-       else:
-           log("Verified. Contents are good",level=LOGL_NORMAL,tag = self.NAME)
-
-    def waitForEEPROM(self):
-        timeout = time.time()*1000  + 5000 # 5 seconds
-        readstatus = 0x00
-        while True:
-            if time.time()*1000<timeout:
-                time.sleep(0.010)
-                readstatus = self.usbdm.readBdmByte(MC9S12DG128.REG_ESTAT)[1]
-                if readstatus & MC9S12DG128.BITS_ESTAT_ACCER == MC9S12DG128.BITS_ESTAT_ACCER:
-                    raise ValueError("Error: couldn't access EEPROM")
-                elif readstatus & MC9S12DG128.BITS_ESTAT_PVIOL == MC9S12DG128.BITS_ESTAT_PVIOL:
-                    raise ValueError("Error: protection violation EEPROM")
-                elif readstatus & MC9S12DG128.BITS_ESTAT_CCIF == MC9S12DG128.BITS_ESTAT_CCIF:
-                   break
-            else:
-                raise ValueError("Error: command timed out")
-        return readstatus
-
-
-    def waitForFlash(self):
-        timeout = time.time()*1000  + 5000 # 5 seconds
-        readstatus = 0x00
-        while True:
-            if time.time()*1000<timeout:
-                time.sleep(0.010)
-                readstatus = self.usbdm.readBdmByte(MC9S12DG128.REG_FSTAT)[1]
-                if readstatus & MC9S12DG128.BITS_FSTAT_ACCER == MC9S12DG128.BITS_FSTAT_ACCER:
-                    raise ValueError("Error: couldn't access flash")
-                elif readstatus & MC9S12DG128.BITS_FSTAT_PVIOL == MC9S12DG128.BITS_FSTAT_PVIOL:
-                    raise ValueError("Error: protection violation flash")
-                elif readstatus & MC9S12DG128.BITS_FSTAT_CCIF == MC9S12DG128.BITS_FSTAT_CCIF:
-                   break
-            else:
-                raise ValueError("Error: command timed out")
-        return readstatus
+           pagestart = self.ChipPages[pageaddress][0]
+           image = pageimage(self.memorypages[pageaddress], pagestart, MC9S12DG128.PAGE_LENGTH)
+           mismatches.extend(self.verifymemory(MC9S12DG128.ADDRESS_MAPPED_PAGE, image, pagestart, self.failfast))
+           if mismatches and self.failfast:
+               break
+
+       self.checkmismatches(mismatches)
+
+    def waitForEEPROM(self, kind="eepromerase"):
+        return self.waitforcommand(kind, MC9S12DG128.REG_ESTAT, MC9S12DG128.BITS_ESTAT_CCIF,
+                                   [(MC9S12DG128.BITS_ESTAT_ACCER, "Error: couldn't access EEPROM"),
+                                    (MC9S12DG128.BITS_ESTAT_PVIOL, "Error: protection violation EEPROM")])
+
+
+    def waitForFlash(self, kind="program"):
+        return self.waitforcommand(kind, MC9S12DG128.REG_FSTAT, MC9S12DG128.BITS_FSTAT_CCIF,
+                                   [(MC9S12DG128.BITS_FSTAT_ACCER, "Error: couldn't access flash"),
+                                    (MC9S12DG128.BITS_FSTAT_PVIOL, "Error: protection violation flash")])
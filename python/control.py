@@ -6,7 +6,9 @@
 from chips.mc9s12dg128 import MC9S12DG128
 from chips.mc9s12dj64 import MC9S12DJ64
 from chips.mc9s08dz128 import MC9S08DZ128
-from usbdm import Usbdm
+from usbdm import Usbdm, LibusbTransport, TracingTransport
+from simulator import SimulatedTransport
+from gang import gangprogram
 from helpers import *
 import sys
 
@@ -22,8 +24,22 @@ if __name__ == "__main__":
         chipHandle = None
         usbdmHandle = None
         filename = ""
+        base = None
         chipname = ""
         loglevel = LOGL_NORMAL
+        pingpong = False
+        simulate = False
+        cache = True
+        readback = False
+        failfast = False
+        differential = False
+        repair = True
+        tagaddress = None
+        tagcheck = False
+        gang = None
+        tracefile = None
+        ringsize = LOG_RING_SIZE
+        pipeline = None
         idx = 1
 
         try:
@@ -31,34 +47,114 @@ if __name__ == "__main__":
                 if sys.argv[idx] == "-file":
                     idx +=1
                     filename = sys.argv[idx]
+                elif sys.argv[idx] == "-base":
+                    idx +=1
+                    base = int(sys.argv[idx],16)
                 elif sys.argv[idx] == "-chip":
                     idx +=1
                     chipname = sys.argv[idx]
                 elif sys.argv[idx] == "-log":
                     idx +=1
                     loglevel = int(sys.argv[idx])
+                elif sys.argv[idx] == "-pingpong":
+                    pingpong = True
+                elif sys.argv[idx] == "-simulate":
+                    simulate = True
+                elif sys.argv[idx] == "-nocache":
+                    cache = False
+                elif sys.argv[idx] == "-readback":
+                    readback = True
+                elif sys.argv[idx] == "-failfast":
+                    failfast = True
+                elif sys.argv[idx] == "-differential":
+                    differential = True
+                elif sys.argv[idx] == "-norepair":
+                    repair = False
+                elif sys.argv[idx] == "-tag":
+                    idx +=1
+                    tagaddress = int(sys.argv[idx],16)
+                elif sys.argv[idx] == "-tagcheck":
+                    tagcheck = True
+                elif sys.argv[idx] == "-pipeline":
+                    idx +=1
+                    pipeline = int(sys.argv[idx])
+                elif sys.argv[idx] == "-logring":
+                    idx +=1
+                    ringsize = int(sys.argv[idx])
+                elif sys.argv[idx] == "-trace":
+                    idx +=1
+                    tracefile = sys.argv[idx]
+                elif sys.argv[idx] == "-gang":
+                    idx +=1
+                    gang = int(sys.argv[idx])
                 idx +=1
 
             setlogginglevel(loglevel)
-            usbdmHandle = Usbdm()
-            if chipname in chips.keys():
+            setlogring(ringsize)
+            if chipname not in chips.keys():
+                raise ValueError("Error: Chip not found")
+            elif gang != None:
+                # one worker per probe, fails if any of the slots failed
+                settings = {"usepingpong":pingpong, "usecrcverify":not readback, "failfast":failfast, "usedifferential":differential,
+                            "userepair":repair, "tagaddress":tagaddress, "tagcheck":tagcheck}
+                results = gangprogram(chips[chipname], filename, base, gang, settings, simulate)
+                if any(error != None for slot, probe, error, seconds in results):
+                    sys.exit(1)
+            else:
+                if simulate:
+                    transport = SimulatedTransport(chipname)
+                else:
+                    transport = LibusbTransport()
+                if tracefile != None:
+                    settracer(Tracer(transport.now if simulate else time.perf_counter))
+                    transport = TracingTransport(transport, gettracer())
+                usbdmHandle = Usbdm(transport)
+                if pipeline != None:
+                    usbdmHandle.pipelinedepth = max(pipeline, 1)
                 chipHandle = chips[chipname](usbdmHandle)
-                chipHandle.load(filename)
+                chipHandle.usepingpong = pingpong and chipHandle.pingpongloader != None
+                if not cache:
+                    chipHandle.imagecache = None
+                chipHandle.usecrcverify = not readback
+                chipHandle.failfast = failfast
+                chipHandle.usedifferential = differential
+                chipHandle.userepair = repair
+                chipHandle.tagaddress = tagaddress
+                chipHandle.tagcheck = tagcheck
+                chipHandle.load(filename, base)
                 chipHandle.program()
-            else:
-                raise ValueError("Error: Chip not found")
+                if simulate:
+                    usbdmHandle.transport.report()
         except Exception as e:
+            dumplog()
             log(e, level=LOGL_NORMAL)
             sys.exit(1)
+        finally:
+            if gettracer() != None:
+                gettracer().write(tracefile)
 
     else:
         print("Arguments:")
-        print("%-30s :%s"%("\t-file <>","load file to program .bin|.s19|.hex"))
+        print("%-30s :%s"%("\t-file <>","load file to program .bin|.s19|.hex, - reads s19 from stdin"))
+        print("%-30s :%s"%("\t-base <address>","linear start address of a .bin file (hex), default the lowest whole page"))
         print("%-30s :%s"%("\t-chip <chipname>","select chip to program"))
         print("%-30s :%s"%("\t-log <loglevel>","change logging level DEBUG(0) VERBOSE(1) NORMAL(2)"))
+        print("%-30s :%s"%("\t-pingpong","flash with the double buffered bootloader (HCS12)"))
+        print("%-30s :%s"%("\t-readback","verify by reading back the whole flash instead of the checksums (HCS12)"))
+        print("%-30s :%s"%("\t-failfast","stop verifying at the first mismatch"))
+        print("%-30s :%s"%("\t-differential","erase and program only the sectors that changed (HCS12)"))
+        print("%-30s :%s"%("\t-norepair","erase and program again instead of reprogramming the mismatching words"))
+        print("%-30s :%s"%("\t-tag <address>","program an image tag at the address (hex), skip programming if it matches"))
+        print("%-30s :%s"%("\t-tagcheck","confirm a matching image tag with the checksums (HCS12)"))
+        print("%-30s :%s"%("\t-simulate","run against the simulated probe and chip"))
+        print("%-30s :%s"%("\t-pipeline <depth>","frames sent before their status is read, default 1 on usb probes"))
+        print("%-30s :%s"%("\t-logring <count>","log records kept and printed after a failure, default %d, 0 disables"%LOG_RING_SIZE))
+        print("%-30s :%s"%("\t-trace <file>","write a Chrome trace json of the usb transactions and chip phases, see ui.perfetto.dev"))
+        print("%-30s :%s"%("\t-gang <count>","program with count probes at once, 0 uses every probe found"))
+        print("%-30s :%s"%("\t-nocache","parse the file again instead of using the prepared image in %s"%IMAGE_CACHE_DIR))
         print("Commands:")
         print("%-30s :%s"%("\tlog <loglevel>","change logging level DEBUG(0) VERBOSE(1) NORMAL(2)"))
-        print("%-30s :%s"%("\tload <file>","load file to program .bin|.s19|.hex"))
+        print("%-30s :%s"%("\tload <file> [base]","load file to program .bin|.s19|.hex, base of a .bin in hex"))
         print("%-30s :%s"%("\topen <chip name>","open specific chip"))
         print("%-30s :%s"%("\thalt","halt processor"))
         print("%-30s :%s"%("\tauto","auto identification of the connected chip"))
@@ -67,6 +163,13 @@ if __name__ == "__main__":
         print("%-30s :%s"%("\tconnect","connect to chip"))
         print("%-30s :%s"%("\tdisconnect","disconnect from chip"))
         print("%-30s :%s"%("\tprogram","program chip with loaded binary"))
+        print("%-30s :%s"%("\tpingpong <0|1>","disable/enable the double buffered bootloader (HCS12)"))
+        print("%-30s :%s"%("\tcrcverify <0|1>","disable/enable the checksum verify (HCS12)"))
+        print("%-30s :%s"%("\tfailfast <0|1>","disable/enable stopping the verify at the first mismatch"))
+        print("%-30s :%s"%("\tdifferential <0|1>","disable/enable programming only the changed sectors (HCS12)"))
+        print("%-30s :%s"%("\trepair <0|1>","disable/enable reprogramming the mismatching words after a failed verify"))
+        print("%-30s :%s"%("\tcache [0|1]","disable/enable caching the memory read while the target is halted, report without argument"))
+        print("%-30s :%s"%("\ttag <address|off>","image tag address (hex) for the next load"))
         print("%-30s :%s"%("\tsetup","setup PLL and registers"))
         print("%-30s :%s"%("\tverify","compare programmed flash against the loaded binary"))
         print("%-30s :%s"%("\tread <address> <size>","read memory at address"))
@@ -126,20 +229,39 @@ if __name__ == "__main__":
                     elif cmds[0] == "unsecure":
                         chipHandle.unsecure()
                     elif cmds[0] == "load":
-                        if len(cmds)>1:
+                        if len(cmds)>2:
+                            chipHandle.load(cmds[1], int(cmds[2],16))
+                        elif len(cmds)>1:
                             chipHandle.load(cmds[1])
                         else:
                             log("Error: no file specified",level=LOGL_NORMAL)
 
                     elif cmds[0] == "program":
                         chipHandle.program()
+                    elif cmds[0] == "pingpong" and len(cmds) == 2:
+                        chipHandle.usepingpong = int(cmds[1]) != 0 and chipHandle.pingpongloader != None
+                    elif cmds[0] == "crcverify" and len(cmds) == 2:
+                        chipHandle.usecrcverify = int(cmds[1]) != 0
+                    elif cmds[0] == "failfast" and len(cmds) == 2:
+                        chipHandle.failfast = int(cmds[1]) != 0
+                    elif cmds[0] == "differential" and len(cmds) == 2:
+                        chipHandle.usedifferential = int(cmds[1]) != 0
+                    elif cmds[0] == "repair" and len(cmds) == 2:
+                        chipHandle.userepair = int(cmds[1]) != 0
+                    elif cmds[0] == "cache" and len(cmds) == 2:
+                        chipHandle.setmemorycache(int(cmds[1]) != 0)
+                    elif cmds[0] == "cache":
+                        cache = chipHandle.usbdm.memorycache
+                        log(cache.report() if cache != None else "Memory cache disabled", level=LOGL_NORMAL, tag=chipHandle.NAME)
+                    elif cmds[0] == "tag" and len(cmds) == 2:
+                        chipHandle.tagaddress = None if cmds[1] == "off" else int(cmds[1],16)
                     elif cmds[0] == "setup":
                         chipHandle.setup()
                     elif cmds[0] == "erase":
                         chipHandle.erase()
                     # Note can only verify if the chip is not secured
                     elif cmds[0] == "verify":
-                        chipHandle.verify()
+                        chipHandle.verifyimage()
                     elif cmds[0] == "reset":
                         chipHandle.reset()
                     elif cmds[0] == "reattach":
@@ -162,4 +284,5 @@ if __name__ == "__main__":
                         chipHandle.writememory(int(cmds[1],16), bytes.fromhex(cmds[2]))
 
             except Exception as e:
+                dumplog()
                 log(e, level=LOGL_NORMAL)
@@ -0,0 +1,84 @@
+# description: gang programming of one image with several probes: gangprogram(MC9S12DJ64, "image.s19", None, 0, {})
+#              Every probe is driven by its own worker process with its own Usbdm and chip.
+#              The image is parsed once and shared with the workers through a shared memory block
+
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from usbdm import Usbdm, LibusbTransport, findprobes
+from helpers import *
+
+
+# Program the board of one probe with the image in the shared memory block
+# Returns [slot, probe, error or None, seconds]
+def programslot(slot, probe, chipclass, imagename, settings, loglevel, ringsize):
+    setlogginglevel(loglevel)
+    setlogring(ringsize)
+    image = shared_memory.SharedMemory(name=imagename)
+    try:
+        return programboard(slot, probe, chipclass, image.buf, settings)
+    finally:
+        image.close()
+
+# The segments are views of content, nothing refers to them when this returns
+def programboard(slot, probe, chipclass, content, settings):
+    start = time.time()
+    tag = "SLOT%d"%slot
+    error = None
+    try:
+        log("Programming with probe %s"%("simulated" if probe == None else "%d:%d"%tuple(probe)), level=LOGL_NORMAL, tag=tag)
+        if probe == None:
+            from simulator import SimulatedTransport
+            transport = SimulatedTransport(chipclass.NAME)
+        else:
+            transport = LibusbTransport(bus=probe[0], address=probe[1])
+        chip = chipclass(Usbdm(transport))
+        for name, value in settings.items():
+            setattr(chip, name, value)
+        chip.usepingpong = chip.usepingpong and chip.pingpongloader != None
+        chip.memory, chip.memorypages = unpackimage(content, chip.ChipPages)
+        chip.makeimagetag()
+        chip.program()
+        if probe == None:
+            transport.report()
+    except Exception as e:
+        error = str(e)
+        dumplog()
+        log(e, level=LOGL_NORMAL, tag=tag)
+    return [slot, probe, error, time.time()-start]
+
+# Program the image with slots probes at once, 0 uses every probe found
+# settings are chip attributes, e.g. {"usecrcverify":False}. Simulated probes need a slot count
+# Returns the [slot, probe, error or None, seconds] of the slots
+def gangprogram(chipclass, fname, base, slots, settings, simulate=False):
+    start = time.time()
+    if simulate:
+        if slots <= 0:
+            raise ValueError("Error: the number of simulated probes is missing")
+        probes = [None]*slots
+    else:
+        probes = findprobes()
+        if slots > 0:
+            probes = probes[:slots]
+    if not probes:
+        raise ValueError("Error: Device not found")
+
+    log("Loading file %s"%fname,level=LOGL_NORMAL,tag = "GANG")
+    memory = loadprogramfile(fname, chipclass.PAGES, base)
+    content = packimage(pageassignments(memory, chipclass.PAGES))
+
+    image = shared_memory.SharedMemory(create=True, size=len(content))
+    try:
+        image.buf[:len(content)] = content
+        # spawned workers, libusb isn't fork safe
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(len(probes)) as pool:
+            results = pool.starmap(programslot, [(slot, probe, chipclass, image.name, settings, getlogginglevel(), getlogringsize()) for slot, probe in enumerate(probes)])
+    finally:
+        image.close()
+        image.unlink()
+
+    for slot, probe, error, seconds in results:
+        log("Slot %d %s: %s, %.1f s"%(slot, "simulated" if probe == None else "%d:%d"%tuple(probe), error or "ok", seconds), level=LOGL_NORMAL, tag="GANG")
+    log("time: %s s"%str(time.time()-start), level=LOGL_NORMAL, tag="GANG")
+    return results
@@ -1,5 +1,22 @@
+import os
+import sys
 import time
+import struct
+import hashlib
 import threading
+import re
+import bisect
+import binascii
+import json
+import functools
+import contextlib
+import collections
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #levels
 LOGL_DEBUG = 0
@@ -10,17 +27,26 @@ LOGL_INF = 99
 #parameters
 loglevel = LOGL_DEBUG
 
+# Segments hold their bytes in a bytearray, so appending a record is amortized O(1)
+# A memoryview is kept as it is, e.g. the segments of an image in shared memory. It is copied
+# into a bytearray before the segment is changed
 class Segment:
-    def __init__(self,address):
+    def __init__(self,address,data=b""):
         self.address = address
-        self.data = b""
+        self.data = data if isinstance(data, memoryview) else bytearray(data)
+
+    def writable(self):
+        if isinstance(self.data, memoryview):
+            self.data = bytearray(self.data)
+        return self.data
 
     def append(self, data):
+        self.writable()
         self.data += data
 
     def truncate(self):
-        data = self.data[0]
-        self.data = self.data[1:]
+        data = self.writable()[0]
+        del self.data[0]
         self.address +=1
         return data
 
@@ -31,30 +57,57 @@ class Segment:
         return self.address +len(self.data)-1
 
     def prepend(self,data):
-        self.data[:0] = data
+        self.writable()[:0] = data
 
     def newsegment(self,address):
         return self.getsegmentend()+1 != address
 
+# The segments are kept sorted by address, starts indexes them for bisect
+# Data overlapping a segment overwrites it, touching segments are merged
 class Memory:
     def __init__(self):
         self.segments=[]
+        self.starts=[]
         self.currentseg= None
+        self.currentidx = 0
 
     def adddata(self, data, address):
         if self.currentseg == None or self.currentseg.newsegment(address):
-            # try to find a segment to continue
-            self.currentseg = None
-            for segment in self.segments:
-                if segment.getsegmentend()+1 == address:
-                    self.currentseg = segment
-
-            # if no segment has been found to continue
-            if self.currentseg == None:
+            idx = bisect.bisect_right(self.starts, address)-1
+            if idx >= 0 and self.segments[idx].getsegmentend()+1 >= address:
+                # continue or overwrite a segment
+                self.currentidx = idx
+                self.currentseg = self.segments[idx]
+            else:
+                self.currentidx = idx+1
                 self.currentseg = Segment(address)
-                self.segments.append(self.currentseg)
+                self.segments.insert(self.currentidx, self.currentseg)
+                self.starts.insert(self.currentidx, address)
+
+        segment = self.currentseg
+        offset = address-segment.address
+        if offset == len(segment.data):
+            segment.append(data)
+        else:
+            segment.writable()[offset:offset+len(data)] = data
+        self.merge(self.currentidx)
+
+    # merge the following segments reached by the segment at idx
+    def merge(self, idx):
+        segment = self.segments[idx]
+        while idx+1 < len(self.segments) and self.segments[idx+1].address <= segment.getsegmentend()+1:
+            nextsegment = self.segments.pop(idx+1)
+            del self.starts[idx+1]
+            overlap = segment.getsegmentend()+1-nextsegment.address
+            segment.append(nextsegment.data[overlap:])
+
+    # segment containing the address or None
+    def findsegment(self, address):
+        idx = bisect.bisect_right(self.starts, address)-1
+        if idx >= 0 and address <= self.segments[idx].getsegmentend():
+            return self.segments[idx]
+        return None
 
-        self.currentseg.append(data)
     def gettotalbytes(self):
         total = 0
         for s in self.segments:
@@ -65,38 +118,48 @@ class Memory:
     # this function realigns segments and their length on the 2 byte boundary
     # even though depending on the page size, these can be cut again, generally only words can be written into D-Flash
     def align(self):
-        self.sortsegments()
-        previous = None
-        length = len(self.segments)
-        for idx in range(length):
+        idx = 0
+        while idx < len(self.segments):
             segment = self.segments[idx]
             if segment.address%2!= 0:
                 segment.address -=1
                 segment.prepend(b"\xFF")
+                self.starts[idx] = segment.address
 
             if segment.getsegmentend()%2 == 0:
-                if (idx+1)<length:
+                if (idx+1)<len(self.segments) and self.segments[idx+1].address == segment.getsegmentend()+1:
                     nextsegment = self.segments[idx+1]
-                    if nextsegment.address  == segment.getsegmentend()+1:
-                        segment.append([nextsegment.truncate()])
-                    else:
-                        segment.append(b"\xFF")
+                    segment.append(bytes([nextsegment.truncate()]))
+                    self.starts[idx+1] = nextsegment.address
+                    if nextsegment.getlength() == 0:
+                        del self.segments[idx+1]
+                        del self.starts[idx+1]
                 else:
                     segment.append(b"\xFF")
-            previous = segment
-
+            if idx > 0 and self.segments[idx-1].getsegmentend()+1 >= segment.address:
+                # the end of the merged segment is aligned again
+                idx -= 1
+                self.merge(idx)
+                continue
+            idx += 1
+        self.currentseg = None
+
+    # cut the segment at idx after endaddress, the rest becomes a new segment behind it
     def splitsegment(self,idx,endaddress):
         segment = self.segments[idx]
-        restofdata = segment.data[endaddress-segment.address:]
-        segment.data = segment.data[:endaddress-segment.address]
+        newsegment = Segment(endaddress+1, bytes(segment.data[endaddress+1-segment.address:]))
+        del segment.writable()[endaddress+1-segment.address:]
 
-        newsegment = Segment(endaddress+1)
-        newsegment.data = restofdata
+        self.segments.insert(idx+1, newsegment)
+        self.starts.insert(idx+1, newsegment.address)
+        self.currentseg = None
+        return segment
 
     def sortsegments(self):
         def sortcondition(elem):
             return elem.address
         self.segments.sort(key=sortcondition)
+        self.starts = [segment.address for segment in self.segments]
 
     def printmemory(self):
         for s in self.segments:
@@ -113,161 +176,484 @@ class Memory:
         log("Aligned Image: %d Bytes %d Segments"%(self.gettotalbytes(),len(self.segments)),level=LOGL_VERBOSE)
 
 
-def comparepagetosegments(segmentlist,pagememory,startaddress,endaddress,errorQueue):
-    previousstart = 0
-
-    try:
-        for segment in segmentlist:
-            start = segment.address-startaddress
-            end = start+segment.getlength()
-
-            # Check ff's
-            while previousstart != start:
-                if pagememory[previousstart:previousstart+2] != b"\xff\xff":
-                    errorQueue.put((previousstart,  b"\xff\xff",pagememory[previousstart:previousstart+2]))
-                previousstart +=2;
-
-            # Check data
-            while previousstart != end:
-                if pagememory[previousstart:previousstart+2] != segment.data[previousstart-start:previousstart-start+2]:
-                    errorQueue.put((segment.address+previousstart, segment.data[previousstart-start:previousstart-start+2],pagememory[previousstart:previousstart+2]))
-                previousstart +=2;
-
-
-
-        # Check ff's
-        end = len(pagememory)
-        while previousstart < end:
-            if pagememory[previousstart:previousstart+2] != b"\xff\xff":
-                errorQueue.put((previousstart,  b"\xff\xff",pagememory[previousstart:previousstart+2]))
-            previousstart +=2;
-        ''''''
-    except Exception as e:
-        log(e)
-
-
-def comparememorytosegment(segment, pagememory, errorQueue):
-    checked = 0
-    end = segment.getlength()
-    while checked != end:
-        if pagememory[checked:checked+2] != segment.data[checked:checked+2]:
-            errorQueue.put((segment.address+checked, segment.data[checked:checked+2],pagememory[checked:checked+2]))
-        checked +=2;
+# Page contents the segments of a page program, erased bytes in between
+def pageimage(segmentlist, startaddress, length):
+    image = bytearray(b"\xff"*length)
+    for segment in segmentlist:
+        start = segment.address-startaddress
+        image[start:start+segment.getlength()] = segment.data
+    return image
+
+# CRC-16 CCITT lookup table for the crc loaders: 256 high bytes, then 256 low bytes
+def crc16table():
+    table = [binascii.crc_hqx(bytes([idx]), 0) for idx in range(256)]
+    return bytes(value>>8 for value in table) + bytes(value&0xFF for value in table)
+
+# Compare engine: whole regions are compared at once, only regions that differ are narrowed
+# down to the mismatching ranges, with numpy if it is installed
+DIFFERENT_BYTES = re.compile(rb"[^\x00]+")
+
+# Ranges [offset, length] where read differs from expected
+def differences(read, expected):
+    if numpy != None:
+        differing = numpy.flatnonzero(numpy.frombuffer(read, numpy.uint8) != numpy.frombuffer(expected, numpy.uint8))
+        if len(differing) == 0:
+            return []
+        breaks = numpy.flatnonzero(numpy.diff(differing) != 1)
+        starts = [int(differing[0])] + differing[breaks+1].tolist()
+        ends = differing[breaks].tolist() + [int(differing[-1])]
+        return [[start, end-start+1] for start, end in zip(starts, ends)]
+
+    # the xor of both regions is zero where they match
+    difference = (int.from_bytes(read, "big") ^ int.from_bytes(expected, "big")).to_bytes(len(read), "big")
+    matches = DIFFERENT_BYTES.finditer(difference)
+    return [[match.start(), match.end()-match.start()] for match in matches]
+
+# [address, expected, read] of the mismatching ranges, touching ranges are joined
+# The ranges are added to mismatches, if given
+def mismatchranges(ranges, data, startaddress, expected, mismatches=None):
+    if mismatches is None:
+        mismatches = []
+    for offset, length in ranges:
+        if mismatches and mismatches[-1][0]+len(mismatches[-1][2]) == startaddress+offset:
+            mismatches[-1][1] += expected(offset, length)
+            mismatches[-1][2] += data[offset:offset+length]
+        else:
+            mismatches.append([startaddress+offset, expected(offset, length), data[offset:offset+length]])
+    return mismatches
+
+# Compare memory read at address against the expected bytes
+def comparememory(memory, expected, address, mismatches=None):
+    # the read data is only copied if it differs, it may be a reused buffer
+    if memory == expected:
+        return [] if mismatches is None else mismatches
+    data = bytes(memory)
+    return mismatchranges(differences(data, expected), data, address,
+                          lambda offset, length: bytes(expected[offset:offset+length]), mismatches)
 
 # logger
-def log(data, level=0, debugline="",conv="",tag=""):
-    if loglevel<=level:
-        if conv == "hex":
-            if type(data) is int:
-                print("log(%d):%s#%s%s"%(level, tag, debugline, hex(data)))
-            else:
-                print("log(%d):%s#%s%s"%(level, tag, debugline, ''.join('{:02x}'.format(x) for x in data)))
-
-        elif conv == "mem":
-            address = data[0]
+# data may be a callable, it is only called if the record is printed. args are formatted into data
+# the same way, log("Writing %X", args=(address,)) costs no formatting below the logging level
+# The log ring keeps the last records of every level, dumplog() prints them after a failure
+LOG_RING_SIZE = 256
+LOG_RING_BYTES = 32             # bytes of a buffer kept by the ring
+logring = None
+
+def log(data, level=0, debugline="",conv="",tag="", args=None):
+    if logring != None:
+        # the callers reuse their buffers, the ring keeps a copy of the first LOG_RING_BYTES bytes
+        if conv == "mem":
             memory = data[1]
-            length = len(memory)
-            tidx = 0
-            while tidx != length:
-                idx = 0
-                print("log(%d):%s#%s%08X\t  "%(level,tag, debugline, address),end="")
-                while idx <16 and  idx + tidx < length:
-                    if type(memory[idx+tidx]) is int:
-                        print("%02X "%(memory[idx+tidx]),end="")
-                    else:
-                        print("%02X "%(int.from_bytes(memory[idx+tidx],byteorder="big")),end="")
-                    idx = idx + 1
-                print("")
-                address = address + idx
-                tidx = tidx + idx
-
+            if not isinstance(memory, bytes):
+                logring.append((level, tag, debugline, (data[0], ringcopy(memory)), conv, args, len(memory)))
+            else:
+                logring.append((level, tag, debugline, data, conv, args, len(memory)))
+        elif isinstance(data, (bytearray, memoryview, array)):
+            logring.append((level, tag, debugline, ringcopy(data), conv, args, len(data)))
         else:
-            print("log(%d):%s#%s%s"%(level, tag,debugline,str(data)))
+            logring.append((level, tag, debugline, data, conv, args, 0))
+    if loglevel<=level:
+        sys.stdout.write(formatlog(data, level, debugline, conv, tag, args))
+
+def ringcopy(memory):
+    return bytes(memory) if len(memory) <= LOG_RING_BYTES else bytes(memory[:LOG_RING_BYTES])
+
+def formatlog(data, level, debugline, conv, tag, args):
+    if callable(data):
+        data = data()
+    if args != None:
+        data = data%args
+    if conv == "hex":
+        if type(data) is int:
+            return "log(%d):%s#%s%s\n"%(level, tag, debugline, hex(data))
+        else:
+            return "log(%d):%s#%s%s\n"%(level, tag, debugline, ''.join('{:02x}'.format(x) for x in data))
+
+    elif conv == "mem":
+        # 16 bytes per line, one write for all of them
+        address = data[0]
+        memory = data[1]
+        lines = []
+        for tidx in range(0, len(memory), 16):
+            row = memory[tidx:tidx+16]
+            if len(row) and type(row[0]) is not int:
+                row = [int.from_bytes(value, byteorder="big") for value in row]
+            lines.append("log(%d):%s#%s%08X\t  %s\n"%(level, tag, debugline, address+tidx, "".join("%02X "%value for value in row)))
+        return "".join(lines)
+
+    else:
+        return "log(%d):%s#%s%s\n"%(level, tag,debugline,str(data))
+
+# Keep the last size records for dumplog(), 0 disables the ring
+def setlogring(size):
+    global logring
+    logring = collections.deque(maxlen=size) if size > 0 else None
+
+def getlogringsize():
+    return logring.maxlen if logring != None else 0
+
+# Print the records of the ring, whatever their level, and empty it
+def dumplog():
+    if not logring:
+        return
+    lines = ["log ring: last %d records\n"%len(logring)]
+    for level, tag, debugline, data, conv, args, size in logring:
+        if size > LOG_RING_BYTES:
+            debugline = "%s(first %d of %d bytes)"%(debugline, LOG_RING_BYTES, size)
+            if conv == "mem":
+                data = (data[0], data[1][:LOG_RING_BYTES])
+        try:
+            lines.append(formatlog(data, level, debugline, conv, tag, args))
+        except Exception as e:
+            lines.append("log(%d):%s#%s<%s>\n"%(level, tag, debugline, e))
+    logring.clear()
+    sys.stdout.write("".join(lines))
+    sys.stdout.flush()
 
 def setlogginglevel(level):
     global loglevel
     loglevel = level
 
-def gets19data(record, realchecksum):
-    checksum = 0
-    idx = 0
-    length = len(record)
-    data = b""
-    while idx<length:
-        bval = int(record[idx:idx+2],16)&0x000000FF
-        checksum += bval
-        data += bval.to_bytes(1,"big")
-        idx +=  2
-
-    checksum = ((~checksum) &0x000000FF)
-    if checksum != realchecksum:
+def getlogginglevel():
+    return loglevel
+
+# tracer, events in the Chrome trace format for chrome://tracing and Perfetto
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+tracer = None
+
+class Tracer():
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock                  # seconds, the simulator passes its virtual clock
+        self.start = clock()
+        self.events = []
+
+    # microseconds since the start of the trace
+    def now(self):
+        return (self.clock()-self.start)*1000000
+
+    def complete(self, name, category, start, end, args=None):
+        event = {"name":name, "cat":category, "ph":"X", "ts":start, "dur":end-start, "pid":os.getpid(), "tid":threading.get_ident()}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category="chip", **args):
+        start = self.now()
+        try:
+            yield args                      # the spanned code may add arguments
+        finally:
+            self.complete(name, category, start, self.now(), args)
+
+    def write(self, filename):
+        with open(filename, "w") as fout:
+            json.dump({"traceEvents":self.events, "displayTimeUnit":"ms"}, fout)
+        log("%d trace events written to %s"%(len(self.events), filename), level=LOGL_NORMAL, tag="TRACE")
+
+def settracer(newtracer):
+    global tracer
+    tracer = newtracer
+
+def gettracer():
+    return tracer
+
+# with tracespan("erase"): ..., nothing is recorded without a tracer
+def tracespan(name, category="chip", **args):
+    if tracer == None:
+        return contextlib.nullcontext(args)
+    return tracer.span(name, category, **args)
+
+# Method decorator, the calls are spans of the trace
+def traced(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer == None:
+                return function(*args, **kwargs)
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Target memory read while the target is halted, in blocks of BLOCK_SIZE bytes aligned to BLOCK_SIZE
+# The least recently used block is dropped when the cache is full
+# Volatile ranges ([first, last] address) are never cached, a write to them flushes the whole cache:
+# register writes start flash commands and change the page mapping
+class MemoryCache():
+    BLOCK_SIZE = 0x90
+    MAX_BLOCKS = 512
+    def __init__(self, volatile, maxblocks=MAX_BLOCKS):
+        self.volatile = volatile            # [[first, last], ...]
+        self.maxblocks = maxblocks
+        self.blocks = collections.OrderedDict()     # block address -> bytes
+        self.suspended = False              # the target runs, nothing is cached
+        self.hits = 0
+        self.misses = 0
+
+    def isvolatile(self, address, size):
+        for first, last in self.volatile:
+            if address <= last and address+size > first:
+                return True
+        return False
+
+    def get(self, address):
+        block = self.blocks.get(address)
+        if block != None:
+            self.blocks.move_to_end(address)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return block
+
+    def put(self, address, block):
+        if self.suspended:
+            return
+        self.blocks[address] = bytes(block)
+        self.blocks.move_to_end(address)
+        if len(self.blocks) > self.maxblocks:
+            self.blocks.popitem(last=False)
+
+    # Drop the blocks a write to address touched
+    def invalidate(self, address, size):
+        if self.isvolatile(address, size):
+            self.blocks.clear()
+            return
+        first = address-address%self.BLOCK_SIZE
+        for block in range(first, address+size, self.BLOCK_SIZE):
+            self.blocks.pop(block, None)
+
+    def flush(self):
+        self.blocks.clear()
+
+    def report(self):
+        return "%d blocks cached, %d hits, %d misses"%(len(self.blocks), self.hits, self.misses)
+
+# https://en.wikipedia.org/wiki/SREC_(file_format)
+# address bytes of the record types, S4 is reserved
+S19_ADDRESSBYTES = {b"S0":2, b"S1":2, b"S2":3, b"S3":4, b"S5":2, b"S6":3, b"S7":4, b"S8":3, b"S9":2}
+
+# Decode one record into (type, address, data)
+def gets19record(line):
+    recordfield = line[0:2]
+    if recordfield not in S19_ADDRESSBYTES:
+        raise ValueError('Error: S19 bad format')
+    try:
+        record = binascii.unhexlify(line[2:])
+    except (binascii.Error, ValueError):
+        raise ValueError('Error: S19 bad format')
+
+    addressbytes = S19_ADDRESSBYTES[recordfield]
+    if len(record) == 0 or record[0] != len(record)-1 or record[0] < addressbytes+1:
+        raise ValueError("Error: S19 wrong record length")
+    # count, address, data and checksum add up to 0xFF
+    if sum(record)&0xFF != 0xFF:
         raise ValueError("Error: S19 wrong checksum")
-    return data[1:]
+    return recordfield, int.from_bytes(record[1:1+addressbytes], "big"), record[1+addressbytes:-1]
+
+# Feed the records of a binary file object (or mmap) into memory, line by line
+def reads19(fin, memory):
+    flagstart = 0
+    for line in iter(fin.readline, b""):
+        line = line.strip()
+        if len(line) == 0 or line[0:2] == b"S4":
+            continue
+
+        recordfield, address, data = gets19record(line)
+        # Header
+        if recordfield == b"S0":
+            flagstart = 1
+            log("S19 starting record: %s" %data, level=LOGL_VERBOSE)
+        # 16, 24 and 32-bit address data. Counts and terminations are not needed
+        elif flagstart == 1 and recordfield in (b"S1", b"S2", b"S3"):
+            memory.adddata(data, address)
+    return memory
+
+# https://en.wikipedia.org/wiki/Intel_HEX
+# Feed the data records (00) of an intel hex file into memory, 02 and 04 set the upper address bits
+def readhex(fin, memory):
+    upper = 0
+    for line in iter(fin.readline, b""):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if line[0:1] != b":":
+            raise ValueError('Error: HEX bad format')
+        try:
+            record = binascii.unhexlify(line[1:])
+        except (binascii.Error, ValueError):
+            raise ValueError('Error: HEX bad format')
+
+        # count, address, type, data, checksum
+        if len(record) < 5 or record[0] != len(record)-5:
+            raise ValueError("Error: HEX wrong record length")
+        if sum(record)&0xFF != 0:
+            raise ValueError("Error: HEX wrong checksum")
+
+        recordtype = record[3]
+        data = record[4:-1]
+        if recordtype == 0x00:
+            memory.adddata(data, upper+int.from_bytes(record[1:3], "big"))
+        elif recordtype == 0x01:
+            break
+        elif recordtype == 0x02:
+            upper = int.from_bytes(data, "big")<<4
+        elif recordtype == 0x04:
+            upper = int.from_bytes(data, "big")<<16
+        # 03 and 05 are start addresses, not needed
+    return memory
 
-def loadprogramfile(fname):
+BIN_PAGE_SIZE = 0x4000
+# data runs of a raw image, erased gaps of 32 bytes and more split them
+BIN_DATA = re.compile(rb"[^\xff](?:[^\xff]|\xff{1,31}(?=[^\xff]))*")
+
+# Pages a raw image can be placed in: their window is a whole page, starting on a page boundary
+def binpages(pages):
+    return [ppage for ppage, window in pages.items() if window[0]%BIN_PAGE_SIZE == 0 and window[1]-window[0]+1 == BIN_PAGE_SIZE]
+
+# Place a raw image starting at the linear address base (ppage*BIN_PAGE_SIZE+offset) into the
+# windows of the pages {ppage:[start, end]}. Erased gaps are left out, like the gaps of an s19 image
+def readbin(fin, memory, pages, base):
+    placeable = binpages(pages)
+    linear = base
+    while True:
+        offset = linear%BIN_PAGE_SIZE
+        chunk = fin.read(BIN_PAGE_SIZE-offset)
+        if len(chunk) == 0:
+            break
+        ppage = linear//BIN_PAGE_SIZE
+        for match in BIN_DATA.finditer(chunk):
+            if ppage not in pages:
+                raise ValueError("Error: bin data at %X is outside of the flash pages"%(linear+match.start()))
+            if ppage not in placeable:
+                raise ValueError("Error: bin data at %X is in page %X, its window %X-%X isn't a whole page"%(linear+match.start(), ppage, pages[ppage][0], pages[ppage][1]))
+            memory.adddata(match.group(), pages[ppage][0]+offset+match.start())
+        linear += len(chunk)
+    return memory
+
+# fname "-" reads an s19 image from stdin
+# bin images need the pages of the chip, base defaults to the start of the lowest page that takes them
+def loadprogramfile(fname, pages=None, base=None):
     memory = None
     format = fname.split(".")
     format = format[len(format)-1]
 
-    # https://en.wikipedia.org/wiki/SREC_(file_format)
-    if format == "s19":
-        flagstart = 0
+    if fname == "-":
+        memory = reads19(sys.stdin.buffer, Memory())
+    elif format == "s19":
         with open(fname, "rb") as fin:
-            lines = fin.readlines()
-            memory = Memory()
-            for line in lines:
-                line = line.strip()
-                recordfield = line[0:2]
-                recordlength= int(line[2:4],16) &0x00000000FF
-                readlength = int((len(line)-4)/2)
-
-                if(readlength!= recordlength or recordlength <4):
-                    raise ValueError("Error: S19 wrong record length")
-
-                record = line[2:len(line)-2]
-                checksum = line[len(line)-2:]
-                datarecord = gets19data(record,int(checksum,16) &0x0000FFFF)
-
-                # Header
-                if recordfield == b"S0":
-                    flagstart = 1
-                    log("S19 starting record: %s" %record, level=LOGL_VERBOSE)
-                elif flagstart == 1:
-                    # 16-bit address data
-                    if recordfield == b"S1":
-                        memory.adddata(datarecord[2:], int.from_bytes(datarecord[0:2],byteorder="big", signed=False))
-                    # 24-bit address data
-                    elif recordfield == b"S2":
-                        memory.adddata(datarecord[3:], int.from_bytes(datarecord[0:3], byteorder="big",signed=False))
-                    # 32-bit address data
-                    elif recordfield == b"S3":
-                        memory.adddata(datarecord[4:], int.from_bytes(datarecord[0:4],byteorder="big", signed=False))
-                    # reserved
-                    elif recordfield == b"S4":
-                        pass
-                    # 16-bit count
-                    elif recordfield == b"S5":
-                        pass
-                    # 24-bit count
-                    elif recordfield == b"S6":
-                        pass
-                    # 32-bit address termination
-                    elif recordfield == b"S7":
-                        pass
-                    # 24-bit address termination
-                    elif recordfield == b"S8":
-                        pass
-                    # 16-bit address termination
-                    elif recordfield == b"S9":
-                        pass
-                    else:
-                        raise ValueError('Error: S19 bad format')
-            memory.printmemory()
-            memory.alignmemory()
-            memory.printsegments()
-
+            memory = reads19(fin, Memory())
     elif format == "hex":
-         raise ValueError('Error: hex not implemented')
+        with open(fname, "rb") as fin:
+            memory = readhex(fin, Memory())
     elif format == "bin":
-         raise ValueError('Error: bin not implemented')     # can only split into correct segments, when the page size is known
+        if not pages:
+            raise ValueError('Error: bin needs the pages of the chip')
+        if base == None:
+            if not binpages(pages):
+                raise ValueError("Error: no page of the chip is a whole page, bin needs a base")
+            base = min(binpages(pages))*BIN_PAGE_SIZE
+        with open(fname, "rb") as fin:
+            memory = readbin(fin, Memory(), pages, base)
+
+    if memory != None:
+        memory.printmemory()
+        memory.alignmemory()
+        memory.printsegments()
     return memory
+
+# Prepared page layouts of loaded images, keyed by the file content, the chip and the loader version
+IMAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "usbdm")
+IMAGE_CACHE_MAGIC = b"USBDMIMG"
+IMAGE_CACHE_VERSION = 2        # bump when the loaders or the page assignment change
+IMAGE_CACHE_HEADER = struct.Struct("<8sII")       # magic, version, segments
+IMAGE_CACHE_SEGMENT = struct.Struct("<III")       # page, address, length
+
+def imagecachename(directory, fname, chipname, base):
+    digest = hashlib.sha256()
+    with open(fname, "rb") as fin:
+        for chunk in iter(lambda: fin.read(0x100000), b""):
+            digest.update(chunk)
+    digest.update(("%s %s %d"%(chipname, base, IMAGE_CACHE_VERSION)).encode())
+    return os.path.join(directory, digest.hexdigest()+".img")
+
+# header, segment table in address order, then the data of the segments
+def packimage(memorypages):
+    table = sorted((segment.address, page, segment) for page in memorypages for segment in memorypages[page])
+    content = [IMAGE_CACHE_HEADER.pack(IMAGE_CACHE_MAGIC, IMAGE_CACHE_VERSION, len(table))]
+    content.extend(IMAGE_CACHE_SEGMENT.pack(page, address, segment.getlength()) for address, page, segment in table)
+    content.extend(segment.data for address, page, segment in table)
+    return b"".join(content)
+
+# (memory, memorypages) of a packed image or None if it isn't valid, e.g. a truncated file
+# The segments are slices of content, views if content is a memoryview
+def unpackimage(content, pages):
+    if len(content) < IMAGE_CACHE_HEADER.size:
+        return None
+    magic, version, count = IMAGE_CACHE_HEADER.unpack_from(content, 0)
+    if magic != IMAGE_CACHE_MAGIC or version != IMAGE_CACHE_VERSION:
+        return None
+    if len(content) < IMAGE_CACHE_HEADER.size+count*IMAGE_CACHE_SEGMENT.size:
+        return None
+
+    memory = Memory()
+    memorypages = {}
+    for page in pages:
+        memorypages[page] = []
+    offset = IMAGE_CACHE_HEADER.size+count*IMAGE_CACHE_SEGMENT.size
+    for page, address, length in IMAGE_CACHE_SEGMENT.iter_unpack(content[IMAGE_CACHE_HEADER.size:offset]):
+        if page not in memorypages or offset+length > len(content):
+            return None
+        segment = Segment(address, content[offset:offset+length])
+        memory.segments.append(segment)
+        memory.starts.append(address)
+        memorypages[page].append(segment)
+        offset += length
+    return memory, memorypages
+
+def writeimagecache(cachename, memorypages):
+    # written aside and renamed, a concurrent run never sees half a file
+    os.makedirs(os.path.dirname(cachename), exist_ok=True)
+    temporary = "%s.%d"%(cachename, os.getpid())
+    with open(temporary, "wb") as fout:
+        fout.write(packimage(memorypages))
+    os.replace(temporary, cachename)
+
+# (memory, memorypages) or None if there is no valid cache file
+def readimagecache(cachename, pages):
+    try:
+        with open(cachename, "rb") as fin:
+            content = fin.read()
+    except OSError:
+        return None
+    return unpackimage(content, pages)
+
+# Assign the segments to the pages (page -> [first, last]) in one pass over a sorted index of the page windows
+# Segments spanning several windows are split into copies of their parts. Returns page -> segments
+def pageassignments(memory, pages):
+    windows = sorted((pages[pgaddr][0], pages[pgaddr][1], pgaddr) for pgaddr in pages if pages[pgaddr][0] <= pages[pgaddr][1])
+    windowstarts = [window[0] for window in windows]
+    memorypages = {}
+    for pgaddr in pages:
+        memorypages[pgaddr] = []
+
+    segments = []
+    for segment in memory.segments:
+        address = segment.address
+        data = memoryview(segment.data)
+        while len(data) > 0:
+            idx = bisect.bisect_right(windowstarts, address)-1
+            if idx < 0 or address > windows[idx][1]:
+                raise ValueError("Error: some of the segments were not assigned, %X is outside of the pages"%address)
+            pagestart, pageend, pgaddr = windows[idx]
+            length = min(len(data), pageend+1-address)
+            part = segment if length == segment.getlength() else Segment(address, bytes(data[:length]))
+            segments.append(part)
+            memorypages[pgaddr].append(part)
+            address += length
+            data = data[length:]
+        data.release()
+
+    if len(segments) != len(memory.segments):
+        memory.segments = segments
+        memory.starts = [segment.address for segment in segments]
+    return memorypages
@@ -0,0 +1,293 @@
+# description: replays the USBPcap captures in wireshark-captures/ as a usbdm transport
+#              The recorded IN packets are served in order, our OUT frames are checked against the recorded ones
+#              and the probe timing of the capture is replayed: Usbdm(ReplayTransport("../wireshark-captures/rblock"))
+#              python replay.py <capture> runs the matching scenario and reports the differences
+
+import os
+import sys
+import time
+import struct
+from array import array
+from usbdm import Usbdm
+from helpers import *
+
+
+PCAP_MAGIC = 0xA1B2C3D4
+LINKTYPE_USBPCAP = 249
+TRANSFER_CONTROL = 2
+TRANSFER_BULK = 3
+ENDPOINT_OUT = 0x01
+ENDPOINT_IN = 0x82
+RESYNC_WINDOW = 8           # recorded frames searched ahead for our frame
+
+CAPTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "wireshark-captures")
+
+
+# Packets of a USBPcap file: [timestamp, irp, response, device, endpoint, transfer, data]
+def readpcap(filename):
+    with open(filename, "rb") as f:
+        content = f.read()
+
+    if len(content) < 24:
+        raise ValueError("Error: %s is not a pcap file"%filename)
+    magic, = struct.unpack_from("<I", content, 0)
+    if magic != PCAP_MAGIC:
+        raise ValueError("Error: %s is not a little endian pcap file"%filename)
+    linktype, = struct.unpack_from("<I", content, 20)
+    if linktype != LINKTYPE_USBPCAP:
+        raise ValueError("Error: %s is not a USBPcap capture"%filename)
+
+    packets = []
+    offset = 24
+    while offset+16 <= len(content):
+        seconds, useconds, length, _ = struct.unpack_from("<IIII", content, offset)
+        offset += 16
+        packet = content[offset:offset+length]
+        offset += length
+
+        # USBPcap header: headerLen irpId status function info bus device endpoint transfer dataLength
+        headerlength, irp, _, _, info, _, device, endpoint, transfer, datalength = struct.unpack_from("<HQIHBHHBBI", packet, 0)
+        data = packet[headerlength:headerlength+datalength]
+        packets.append([seconds+useconds/1e6, irp, info&0x01, device, endpoint, transfer, data])
+    return packets
+
+
+# Recorded bulk frame: the out packets of one usbdm command and the in packets answering it
+class RecordedFrame():
+    def __init__(self, timestamp):
+        self.timestamp = timestamp      # time of the last out packet
+        self.packets = []
+        self.responses = []             # [delay, data]
+        self.answered = False
+
+    def command(self):
+        return self.packets[0][1] if len(self.packets[0]) > 1 else None
+
+
+class ReplayTransport():
+    NAME = "REPLAY"
+
+    def __init__(self, filename, device=None, realtime=False, strict=False):
+        self.filename = filename
+        self.realtime = realtime        # sleep the recorded probe time instead of only adding it to the clock
+        self.strict = strict            # raise on the first difference
+        self.maxpacketsize = 64
+        self.frames = []
+        self.controls = {}              # setup packet -> [delay, data]
+        self.load(readpcap(filename), device)
+
+        self.position = 0               # next recorded frame
+        self.outstanding = []           # recorded frames answering ours, oldest first
+        self.pending = []               # packets of our frame under construction
+        self.sent = 0.0
+        self.clock = 0.0
+        self.lastreturn = time.monotonic()
+        self.transactions = 0
+        self.mismatches = []            # [frame index, recorded packets, our packets]
+        self.skipped = 0                # recorded frames we never sent
+        self.unread = 0                 # recorded responses we never read
+
+    def load(self, packets, device):
+        # the probe is the device talking bulk on the out endpoint
+        if device is None:
+            for packet in packets:
+                if packet[5] == TRANSFER_BULK and packet[4] == ENDPOINT_OUT:
+                    device = packet[3]
+                    break
+            else:
+                raise ValueError("Error: %s has no usbdm traffic"%self.filename)
+
+        setups = {}
+        frame = None
+        for timestamp, irp, response, dev, endpoint, transfer, data in packets:
+            if dev != device or len(data) == 0:
+                continue
+            if transfer == TRANSFER_CONTROL:
+                if not response:
+                    setups[irp] = (timestamp, data[:8])
+                elif irp in setups:
+                    requested, setup = setups.pop(irp)
+                    self.controls[setup] = [timestamp-requested, data]
+            elif transfer == TRANSFER_BULK and endpoint == ENDPOINT_OUT:
+                # continuation packets start with 0 and follow their first packet
+                if data[0] != 0 or frame is None or frame.responses:
+                    frame = RecordedFrame(timestamp)
+                    self.frames.append(frame)
+                frame.timestamp = timestamp
+                frame.packets.append(bytes(data))
+            elif transfer == TRANSFER_BULK and endpoint == ENDPOINT_IN and frame != None:
+                frame.responses.append([timestamp-frame.timestamp, bytes(data)])
+
+        log("%d frames, %d control transfers from %s"%(len(self.frames), len(self.controls), self.filename), level=LOGL_VERBOSE, tag=self.NAME)
+
+    # Find the recorded frame to answer ours: same bytes first, then same command, else the next one
+    def match(self, packets):
+        window = self.frames[self.position:self.position+RESYNC_WINDOW]
+        for idx, frame in enumerate(window):
+            if frame.packets == packets:
+                return self.position+idx
+        for idx, frame in enumerate(window):
+            if frame.command() == packets[0][1]:
+                return self.position+idx
+        return self.position
+
+    def difference(self, index, recorded, packets):
+        message = "Frame %d differs: recorded %s, sent %s"%(index, " ".join(p.hex() for p in recorded), " ".join(p.hex() for p in packets))
+        if self.strict:
+            raise ValueError("Error: "+message)
+        log(message, level=LOGL_NORMAL, tag=self.NAME)
+        self.mismatches.append([index, recorded, packets])
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        data = bytes(data)
+        self.pending.append(data)
+        if sum(len(p)-1 for p in self.pending)+1 < self.pending[0][0]:
+            return len(data)         # frame continues in the next packet
+
+        packets = self.pending
+        self.pending = []
+        # the replies of answered frames are not read anymore (busy replies the original software polled)
+        while self.outstanding and self.outstanding[0].answered:
+            self.unread += len(self.outstanding.pop(0).responses)
+        if self.position >= len(self.frames):
+            raise ValueError("Error: capture exhausted, sent %s"%" ".join(p.hex() for p in packets))
+
+        index = self.match(packets)
+        self.skipped += index-self.position
+        frame = self.frames[index]
+        if frame.packets != packets:
+            self.difference(index, frame.packets, packets)
+        self.position = index+1
+        answer = RecordedFrame(frame.timestamp)
+        answer.responses = list(frame.responses)
+        self.outstanding.append(answer)
+        self.transactions += 1
+
+        now = time.monotonic()
+        self.clock += now-self.lastreturn
+        self.sent = now
+        self.lastreturn = now
+        return len(data)
+
+    def respond(self, delay, data):
+        if self.realtime:
+            remaining = self.sent+delay-time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+        now = time.monotonic()
+        self.clock += max(delay, now-self.sent) if self.realtime else delay+(now-self.lastreturn)
+        self.lastreturn = time.monotonic()
+        return array("B", data)
+
+    def read(self, size):
+        # a frame written behind an answered one takes over the replies
+        while len(self.outstanding) > 1 and self.outstanding[0].answered:
+            self.unread += len(self.outstanding.pop(0).responses)
+        if len(self.outstanding) == 0 or len(self.outstanding[0].responses) == 0:
+            raise ValueError("Error: no recorded response left for frame %d"%(self.position-1))
+        answer = self.outstanding[0]
+        answer.answered = True
+        delay, data = answer.responses.pop(0)
+        return self.respond(delay, data[:size])
+
+    def readinto(self, buffer):
+        response = self.read(len(buffer))
+        memoryview(buffer)[:len(response)] = response
+        return len(response)
+
+    def control(self, setup):
+        if setup not in self.controls:
+            raise ValueError("Error: control transfer %s was not recorded"%setup.hex())
+        self.sent = time.monotonic()
+        self.clock += self.sent-self.lastreturn
+        self.lastreturn = self.sent
+        return self.respond(*self.controls[setup])
+
+    def ctrlTransfer(self, requesttype, request, value, index, length):
+        return self.control(struct.pack("<BBHHH", requesttype, request, value, index, length))[:length]
+
+    # GET_DESCRIPTOR(STRING) with the language id of the capture
+    def getString(self, index):
+        for setup in self.controls:
+            if setup[:4] == struct.pack("<BBH", 0x80, 0x06, 0x0300|index):
+                descriptor = self.control(setup)
+                return bytes(descriptor[2:descriptor[0]]).decode("utf-16-le")
+        raise ValueError("Error: string %d was not recorded"%index)
+
+    def reattach(self):
+        pass
+
+    def report(self):
+        log("%d transactions, %d differing, %d recorded frames skipped, %d responses unread, %d frames left, %.3f s"%(
+            self.transactions, len(self.mismatches), self.skipped, self.unread, len(self.frames)-self.position, self.clock), level=LOGL_NORMAL, tag=self.NAME)
+
+
+# What was done with the USBDM software when the captures were taken, using our calls (see wireshark readme.txt)
+def readblock(usbdm, address, size):
+    for offset in range(0, size, 0x90):
+        usbdm.readBdmBlock(address+offset, min(0x90, size-offset))
+
+SCENARIOS = {
+    "openbdm":          lambda usbdm: usbdm.openBdm(),
+    "getstatus":        lambda usbdm: [usbdm.getBdmStatus() for _ in range(4)],
+    "rblock":           lambda usbdm: (readblock(usbdm, 0x8000, 0xFF), readblock(usbdm, 0x8000, 0x1FF)),
+    "wblock":           lambda usbdm: (usbdm.openBdm(),
+                                       usbdm.writeBdmBlock(0x8000, bytes((0xCC+idx)&0xFF for idx in range(0x88))),
+                                       usbdm.writeBdmBlock(0x8088, bytes((0x54+idx)&0xFF for idx in range(0x40))),
+                                       usbdm.closeBdm()),
+    "writebdm":         lambda usbdm: (usbdm.openBdm(),
+                                       usbdm.writeBdmByte(0x4FFF, 0xAA),
+                                       usbdm.writeBdmWord(0x4FFF, 0xAAAA),
+                                       usbdm.readBdmByte(0x4FFE),
+                                       usbdm.closeBdm()),
+    "writereggohalt":   lambda usbdm: (usbdm.writeRegister(0x03, 0x4004),
+                                       usbdm.writeCoreRegister(),
+                                       usbdm.readBdmBlock(0x4004, 4),
+                                       usbdm.runTarget(),
+                                       usbdm.haltTarget()),
+}
+
+
+'''
+ Replay a capture: python replay.py <capture> [-realtime] [-strict] [-log <loglevel>]
+'''
+if __name__ == "__main__":
+    if len(sys.argv)>1:
+        capture = sys.argv[1]
+        realtime = False
+        strict = False
+        loglevel = LOGL_NORMAL
+        idx = 2
+
+        try:
+            while idx<len(sys.argv):
+                if sys.argv[idx] == "-realtime":
+                    realtime = True
+                elif sys.argv[idx] == "-strict":
+                    strict = True
+                elif sys.argv[idx] == "-log":
+                    idx +=1
+                    loglevel = int(sys.argv[idx])
+                idx +=1
+
+            setlogginglevel(loglevel)
+            name = os.path.basename(capture)
+            if name not in SCENARIOS:
+                raise ValueError("Error: No scenario for %s"%name)
+            if not os.path.exists(capture):
+                capture = os.path.join(CAPTURES, name)
+
+            transport = ReplayTransport(capture, realtime=realtime, strict=strict)
+            SCENARIOS[name](Usbdm(transport))
+            transport.report()
+        except Exception as e:
+            log(e, level=LOGL_NORMAL)
+            sys.exit(1)
+    else:
+        print("Arguments:")
+        print("%-30s :%s"%("\t<capture>","capture to replay: %s"%", ".join(SCENARIOS.keys())))
+        print("%-30s :%s"%("\t-realtime","wait for the recorded probe time"))
+        print("%-30s :%s"%("\t-strict","stop at the first frame differing from the capture"))
+        print("%-30s :%s"%("\t-log <loglevel>","change logging level DEBUG(0) VERBOSE(1) NORMAL(2)"))
@@ -0,0 +1,981 @@
+# description: simulated usbdm probe with a HCS12/HCS08 target behind it
+#              Hand it to Usbdm to run the flashing paths without hardware:
+#              Usbdm(SimulatedTransport("MC9S12DJ64"))
+
+import time
+from array import array
+from helpers import *
+
+
+# Chips the simulator knows about
+# pages: flash pages in the order of the blocks, blocks: pages sharing one flash controller
+# (on the DG128 FCNFG.BLKSEL selects the controller)
+PROFILES = {
+    "MC9S12DJ64":  {"target":0x00, "ram":[0x4000,0x5000], "blocks":[[0x3C,0x3D,0x3E,0x3F]],
+                    "partid":[0x1A,0x0200], "sectorsize":0x200, "busclock":4000000},
+    "MC9S12DG128": {"target":0x00, "ram":[0x4000,0x6000], "blocks":[[0x3C,0x3D,0x3E,0x3F],[0x38,0x39,0x3A,0x3B]],
+                    "partid":[0x1A,0x0111], "sectorsize":0x200, "busclock":4000000},
+    "MC9S08DZ128": {"target":0x01, "ram":[0x0080,0x1800,0x1900,0x2180], "blocks":[[0,1,2,3,4,5,6,7]],
+                    "partid":[0x1806,0x0119], "sectorsize":0x300, "busclock":8000000},
+}
+
+# Flash command durations in seconds
+FLASH_TIMES = {
+    "program":      0.000040,
+    "burst":        0.000020,
+    "erasesector":  0.020,
+    "erasemass":    0.100,
+    "blank":        0.002,
+}
+
+BITS_FSTAT_CBEIF = 0x80
+BITS_FSTAT_CCIF  = 0x40
+BITS_FSTAT_PVIOL = 0x20
+BITS_FSTAT_ACCER = 0x10
+BITS_FSTAT_BLANK = 0x04
+
+PAGE_LENGTH = 0x4000
+
+
+# Command state machine of one flash block: FSTAT/FCMD plus the latched array write
+class FlashController():
+    def __init__(self, target, pages, sectorsize, flashtimes):
+        self.target = target
+        self.pages = pages
+        self.sectorsize = sectorsize
+        self.flashtimes = flashtimes
+        self.reset()
+
+    def reset(self):
+        self.fcmd = 0x00
+        self.errors = 0x00
+        self.blank = 0x00
+        self.busyuntil = 0.0
+        self.latch = None               # (page, offset, data) of the last array write
+
+    def readstatus(self, now):
+        status = self.errors | self.blank
+        if now >= self.busyuntil:
+            status |= BITS_FSTAT_CBEIF | BITS_FSTAT_CCIF
+        return status
+
+    def writestatus(self, value, now):
+        self.errors &= ~(value & (BITS_FSTAT_ACCER|BITS_FSTAT_PVIOL))
+        if value & BITS_FSTAT_CBEIF and now >= self.busyuntil and self.latch != None:
+            self.launch(now)
+
+    def writecommand(self, value):
+        self.fcmd = value
+
+    def writearray(self, page, offset, data, now):
+        if now < self.busyuntil:
+            self.errors |= BITS_FSTAT_ACCER
+        else:
+            self.latch = (page, offset, bytes(data))
+
+    def launch(self, now):
+        page, offset, data = self.latch
+        self.latch = None
+        self.blank = 0x00
+        flash = self.target.flash
+
+        if self.fcmd in (0x20, 0x25) and page != None:
+            memory = flash[page]
+            for idx in range(len(data)):
+                memory[offset+idx] &= data[idx]
+            duration = self.flashtimes["burst" if self.fcmd == 0x25 else "program"]
+        elif self.fcmd == 0x40 and page != None:
+            start = offset - offset%self.sectorsize
+            flash[page][start:start+self.sectorsize] = b"\xff"*len(flash[page][start:start+self.sectorsize])
+            duration = self.flashtimes["erasesector"]
+        elif self.fcmd == 0x41:
+            for pg in self.pages:
+                flash[pg][:] = b"\xff"*len(flash[pg])
+            duration = self.flashtimes["erasemass"]
+        elif self.fcmd == 0x05:
+            if all(flash[pg].count(0xff) == len(flash[pg]) for pg in self.pages):
+                self.blank = BITS_FSTAT_BLANK
+            duration = self.flashtimes["blank"]
+        else:
+            self.errors |= BITS_FSTAT_ACCER
+            return
+        self.busyuntil = now + duration
+
+
+# Flags and branches shared by both cpu cores
+class Cpu():
+    CYCLES = 3          # average bus cycles per instruction
+
+    def __init__(self, target, busclock):
+        self.target = target
+        self.busclock = busclock
+        self.time = 0.0
+        self.idlestate = None
+        self.reset()
+
+    def fetch8(self):
+        value = self.target.readbyte(self.pc)
+        self.pc = (self.pc+1)&0xFFFF
+        return value
+
+    def fetch16(self):
+        return (self.fetch8()<<8) | self.fetch8()
+
+    def relative8(self):
+        offset = self.fetch8()
+        return offset-0x100 if offset&0x80 else offset
+
+    def nz(self, value, bits):
+        self.n = (value>>(bits-1))&1 == 1
+        self.z = value == 0
+        self.v = False
+        return value
+
+    def branch(self, opcode):
+        n, z, v, c = self.n, self.z, self.v, self.c
+        return [True, False, not (c or z), c or z, not c, c, not z, z,
+                not v, v, not n, n, n == v, n != v, not z and n == v, z or n != v][opcode&0x0F]
+
+    def push8(self, value):
+        self.target.writebyte(self.sp, value)
+        self.sp = (self.sp-1)&0xFFFF
+
+    def pull8(self):
+        self.sp = (self.sp+1)&0xFFFF
+        return self.target.readbyte(self.sp)
+
+    # Execute until the target time is reached or the target stops
+    def run(self, until):
+        while self.target.running and self.time < until:
+            pc = self.pc
+            self.target.now = self.time
+            self.step()
+            self.time += self.CYCLES/self.busclock
+
+            # Branch onto itself: nothing happens until the flash is done
+            if self.pc == pc:
+                self.time = max(self.time, min(until, self.target.nextevent(self.time)))
+            # Polling loop: the same state at the same backward branch without any write in between
+            elif self.pc < pc:
+                state = (self.pc, self.target.writes) + self.state()
+                if state == self.idlestate:
+                    self.time = max(self.time, min(until, self.target.nextevent(self.time)))
+                    self.idlestate = None
+                else:
+                    self.idlestate = state
+        self.time = max(self.time, until)
+
+    def unsupported(self, opcode, pc):
+        self.target.running = False
+        raise ValueError("Error: simulated %s can't execute %02X at %04X"%(self.NAME, opcode, pc))
+
+
+# Subset of the CPU12 instruction set, enough for the ram loaders
+class Hcs12Cpu(Cpu):
+    NAME = "CPU12"
+
+    def reset(self):
+        self.a = 0
+        self.b = 0
+        self.x = 0
+        self.y = 0
+        self.sp = 0
+        self.pc = 0
+        self.n = self.z = self.v = self.c = False
+
+    def state(self):
+        return (self.a, self.b, self.x, self.y, self.sp, self.n, self.z, self.v, self.c)
+
+    def getd(self):
+        return (self.a<<8)|self.b
+
+    def setd(self, value):
+        self.a = (value>>8)&0xFF
+        self.b = value&0xFF
+
+    # USBDM register numbers
+    def setregister(self, register, value):
+        if register == 0x03:
+            self.pc = value
+        elif register == 0x04:
+            self.setd(value)
+        elif register == 0x05:
+            self.x = value
+        elif register == 0x06:
+            self.y = value
+        elif register == 0x07:
+            self.sp = value
+
+    def getregister(self, register):
+        return {0x03:self.pc, 0x04:self.getd(), 0x05:self.x, 0x06:self.y, 0x07:self.sp}.get(register, 0)
+
+    def getindex(self, rr):
+        return [self.x, self.y, self.sp, self.pc][rr]
+
+    def setindex(self, rr, value):
+        if rr == 0:
+            self.x = value
+        elif rr == 1:
+            self.y = value
+        else:
+            self.sp = value
+
+    # Indexed addressing, the indirect forms are not supported
+    def indexed(self):
+        xb = self.fetch8()
+        if xb & 0x20 == 0:                  # rr0nnnnn 5-bit offset
+            offset = xb & 0x1F
+            if offset & 0x10:
+                offset -= 0x20
+            return (self.getindex(xb>>6) + offset)&0xFFFF
+        elif xb & 0xE0 != 0xE0:             # rr1pnnnn auto increment/decrement
+            rr = xb>>6
+            amount = (xb&0x0F)+1 if xb&0x08 == 0 else (xb&0x0F)-16
+            before = self.getindex(rr)
+            after = (before+amount)&0xFFFF
+            self.setindex(rr, after)
+            return before if xb&0x10 else after
+        else:
+            rr = (xb>>3)&0x03
+            if xb & 0x04 == 0:
+                if xb & 0x02 == 0:          # 111rr00s 9-bit offset
+                    offset = self.fetch8() - (0x100 if xb&0x01 else 0)
+                elif xb & 0x01 == 0:        # 111rr010 16-bit offset
+                    offset = self.fetch16()
+                else:
+                    self.unsupported(xb, self.pc)
+            elif xb & 0x03 == 0x03:         # [D,r]
+                self.unsupported(xb, self.pc)
+            else:                           # 111rr1aa accumulator offset
+                offset = [self.a, self.b, self.getd()][xb&0x03]
+            return (self.getindex(rr) + offset)&0xFFFF
+
+    def address(self, opcode):
+        mode = opcode & 0x30
+        if mode == 0x10:
+            return self.fetch8()
+        elif mode == 0x20:
+            return self.indexed()
+        return self.fetch16()
+
+    def sub16(self, left, right):
+        result = (left-right)&0xFFFF
+        self.nz(result, 16)
+        self.v = ((left^right)&(left^result)&0x8000) != 0
+        self.c = left < right
+        return result
+
+    def add16(self, left, right):
+        result = (left+right)&0xFFFF
+        self.nz(result, 16)
+        self.v = ((left^result)&(right^result)&0x8000) != 0
+        self.c = left+right > 0xFFFF
+        return result
+
+    def step(self):
+        t = self.target
+        pc = self.pc
+        op = self.fetch8()
+
+        if op == 0x00:                                  # BGND
+            t.running = False
+        elif op == 0x18:
+            self.step18(pc)
+        elif op == 0x07:                                # BSR
+            offset = self.relative8()
+            self.push16(self.pc)
+            self.pc = (self.pc+offset)&0xFFFF
+        elif 0x20 <= op <= 0x2F:                        # Bcc
+            offset = self.relative8()
+            if self.branch(op):
+                self.pc = (self.pc+offset)&0xFFFF
+        elif op == 0x04:                                # DBEQ DBNE TBEQ TBNE IBEQ IBNE
+            lb = self.fetch8()
+            offset = self.fetch8() - (0x100 if lb&0x10 else 0)
+            register = lb&0x07
+            value = self.getregister16(register)
+            kind = lb>>5
+            if kind in (0, 1):
+                value = (value-1)&self.mask(register)
+            elif kind in (4, 5):
+                value = (value+1)&self.mask(register)
+            self.setregister16(register, value)
+            if (value == 0) == (kind in (0, 2, 4)):
+                self.pc = (self.pc+offset)&0xFFFF
+        elif op in (0x06, 0x05):                        # JMP
+            self.pc = self.fetch16() if op == 0x06 else self.indexed()
+        elif op in (0x16, 0x15, 0x17):                  # JSR
+            destination = {0x16:self.fetch16, 0x15:self.indexed, 0x17:self.fetch8}[op]()
+            self.push16(self.pc)
+            self.pc = destination
+        elif op == 0x3D:                                # RTS
+            self.pc = self.pull16()
+        elif op in (0x08, 0x09):                        # INX DEX
+            self.x = (self.x + (1 if op == 0x08 else -1))&0xFFFF
+            self.z = self.x == 0
+        elif op in (0x02, 0x03):                        # INY DEY
+            self.y = (self.y + (1 if op == 0x02 else -1))&0xFFFF
+            self.z = self.y == 0
+        elif op == 0x59:                                # LSLD
+            d = self.getd()
+            self.c = d&0x8000 != 0
+            self.setd(self.nz((d<<1)&0xFFFF, 16))
+            self.v = self.n != self.c
+        elif op == 0x49:                                # LSRD
+            d = self.getd()
+            self.c = d&0x0001 != 0
+            self.setd(self.nz(d>>1, 16))
+            self.v = self.c
+        elif op in (0x87, 0xC7):                        # CLRA CLRB
+            if op == 0x87:
+                self.a = 0
+            else:
+                self.b = 0
+            self.nz(0, 8)
+            self.c = False
+        elif op in (0x42, 0x52, 0x43, 0x53):            # INCA INCB DECA DECB
+            value = self.a if op&0x10 == 0 else self.b
+            value = self.nz((value + (1 if op&0x01 == 0 else -1))&0xFF, 8)
+            if op&0x10 == 0:
+                self.a = value
+            else:
+                self.b = value
+        elif op in (0x72, 0x62, 0x73, 0x63, 0x79, 0x69):  # INC DEC CLR memory
+            address = self.fetch16() if op&0x10 else self.indexed()
+            if op in (0x79, 0x69):
+                value = 0
+                self.c = False
+            else:
+                value = (t.readbyte(address) + (1 if op&0x01 == 0 else -1))&0xFF
+            t.writebyte(address, self.nz(value, 8))
+        elif op in (0x36, 0x37):                        # PSHA PSHB
+            self.push8(self.a if op == 0x36 else self.b)
+        elif op in (0x32, 0x33):                        # PULA PULB
+            if op == 0x32:
+                self.a = self.pull8()
+            else:
+                self.b = self.pull8()
+        elif op in (0x3B, 0x34, 0x35):                  # PSHD PSHX PSHY
+            self.push16({0x3B:self.getd(), 0x34:self.x, 0x35:self.y}[op])
+        elif op in (0x3A, 0x30, 0x31):                  # PULD PULX PULY
+            value = self.pull16()
+            if op == 0x3A:
+                self.setd(value)
+            elif op == 0x30:
+                self.x = value
+            else:
+                self.y = value
+        elif op in (0x4E, 0x4F, 0x1E, 0x1F, 0x0E, 0x0F):  # BRSET BRCLR
+            address = self.fetch8() if op&0x40 else (self.fetch16() if op&0x10 else self.indexed())
+            mask = self.fetch8()
+            offset = self.relative8()
+            value = t.readbyte(address)
+            if (op&0x01 and value&mask == 0) or (op&0x01 == 0 and ~value&mask == 0):
+                self.pc = (self.pc+offset)&0xFFFF
+        elif op in (0x4C, 0x4D, 0x1C, 0x1D, 0x0C, 0x0D):  # BSET BCLR
+            address = self.fetch8() if op&0x40 else (self.fetch16() if op&0x10 else self.indexed())
+            mask = self.fetch8()
+            value = t.readbyte(address)
+            t.writebyte(address, self.nz(value&~mask if op&0x01 else value|mask, 8))
+        elif op == 0xA7:                                # NOP
+            pass
+        elif op >= 0x80 and op&0x0F in (0x06, 0x08, 0x04, 0x0A, 0x01):  # LDA EOR AND ORA CMP
+            value = self.fetch8() if op&0x30 == 0 else t.readbyte(self.address(op))
+            accumulator = self.a if op < 0xC0 else self.b
+            kind = op&0x0F
+            if kind == 0x01:
+                result = (accumulator-value)&0xFF
+                self.nz(result, 8)
+                self.c = accumulator < value
+                return
+            result = self.nz({0x06:value, 0x08:accumulator^value, 0x04:accumulator&value, 0x0A:accumulator|value}[kind], 8)
+            if op < 0xC0:
+                self.a = result
+            else:
+                self.b = result
+        elif op >= 0x80 and op&0x0F in (0x0C, 0x0D, 0x0E, 0x0F):  # LDD LDY LDX LDS, CPD CPY CPX CPS
+            value = self.fetch16() if op&0x30 == 0 else self.readword(self.address(op))
+            if op < 0xC0:
+                left = {0x0C:self.getd(), 0x0D:self.y, 0x0E:self.x, 0x0F:self.sp}[op&0x0F]
+                self.sub16(left, value)
+            else:
+                self.setregister16({0x0C:4, 0x0D:6, 0x0E:5, 0x0F:7}[op&0x0F], self.nz(value, 16))
+        elif op >= 0x80 and op&0x0F == 0x03:            # SUBD ADDD
+            value = self.fetch16() if op&0x30 == 0 else self.readword(self.address(op))
+            if op < 0xC0:
+                self.setd(self.sub16(self.getd(), value))
+            else:
+                self.setd(self.add16(self.getd(), value))
+        elif 0x5A <= op <= 0x7F and op&0x0F in (0x0A, 0x0B) and op&0x30 != 0x00:  # STAA STAB
+            address = self.address(op)
+            t.writebyte(address, self.nz(self.a if op&0x0F == 0x0A else self.b, 8))
+        elif 0x5C <= op <= 0x7F and op&0x0F >= 0x0C and op&0x30 != 0x00:         # STD STY STX STS
+            address = self.address(op)
+            value = self.getregister16({0x0C:4, 0x0D:6, 0x0E:5, 0x0F:7}[op&0x0F])
+            self.writeword(address, self.nz(value, 16))
+        else:
+            self.unsupported(op, pc)
+
+    # MOVB MOVW
+    def step18(self, pc):
+        op = self.fetch8()
+        if op > 0x0D or op in (0x06, 0x07):
+            self.unsupported(op, pc)
+        if op in (0x00, 0x08):              # immediate to indexed, destination first in the opcode
+            destination = self.indexed()
+            value = self.fetch8() if op == 0x08 else self.fetch16()
+        elif op in (0x03, 0x0B):            # immediate to extended
+            value = self.fetch8() if op == 0x0B else self.fetch16()
+            destination = self.fetch16()
+        else:
+            kind = op & 0x07
+            if kind == 0x01:                # extended to indexed
+                destination = self.indexed()
+                source = self.fetch16()
+            elif kind == 0x02:              # indexed to indexed
+                source = self.indexed()
+                destination = self.indexed()
+            elif kind == 0x04:              # extended to extended
+                source = self.fetch16()
+                destination = self.fetch16()
+            else:                           # indexed to extended
+                source = self.indexed()
+                destination = self.fetch16()
+            value = self.target.readbyte(source) if op&0x08 else self.readword(source)
+
+        if op&0x08:
+            self.target.writebyte(destination, value)
+        else:
+            self.writeword(destination, value)
+
+    def mask(self, register):
+        return 0xFF if register < 2 else 0xFFFF
+
+    # TFR/EXG/DBNE register numbering
+    def getregister16(self, register):
+        return [self.a, self.b, 0, 0, self.getd(), self.x, self.y, self.sp][register]
+
+    def setregister16(self, register, value):
+        if register == 0:
+            self.a = value
+        elif register == 1:
+            self.b = value
+        elif register == 4:
+            self.setd(value)
+        elif register == 5:
+            self.x = value
+        elif register == 6:
+            self.y = value
+        elif register == 7:
+            self.sp = value
+
+    def readword(self, address):
+        return (self.target.readbyte(address)<<8) | self.target.readbyte((address+1)&0xFFFF)
+
+    def writeword(self, address, value):
+        self.target.writeword(address, value)
+
+    # the CPU12 stack pointer points to the last pushed byte
+    def push8(self, value):
+        self.sp = (self.sp-1)&0xFFFF
+        self.target.writebyte(self.sp, value)
+
+    def pull8(self):
+        value = self.target.readbyte(self.sp)
+        self.sp = (self.sp+1)&0xFFFF
+        return value
+
+    def push16(self, value):
+        self.sp = (self.sp-2)&0xFFFF
+        self.writeword(self.sp, value)
+
+    def pull16(self):
+        value = self.readword(self.sp)
+        self.sp = (self.sp+2)&0xFFFF
+        return value
+
+
+# Subset of the HCS08 instruction set, enough for the ram loaders
+class Hcs08Cpu(Cpu):
+    NAME = "HCS08"
+
+    def reset(self):
+        self.a = 0
+        self.hx = 0
+        self.sp = 0x00FF
+        self.pc = 0
+        self.n = self.z = self.v = self.c = False
+
+    def state(self):
+        return (self.a, self.hx, self.sp, self.n, self.z, self.v, self.c)
+
+    # USBDM register numbers
+    def setregister(self, register, value):
+        if register == 0x0B:
+            self.pc = value
+        elif register == 0x08:
+            self.a = value&0xFF
+        elif register == 0x0C:
+            self.hx = value
+        elif register == 0x0F:
+            self.sp = value
+
+    def getregister(self, register):
+        return {0x0B:self.pc, 0x08:self.a, 0x0C:self.hx, 0x0F:self.sp}.get(register, 0)
+
+    def readword(self, address):
+        return (self.target.readbyte(address)<<8) | self.target.readbyte((address+1)&0xFFFF)
+
+    def writeword(self, address, value):
+        self.target.writebyte(address, value>>8)
+        self.target.writebyte((address+1)&0xFFFF, value&0xFF)
+
+    # Operand address for the 0xB0..0xFF columns
+    def address(self, opcode):
+        mode = opcode & 0xF0
+        if mode == 0xB0:
+            return self.fetch8()
+        elif mode == 0xC0:
+            return self.fetch16()
+        elif mode == 0xD0:
+            return (self.hx + self.fetch16())&0xFFFF
+        elif mode == 0xE0:
+            return (self.hx + self.fetch8())&0xFFFF
+        return self.hx
+
+    def step(self):
+        t = self.target
+        pc = self.pc
+        op = self.fetch8()
+
+        if op == 0x82:                                  # BGND
+            t.running = False
+        elif op <= 0x0F:                                # BRSET BRCLR
+            value = t.readbyte(self.fetch8())
+            offset = self.relative8()
+            bit = (value>>(op>>1))&1
+            self.c = bit == 1
+            if bit == (0 if op&0x01 else 1):
+                self.pc = (self.pc+offset)&0xFFFF
+        elif op <= 0x1F:                                # BSET BCLR
+            address = self.fetch8()
+            value = t.readbyte(address)
+            bit = 1<<((op-0x10)>>1)
+            t.writebyte(address, value&~bit if op&0x01 else value|bit)
+        elif op <= 0x2F:                                # Bcc
+            offset = self.relative8()
+            if (op <= 0x27 or op in (0x2A, 0x2B)) and self.branch(op):
+                self.pc = (self.pc+offset)&0xFFFF
+        elif op in (0x90, 0x91, 0x92, 0x93):            # BGE BLT BGT BLE
+            offset = self.relative8()
+            if self.branch(op-0x84):
+                self.pc = (self.pc+offset)&0xFFFF
+        elif op in (0x45, 0x55, 0x32):                  # LDHX
+            self.hx = self.nz(self.fetch16() if op == 0x45 else self.readword(self.fetch8() if op == 0x55 else self.fetch16()), 16)
+        elif op in (0x35, 0x96):                        # STHX
+            self.writeword(self.fetch8() if op == 0x35 else self.fetch16(), self.nz(self.hx, 16))
+        elif op in (0x65, 0x75, 0x3E):                  # CPHX
+            value = self.fetch16() if op == 0x65 else self.readword(self.fetch8() if op == 0x75 else self.fetch16())
+            result = (self.hx-value)&0xFFFF
+            self.nz(result, 16)
+            self.v = ((self.hx^value)&(self.hx^result)&0x8000) != 0
+            self.c = self.hx < value
+        elif op == 0xAF:                                # AIX
+            self.hx = (self.hx + self.relative8())&0xFFFF
+        elif op in (0x3C, 0x3A, 0x3F, 0x7C, 0x7A, 0x7F):   # INC DEC CLR memory
+            address = self.fetch8() if op&0xF0 == 0x30 else self.hx
+            if op&0x0F == 0x0F:
+                value = 0
+            else:
+                value = (t.readbyte(address) + (1 if op&0x0F == 0x0C else -1))&0xFF
+            t.writebyte(address, self.nz(value, 8))
+        elif op in (0x4C, 0x4A, 0x4F):                  # INCA DECA CLRA
+            self.a = self.nz({0x4C:(self.a+1)&0xFF, 0x4A:(self.a-1)&0xFF, 0x4F:0}[op], 8)
+        elif op in (0x5C, 0x5A, 0x5F):                  # INCX DECX CLRX
+            x = self.nz({0x5C:(self.hx+1)&0xFF, 0x5A:(self.hx-1)&0xFF, 0x5F:0}[op&0xFF], 8)
+            self.hx = (self.hx&0xFF00) | x
+        elif op == 0x8C:                                # CLRH
+            self.hx &= 0x00FF
+        elif op in (0x48, 0x49, 0x44, 0x46):            # LSLA ROLA LSRA RORA
+            carry = 1 if self.c else 0
+            if op in (0x48, 0x49):
+                result = ((self.a<<1) | (carry if op == 0x49 else 0))&0xFF
+                self.c = self.a&0x80 != 0
+            else:
+                result = (self.a>>1) | ((carry<<7) if op == 0x46 else 0)
+                self.c = self.a&0x01 != 0
+            self.a = self.nz(result, 8)
+        elif op in (0x4B, 0x5B, 0x3B):                  # DBNZA DBNZX DBNZ
+            if op == 0x4B:
+                self.a = value = (self.a-1)&0xFF
+            elif op == 0x5B:
+                value = (self.hx-1)&0xFF
+                self.hx = (self.hx&0xFF00) | value
+            else:
+                address = self.fetch8()
+                value = (t.readbyte(address)-1)&0xFF
+                t.writebyte(address, value)
+            offset = self.relative8()
+            if value != 0:
+                self.pc = (self.pc+offset)&0xFFFF
+        elif op in (0xAD, 0xBD, 0xCD):                  # BSR JSR
+            if op == 0xAD:
+                offset = self.relative8()
+                destination = (self.pc+offset)&0xFFFF
+            else:
+                destination = self.fetch8() if op == 0xBD else self.fetch16()
+            self.push16(self.pc)
+            self.pc = destination
+        elif op in (0xBC, 0xCC):                        # JMP
+            self.pc = self.fetch8() if op == 0xBC else self.fetch16()
+        elif op == 0x81:                                # RTS
+            self.pc = self.pull16()
+        elif op in (0x87, 0x89, 0x8B):                  # PSHA PSHX PSHH
+            self.push8({0x87:self.a, 0x89:self.hx&0xFF, 0x8B:self.hx>>8}[op])
+        elif op in (0x86, 0x88, 0x8A):                  # PULA PULX PULH
+            value = self.pull8()
+            if op == 0x86:
+                self.a = value
+            elif op == 0x88:
+                self.hx = (self.hx&0xFF00) | value
+            else:
+                self.hx = (self.hx&0x00FF) | (value<<8)
+        elif op == 0x9D:                                # NOP
+            pass
+        elif op >= 0xA0 and op&0x0F in (0x06, 0x07, 0x04, 0x08, 0x0A, 0x01, 0x0E, 0x0F) and op not in (0xA7, 0xAF):
+            kind = op&0x0F
+            if kind in (0x07, 0x0F):                     # STA STX
+                address = self.address(op)
+                t.writebyte(address, self.nz(self.a if kind == 0x07 else self.hx&0xFF, 8))
+                return
+            value = self.fetch8() if op&0xF0 == 0xA0 else t.readbyte(self.address(op))
+            if kind == 0x0E:                            # LDX
+                self.hx = (self.hx&0xFF00) | self.nz(value, 8)
+            elif kind == 0x01:                          # CMP
+                result = (self.a-value)&0xFF
+                self.nz(result, 8)
+                self.c = self.a < value
+            else:                                       # LDA AND EOR ORA
+                self.a = self.nz({0x06:value, 0x04:self.a&value, 0x08:self.a^value, 0x0A:self.a|value}[kind], 8)
+        else:
+            self.unsupported(op, pc)
+
+    def push16(self, value):
+        self.push8(value&0xFF)
+        self.push8(value>>8)
+
+    def pull16(self):
+        high = self.pull8()
+        return (high<<8) | self.pull8()
+
+
+# Memory map, registers and flash of the simulated chip
+class SimulatedTarget():
+    def __init__(self, profile, flashtimes):
+        self.profile = profile
+        self.hcs08 = profile["target"] == 0x01
+        self.memory = bytearray(0x10000)        # ram and everything which is not modelled otherwise
+        self.registers = bytearray(0x10000)
+        self.flash = {}
+        self.controllers = []
+        self.pagecontroller = {}
+        for block in profile["blocks"]:
+            controller = FlashController(self, block, profile["sectorsize"], flashtimes)
+            self.controllers.append(controller)
+            for page in block:
+                self.flash[page] = bytearray(b"\xff"*PAGE_LENGTH)
+                self.pagecontroller[page] = controller
+
+        # HCS12 EEPROM
+        self.flash["eeprom"] = bytearray(b"\xff"*0x800)
+        self.eeprom = FlashController(self, ["eeprom"], 4, flashtimes)
+
+        self.now = 0.0
+        self.writes = 0               # bumped by every write, a polling loop never writes
+        self.running = False
+        if self.hcs08:
+            self.cpu = Hcs08Cpu(self, profile["busclock"])
+        else:
+            self.cpu = Hcs12Cpu(self, profile["busclock"])
+        self.reset()
+
+    def reset(self):
+        self.running = False
+        self.registers[:] = bytes(len(self.registers))
+        partid = self.profile["partid"]
+        self.registers[partid[0]:partid[0]+2] = partid[1].to_bytes(2,"big")
+        if self.hcs08:
+            self.registers[0x78] = 0x02     # PPAGE
+            self.registers[0x48] = 0x04     # MCGC1
+            self.registers[0x49] = 0x40     # MCGC2
+            self.registers[0x1824] = 0xFF   # FPROT
+        for controller in self.controllers:
+            controller.reset()
+        self.eeprom.reset()
+        self.cpu.reset()
+
+    def ppage(self):
+        return self.registers[0x78 if self.hcs08 else 0x30]
+
+    def isram(self, address):
+        ram = self.profile["ram"]
+        for idx in range(0, len(ram), 2):
+            if ram[idx] <= address < ram[idx+1]:
+                return True
+        return False
+
+    def isregister(self, address):
+        if self.hcs08:
+            return address < 0x80 or 0x1800 <= address < 0x1900
+        return address < 0x400
+
+    # flash page of a cpu address or None
+    def flashpage(self, address):
+        if self.hcs08:
+            if address < 0x4000:
+                page = 0
+            elif address < 0x8000:
+                page = 1
+            elif address < 0xC000:
+                page = self.ppage()
+            else:
+                page = 3
+        else:
+            if address < 0x4000:
+                return None
+            elif address < 0x8000:
+                page = 0x3E
+            elif address < 0xC000:
+                page = self.ppage()
+            else:
+                page = 0x3F
+            if page not in self.flash:
+                # the unused PPAGE bits are not decoded
+                pages = sorted(self.pagecontroller)
+                page = pages[page%len(pages)]
+        return page if page in self.flash else None
+
+    def controller(self, address):
+        if self.hcs08:
+            return self.controllers[0]
+        elif address >= 0x110:
+            return self.eeprom
+        return self.controllers[self.registers[0x103]&0x01 if len(self.controllers)>1 else 0]
+
+    # array writes latch into the block selected by FCNFG.BLKSEL, whatever page is mapped
+    def arraycontroller(self, page):
+        if self.hcs08:
+            return self.pagecontroller[page]
+        return self.controller(0x100)
+
+    def isflashregister(self, address):
+        if self.hcs08:
+            return 0x1820 <= address < 0x1830
+        return 0x100 <= address < 0x120
+
+    def readbyte(self, address):
+        address &= 0xFFFF
+        if self.isregister(address):
+            if self.isflashregister(address) and address&0x0F == 0x05:
+                return self.controller(address).readstatus(self.now)
+            return self.registers[address]
+        elif self.isram(address):
+            return self.memory[address]
+        page = self.flashpage(address)
+        if page != None:
+            return self.flash[page][address&0x3FFF]
+        return self.memory[address]
+
+    def writebyte(self, address, value):
+        address &= 0xFFFF
+        value &= 0xFF
+        self.writes += 1
+        if self.isregister(address):
+            if self.isflashregister(address):
+                controller = self.controller(address)
+                offset = address&0x0F
+                if offset == 0x05:
+                    controller.writestatus(value, self.now)
+                    return
+                elif offset == 0x06:
+                    controller.writecommand(value)
+                elif offset >= 0x08 and not self.hcs08:          # FADDR FDATA
+                    controller.writearray(None, 0, b"", self.now)
+            self.registers[address] = value
+        elif self.isram(address):
+            self.memory[address] = value
+        else:
+            page = self.flashpage(address)
+            if page != None:
+                self.arraycontroller(page).writearray(page, address&0x3FFF, [value], self.now)
+            else:
+                self.memory[address] = value
+
+    # The HCS12 flash is written in words
+    def writeword(self, address, value):
+        address &= 0xFFFF
+        self.writes += 1
+        page = self.flashpage(address)
+        if page != None and not self.isram(address) and not self.isregister(address):
+            self.arraycontroller(page).writearray(page, address&0x3FFF, value.to_bytes(2,"big"), self.now)
+        else:
+            self.writebyte(address, value>>8)
+            self.writebyte(address+1, value&0xFF)
+
+    def nextevent(self, now):
+        pending = [controller.busyuntil for controller in self.controllers+[self.eeprom] if controller.busyuntil > now]
+        return min(pending) if pending else float("inf")
+
+    def run(self, until):
+        self.cpu.run(until)
+        self.now = until
+
+
+# Transport decoding the usbdm frames against the simulated target
+# Time is modelled: every transaction costs the usb latency plus the BDM transfer of the payload,
+# the time the host spends in between is added as well. clock holds the time of the run so far.
+# Frames written back to back without reading in between (batches) cost frametime instead of the latency.
+class SimulatedTransport():
+    NAME = "SIMULATOR"
+    CAPABILITIES = b"\x00\x74\x01\x00\x91\x04\x0c\x01"     # status, capabilities, command buffer size, firmware 4.12.1
+    VERSION = b"\x00\x4c\x97\x26\x97"
+    STRINGS = {2:"USBDM HCS08,HCS12 Simulator", 3:"USBDM-SIMULATOR-0001"}
+
+    def __init__(self, chip="MC9S12DJ64", latency=0.000125, bytetime=0.00014, flashtimes=None, frametime=0.00002, buffersize=None):
+        times = dict(FLASH_TIMES)
+        if flashtimes:
+            times.update(flashtimes)
+        self.target = SimulatedTarget(PROFILES[chip], times)
+        self.chip = chip
+        self.latency = latency
+        self.bytetime = bytetime
+        self.frametime = frametime
+        self.maxpacketsize = 64
+        self.capabilities = self.CAPABILITIES
+        if buffersize != None:      # a probe firmware with another command buffer
+            self.capabilities = self.CAPABILITIES[:3] + buffersize.to_bytes(2,"big") + self.CAPABILITIES[5:]
+        self.buffersize = int.from_bytes(self.capabilities[3:5],"big")
+        self.clock = 0.0
+        self.transactions = 0
+        self.bytesout = 0
+        self.bytesin = 0
+        self.pending = None         # incomplete frame, continued in the next write
+        self.responses = []
+        self.turnaround = True      # the first frame after a read waits for the usb round trip
+        self.lastreturn = time.monotonic()
+
+    # virtual time, running on in real time between the transfers
+    def now(self):
+        return self.clock + (time.monotonic() - self.lastreturn)
+
+    def advance(self, duration):
+        now = time.monotonic()
+        self.clock += duration + (now - self.lastreturn)
+        self.target.run(self.clock)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        data = bytes(data)
+        self.bytesout += len(data)
+
+        if self.pending != None:
+            self.pending += data[1:]            # continuation frames start with a 0 byte
+        else:
+            self.pending = data
+        if len(self.pending) >= self.pending[0]:
+            frame = self.pending[:self.pending[0]]
+            self.pending = None
+            self.transactions += 1
+            self.responses.append(self.execute(frame))
+            self.turnaround = False
+
+        self.lastreturn = time.monotonic()
+        return len(data)
+
+    def read(self, size):
+        if len(self.responses) == 0:
+            raise ValueError("Error: simulator has no response pending")
+        self.advance(0.0)
+        response = self.responses.pop(0)[:size]
+        self.turnaround = True
+        self.bytesin += len(response)
+        self.lastreturn = time.monotonic()
+        return array("B", response)
+
+    def readinto(self, buffer):
+        response = self.read(len(buffer))
+        memoryview(buffer)[:len(response)] = response
+        return len(response)
+
+    def ctrlTransfer(self, requesttype, request, value, index, length):
+        return array("B", self.VERSION[:length])
+
+    def getString(self, index):
+        return self.STRINGS.get(index, "")
+
+    def reattach(self):
+        pass
+
+    def execute(self, frame):
+        command = frame[1]
+        target = self.target
+        # frames sent back to back only pay the transfer, not the round trip
+        latency = self.latency if self.turnaround else self.frametime
+        if command in (0x20, 0x21):
+            self.advance(latency + frame[3]*self.bytetime)
+        else:
+            self.advance(latency)
+
+        # frames and replies have to fit the command buffer, see Usbdm.setbuffersize
+        if (command == 0x20 and len(frame) > self.buffersize-1) or (command == 0x21 and frame[3]+1 > self.buffersize):
+            return b"\x01"
+        if command == 0x20:                                 # WRITE MEM
+            address = int.from_bytes(frame[4:8],"big")
+            data = frame[8:8+frame[3]]
+            idx = 0
+            while idx < len(data):
+                if (address+idx)%2 == 0 and idx+1 < len(data):
+                    target.writeword(address+idx, (data[idx]<<8)|data[idx+1])
+                    idx += 2
+                else:
+                    target.writebyte(address+idx, data[idx])
+                    idx += 1
+            return b"\x00"
+        elif command == 0x21:                               # READ MEM
+            address = int.from_bytes(frame[4:8],"big")
+            return b"\x00" + bytes(target.readbyte(address+idx) for idx in range(frame[3]))
+        elif command == 0x05:                               # GET CAPABILITIES
+            return self.capabilities
+        elif command == 0x04:                               # GET BDM STATUS
+            return b"\x00\x00\x4d"
+        elif command == 0x11:                               # GET SPEED
+            return b"\x00\x07\x7d"
+        elif command == 0x14:                               # READ BDM STATUS REG, BDMACT when halted
+            return b"\x00\x00\x00\x00" + (b"\x80" if target.running else b"\xc0")
+        elif command == 0x08:                               # CONTROL PINS
+            if frame[2:4] == b"\x00\x0a":
+                target.reset()
+            return b"\x00\x00\x0c"
+        elif command == 0x16:                               # RESET TARGET
+            target.reset()
+            return b"\x00"
+        elif command == 0x18:                               # GO
+            target.cpu.time = self.clock
+            target.running = True
+            return b"\x00"
+        elif command == 0x19:                               # HALT
+            target.running = False
+            return b"\x00"
+        elif command == 0x1a:                               # WRITE REG
+            target.cpu.setregister(frame[3], int.from_bytes(frame[6:8],"big"))
+            return b"\x00"
+        elif command == 0x1b:                               # READ REG
+            return b"\x00\x00\x00" + target.cpu.getregister(frame[3]).to_bytes(2,"big")
+        elif command in (0x01, 0x02, 0x06, 0x0f, 0x10, 0x15):  # SET TARGET, SET VDD, SET OPTIONS, CONNECT, SET SPEED, WRITE CONTROL REG
+            return b"\x00"
+        log("Unknown command %02X"%command, level=LOGL_VERBOSE, tag=self.NAME)
+        return b"\x01"
+
+    def report(self):
+        log("%d transactions, %d bytes out, %d bytes in, %.3f s"%(self.transactions, self.bytesout, self.bytesin, self.clock), level=LOGL_NORMAL, tag=self.NAME)
@@ -0,0 +1,119 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from helpers import *
+from usbdm import Usbdm
+from simulator import SimulatedTransport
+from chips.mc9s12dj64 import MC9S12DJ64
+
+
+def openchip(tmp_path):
+    chip = MC9S12DJ64(Usbdm(SimulatedTransport(MC9S12DJ64.NAME)))
+    chip.imagecache = str(tmp_path/"cache")
+    return chip
+
+def writes19(filename, records):
+    lines = ["S00600004844521B"]
+    for address, data in records:
+        body = bytes([len(data)+3, address>>8, address&0xFF])+data
+        lines.append("S1"+body.hex().upper()+"%02X"%(0xFF-sum(body)&0xFF))
+    lines.append("S9030000FC")
+    with open(filename, "w") as fout:
+        fout.write("\n".join(lines)+"\n")
+
+# A corrupt cache file is ignored, the image is loaded from the file and cached again
+def test_load_corrupt_cache(tmp_path):
+    fname = str(tmp_path/"image.s19")
+    writes19(fname, [(0xC000, bytes(range(16))), (0xC010, bytes(range(16, 32)))])
+    chip = openchip(tmp_path)
+    chip.load(fname)
+    cachename = imagecachename(chip.imagecache, fname, chip.NAME, None)
+    with open(cachename, "rb") as fin:
+        content = fin.read()
+    with open(cachename, "wb") as fout:
+        fout.write(content[:IMAGE_CACHE_HEADER.size+5])
+
+    chip = openchip(tmp_path)
+    chip.load(fname)
+    assert [(segment.address, bytes(segment.data)) for segment in chip.memory.segments] == [(0xC000, bytes(range(32)))]
+    with open(cachename, "rb") as fin:
+        assert fin.read() == content
+
+def imagechip(tmp_path, records):
+    chip = openchip(tmp_path)
+    chip.memory = Memory()
+    for address, data in records:
+        chip.memory.adddata(data, address)
+    chip.memorypages = pageassignments(chip.memory, chip.ChipPages)
+    return chip
+
+# Words whose wrong bits are still set are programmed again, the others need an erase
+def test_repairplan(tmp_path):
+    chip = imagechip(tmp_path, [(0xC000, b"\x12\x34\x56\x78\x9A\xBC\xDE\xF0")])
+    mismatches = [[0xC000, b"\x12", b"\xFF"],                 # erased byte
+                  [0xC003, b"\x78\x9A", b"\x7F\xFF"],         # across two words
+                  [0xC007, b"\xF0", b"\x00"]]                 # cleared bits
+    repairpages, unrepairable = chip.repairplan(mismatches)
+    assert unrepairable == 1
+    assert [(segment.address, bytes(segment.data)) for segment in repairpages[0x3F]] == [(0xC000, b"\x12\x34\x56\x78\x9A\xBC")]
+    assert repairpages[0x3C] == repairpages[0x3D] == repairpages[0x3E] == []
+
+# Bytes outside the image are erased flash
+def test_repairplan_outside_image(tmp_path):
+    chip = imagechip(tmp_path, [(0xC000, b"\x12\x34")])
+    repairpages, unrepairable = chip.repairplan([[0xC002, b"\xFF\xFF", b"\xFF\x00"]])
+    assert unrepairable == 1 and repairpages[0x3F] == []
+
+def cachedchip(tmp_path):
+    chip = openchip(tmp_path)
+    chip.usbdm.connect()
+    chip.setmemorycache(True)
+    return chip
+
+def transactions(chip, call):
+    before = chip.usbdm.transport.transactions
+    result = call()
+    return result, chip.usbdm.transport.transactions-before
+
+# RAM read twice while the target is halted goes over the wire once, writes drop the blocks they touch
+def test_readcached(tmp_path):
+    chip = cachedchip(tmp_path)
+    ram = chip.RAM_START+0x100
+    chip.writememory(ram, bytes(range(0x40)))
+    first, count = transactions(chip, lambda: chip.readmemory(ram+0x10, 0x20))
+    assert first == bytes(range(0x10, 0x30)) and count > 0
+    again, count = transactions(chip, lambda: chip.readmemory(ram+0x18, 0x8))
+    assert again == bytes(range(0x18, 0x20)) and count == 0
+    chip.writememory(ram+0x18, b"\xAA")
+    changed, count = transactions(chip, lambda: chip.readmemory(ram+0x18, 0x2))
+    assert changed == b"\xAA\x19" and count == 1
+
+# Registers are always read from the chip, a register write flushes the cache
+def test_readcached_volatile(tmp_path):
+    chip = cachedchip(tmp_path)
+    chip.readmemory(chip.RAM_START, 0x10)
+    for repeat in range(2):
+        assert transactions(chip, lambda: chip.readmemory(0x0030, 1))[1] == 1
+    chip.usbdm.writeBdmByte(0x0030, 0x3E)
+    assert len(chip.usbdm.memorycache.blocks) == 0
+
+# Nothing is cached while the target runs, halting resumes the cache
+def test_readcached_running(tmp_path):
+    chip = cachedchip(tmp_path)
+    cache = chip.usbdm.memorycache
+    chip.usbdm.setTargetRunning(True)
+    chip.readmemory(chip.RAM_START, 0x10)
+    assert len(cache.blocks) == 0
+    chip.usbdm.setTargetRunning(False)
+    chip.readmemory(chip.RAM_START, 0x10)
+    assert len(cache.blocks) == 1
+
+# The last block of the memory map isn't read past 0xFFFF
+def test_readcached_end_of_map(tmp_path):
+    chip = cachedchip(tmp_path)
+    reads = []
+    readblocks = chip.readblocks
+    chip.readblocks = lambda address, size: reads.append((address, size)) or readblocks(address, size)
+    top = chip.readmemory(0xFFE8, 0x18)
+    assert len(top) == 0x18 and all(address+size <= 0x10000 for address, size in reads)
+    assert transactions(chip, lambda: chip.readmemory(0xFFFE, 2))[1] == 0
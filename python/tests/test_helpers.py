@@ -0,0 +1,216 @@
+import io
+import os
+import sys
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from helpers import *
+
+
+# A segment padded at its start is merged into the one before it, the merged end is aligned again
+def test_align_merged_segment():
+    memory = Memory()
+    memory.adddata(bytes(17), 0xC00F)
+    memory.adddata(bytes(14), 0xC021)
+    memory.adddata(bytes(23), 0xC030)
+    memory.align()
+    assert [(segment.address, segment.getlength()) for segment in memory.segments] == [(0xC00E, 58)]
+    assert memory.starts == [0xC00E]
+    for segment in memory.segments:
+        assert segment.address%2 == 0 and segment.getlength()%2 == 0
+
+
+def cachedpages():
+    memory = Memory()
+    memory.adddata(bytes(range(32)), 0xC000)
+    memory.adddata(bytes(range(16)), 0x3C8000)
+    pages = {0x3C:[0x3C8000,0x3CBFFF], 0x3F:[0xC000,0xFFFF]}
+    return pageassignments(memory, pages), pages
+
+def test_image_cache_round_trip(tmp_path):
+    memorypages, pages = cachedpages()
+    cachename = str(tmp_path/"image.img")
+    writeimagecache(cachename, memorypages)
+    memory, readpages = readimagecache(cachename, pages)
+    assert [(segment.address, bytes(segment.data)) for segment in memory.segments] == [(0xC000, bytes(range(32))), (0x3C8000, bytes(range(16)))]
+    assert {page: [segment.address for segment in segments] for page, segments in readpages.items()} == {0x3C:[0x3C8000], 0x3F:[0xC000]}
+
+# A cut off cache file is not valid, wherever it ends
+def test_image_cache_truncated(tmp_path):
+    memorypages, pages = cachedpages()
+    content = packimage(memorypages)
+    cachename = str(tmp_path/"image.img")
+    for length in range(len(content)):
+        with open(cachename, "wb") as fout:
+            fout.write(content[:length])
+        assert readimagecache(cachename, pages) == None
+
+def test_image_cache_other_version(tmp_path):
+    memorypages, pages = cachedpages()
+    content = bytearray(packimage(memorypages))
+    IMAGE_CACHE_HEADER.pack_into(content, 0, IMAGE_CACHE_MAGIC, IMAGE_CACHE_VERSION-1, 2)
+    assert unpackimage(bytes(content), pages) == None
+    assert unpackimage(b"garbage"*4, pages) == None
+
+
+DZ128_PAGES = {0:[0x2180,0x217F], 1:[0x4000,0x7FFF], 2:[0x8000,0xBFFF], 3:[0xC000,0xFFFF], 4:[0x48000,0x4BFFF]}
+
+def hexrecord(recordtype, address, data):
+    record = bytes([len(data)])+address.to_bytes(2, "big")+bytes([recordtype])+data
+    return b":"+(record+bytes([-sum(record)&0xFF])).hex().upper().encode()+b"\n"
+
+def segments(memory):
+    return [(segment.address, bytes(segment.data)) for segment in memory.segments]
+
+def test_readhex_records():
+    content = (hexrecord(0x00, 0xC000, b"\x01\x02\x03\x04")
+               + hexrecord(0x00, 0xC004, b"\x05\x06")
+               + hexrecord(0x04, 0x0000, b"\x00\x3C")        # extended linear address
+               + hexrecord(0x00, 0x8000, b"\xAA\xBB")
+               + hexrecord(0x02, 0x0000, b"\x10\x00")        # extended segment address
+               + hexrecord(0x00, 0x0010, b"\xCC")
+               + hexrecord(0x05, 0x0000, b"\x00\x00\xC0\x00")
+               + hexrecord(0x01, 0x0000, b"")
+               + hexrecord(0x00, 0xD000, b"\xDD"))          # after the end of file record
+    memory = readhex(io.BytesIO(content), Memory())
+    assert segments(memory) == [(0xC000, b"\x01\x02\x03\x04\x05\x06"), (0x10010, b"\xCC"), (0x3C8000, b"\xAA\xBB")]
+
+def test_readhex_errors():
+    good = hexrecord(0x00, 0xC000, b"\x01\x02")
+    with pytest.raises(ValueError, match="checksum"):
+        readhex(io.BytesIO(good[:-3]+b"00\n"), Memory())
+    with pytest.raises(ValueError, match="record length"):
+        readhex(io.BytesIO(b":0300000001FE\n"), Memory())
+    with pytest.raises(ValueError, match="bad format"):
+        readhex(io.BytesIO(b"S1030000FC\n"), Memory())
+
+# Erased runs of 32 bytes and more split the data, shorter ones are kept
+def test_readbin_gaps():
+    content = b"\x01"*4 + b"\xff"*31 + b"\x02" + b"\xff"*32 + b"\x03"
+    memory = readbin(io.BytesIO(content), Memory(), DZ128_PAGES, 0x4000*3)
+    assert segments(memory) == [(0xC000, b"\x01"*4 + b"\xff"*31 + b"\x02"), (0xC000+68, b"\x03")]
+
+# The linear address ppage*0x4000+offset is placed in the window of the page
+def test_readbin_placement():
+    content = b"\x11"*0x4000 + b"\x22"*0x10
+    memory = readbin(io.BytesIO(content), Memory(), DZ128_PAGES, 0x4000*3)
+    assert segments(memory) == [(0xC000, b"\x11"*0x4000), (0x48000, b"\x22"*0x10)]
+    memory = readbin(io.BytesIO(b"\x33"*4), Memory(), DZ128_PAGES, 0x4000*4+0x100)
+    assert segments(memory) == [(0x48100, b"\x33"*4)]
+
+def test_readbin_outside_pages():
+    with pytest.raises(ValueError, match="outside of the flash pages"):
+        readbin(io.BytesIO(b"\x11"*0x10), Memory(), DZ128_PAGES, 0x4000*5)
+    with pytest.raises(ValueError, match="isn't a whole page"):
+        readbin(io.BytesIO(b"\x11"*0x10), Memory(), DZ128_PAGES, 0)
+    # erased data isn't placed, it doesn't need a page
+    assert segments(readbin(io.BytesIO(b"\xff"*0x10), Memory(), DZ128_PAGES, 0)) == []
+
+# A bin starts at the lowest page with a whole window, page 0 of the DZ128 has none
+def test_loadprogramfile_bin_base(tmp_path):
+    fname = str(tmp_path/"image.bin")
+    with open(fname, "wb") as fout:
+        fout.write(b"\x44"*0x10)
+    assert binpages(DZ128_PAGES) == [1, 2, 3, 4]
+    assert segments(loadprogramfile(fname, DZ128_PAGES)) == [(0x4000, b"\x44"*0x10)]
+    assert segments(loadprogramfile(fname, DZ128_PAGES, 0x4000*2+0x20)) == [(0x8020, b"\x44"*0x10)]
+    with pytest.raises(ValueError, match="needs a base"):
+        loadprogramfile(fname, {0:[0x2180,0x3FFF]})
+
+# A segment across two windows is split into parts that can be changed, the original isn't pinned
+def test_pageassignments_split():
+    memory = Memory()
+    memory.adddata(bytes(range(0x20)), 0x7FF0)
+    original = memory.segments[0].data
+    memorypages = pageassignments(memory, DZ128_PAGES)
+    assert segments(memory) == [(0x7FF0, bytes(range(0x10))), (0x8000, bytes(range(0x10, 0x20)))]
+    assert memorypages[1] == [memory.segments[0]] and memorypages[2] == [memory.segments[1]]
+    original += b"\x00"
+
+    memory.adddata(b"\xAA", 0x7FEF)
+    memory.adddata(b"\xBB\xBB", 0x8004)
+    memory.align()
+    memory.splitsegment(0, 0x7FF7)
+    assert segments(memory) == [(0x7FEE, b"\xff\xaa"+bytes(range(8))), (0x7FF8, bytes(range(8, 0x14))+b"\xbb\xbb"+bytes(range(0x16, 0x20)))]
+
+# Segments over a memoryview are copied before they are changed, the viewed buffer stays as it is
+def test_segment_view():
+    content = bytearray(range(8))
+    segment = Segment(0x100, memoryview(content)[2:6])
+    segment.append(b"\x10")
+    segment.prepend(b"\x20")
+    assert segment.truncate() == 0x20
+    assert bytes(segment.data) == b"\x02\x03\x04\x05\x10" and segment.address == 0x101
+    assert content == bytearray(range(8))
+    content += b"\x00"
+
+    memory = Memory()
+    memory.segments = [Segment(0x200, memoryview(bytes(4)))]
+    memory.starts = [0x200]
+    memory.adddata(b"\x01", 0x201)
+    memory.adddata(b"\x02", 0x204)
+    assert segments(memory) == [(0x200, b"\x00\x01\x00\x00\x02")]
+
+# Segments go to the page of their window, in address order per page
+def test_pageassignments_pages():
+    memory = Memory()
+    memory.adddata(b"\x01"*4, 0xC000)
+    memory.adddata(b"\x02"*4, 0x48010)
+    memory.adddata(b"\x03"*4, 0x4000)
+    memory.adddata(b"\x04"*4, 0xC100)
+    memorypages = pageassignments(memory, DZ128_PAGES)
+    assert {page: [segment.address for segment in pagesegments] for page, pagesegments in memorypages.items()} == \
+           {0:[], 1:[0x4000], 2:[], 3:[0xC000, 0xC100], 4:[0x48010]}
+    memory.adddata(b"\x05", 0x2000)
+    with pytest.raises(ValueError, match="2000 is outside of the pages"):
+        pageassignments(memory, DZ128_PAGES)
+
+# Both compare engines find the same ranges, touching ranges of several blocks are joined
+@pytest.mark.parametrize("usenumpy", [False, True])
+def test_comparememory(monkeypatch, usenumpy):
+    import helpers
+    if usenumpy and helpers.numpy == None:
+        pytest.skip("numpy isn't installed")
+    if not usenumpy:
+        monkeypatch.setattr(helpers, "numpy", None)
+    expected = bytes(range(16))
+    read = bytearray(expected)
+    assert comparememory(read, expected, 0x100) == []
+    read[2:4] = b"\xff\xff"
+    read[15] = 0
+    mismatches = comparememory(read, expected, 0x100)
+    assert mismatches == [[0x102, b"\x02\x03", b"\xff\xff"], [0x10F, b"\x0f", b"\x00"]]
+    # the next block continues the last range
+    comparememory(b"\x00\x11", b"\x10\x11", 0x110, mismatches)
+    assert mismatches == [[0x102, b"\x02\x03", b"\xff\xff"], [0x10F, b"\x0f\x10", b"\x00\x00"]]
+    assert differences(bytes(4), bytes(4)) == []
+
+def test_memorycache_lru():
+    cache = MemoryCache([[0x0000, 0x03FF]], maxblocks=2)
+    cache.put(0x900, b"\x01"*0x90)
+    cache.put(0x990, b"\x02"*0x90)
+    assert cache.get(0x900) == b"\x01"*0x90
+    cache.put(0xA20, b"\x03"*0x90)
+    assert cache.get(0x990) == None
+    assert cache.get(0x900) != None and cache.get(0xA20) != None
+    assert (cache.hits, cache.misses) == (3, 1)
+
+def test_memorycache_invalidate():
+    cache = MemoryCache([[0x0000, 0x03FF]])
+    for address in (0x900, 0x990, 0xA20):
+        cache.put(address, bytes(0x90))
+    cache.invalidate(0x98F, 2)
+    assert list(cache.blocks) == [0xA20]
+    cache.invalidate(0x3FF, 1)
+    assert list(cache.blocks) == []
+    assert cache.isvolatile(0x3F0, 0x90) and not cache.isvolatile(0x400, 0x90)
+
+# Nothing is cached while the target runs
+def test_memorycache_suspended():
+    cache = MemoryCache([])
+    cache.suspended = True
+    cache.put(0x900, bytes(0x90))
+    assert cache.get(0x900) == None
+    cache.suspended = False
+    cache.put(0x900, bytes(0x90))
+    cache.flush()
+    assert cache.get(0x900) == None
@@ -0,0 +1,107 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from array import array
+from helpers import *
+from usbdm import Usbdm
+
+
+# Answers the reads with the queued replies, records the order of the writes and reads
+class ScriptedTransport():
+    def __init__(self, replies, pipelinedepth=None):
+        self.maxpacketsize = 64
+        self.replies = list(replies)
+        self.events = []
+        if pipelinedepth != None:
+            self.pipelinedepth = pipelinedepth
+
+    def write(self, data):
+        self.events.append(("write", bytes(data)))
+        return len(data)
+
+    def read(self, size):
+        self.events.append(("read", size))
+        return array("B", self.replies.pop(0))
+
+    def readinto(self, buffer):
+        reply = self.read(len(buffer))
+        memoryview(buffer)[:len(reply)] = reply
+        return len(reply)
+
+    def order(self):
+        return "".join("w" if kind == "write" else "r" for kind, value in self.events)
+
+
+# The statuses of a batch belong to the commands in the order they were queued
+def test_batch_statuses():
+    transport = ScriptedTransport([b"\x00", b"\x11", b"\x00"])
+    usbdm = Usbdm(transport)
+    usbdm.beginBatch()
+    assert usbdm.writeBdmByte(0x100, 1) == 0
+    assert usbdm.writeBdmByte(0x101, 2) == 0
+    assert usbdm.writeBdmWord(0x102, 0x0304) == 0
+    assert transport.events == []
+    results = usbdm.endBatch()
+    assert [status for debugline, status in results] == [0x00, 0x11, 0x00]
+    assert transport.order() == "wwwrrr"
+    assert [value[1] for kind, value in transport.events if kind == "write"] == [0x20, 0x20, 0x20]
+
+# A call expecting data collects the statuses of the queued commands first
+def test_batch_flushed_before_read():
+    transport = ScriptedTransport([b"\x00", b"\x00", b"\x00\x5A", b"\x00"])
+    usbdm = Usbdm(transport)
+    usbdm.beginBatch()
+    usbdm.writeBdmByte(0x100, 1)
+    usbdm.writeBdmByte(0x101, 2)
+    assert list(usbdm.readBdmByte(0x100)) == [0x00, 0x5A]
+    usbdm.writeBdmByte(0x102, 3)
+    results = usbdm.endBatch()
+    assert transport.order() == "wwrrwrwr"
+    assert [status for debugline, status in results] == [0, 0, 0]
+
+# Nested batches are sent when the outermost one ends
+def test_batch_nested():
+    transport = ScriptedTransport([b"\x00", b"\x00"])
+    usbdm = Usbdm(transport)
+    usbdm.beginBatch()
+    usbdm.writeBdmByte(0x100, 1)
+    usbdm.beginBatch()
+    usbdm.writeBdmByte(0x101, 2)
+    assert usbdm.endBatch() == []
+    assert transport.events == []
+    assert len(usbdm.endBatch()) == 2
+
+# No more than pipelinedepth frames wait for their status, the transport sets the depth
+def test_pipeline_depth():
+    transport = ScriptedTransport([b"\x00"]*5, pipelinedepth=2)
+    usbdm = Usbdm(transport)
+    assert usbdm.pipelinedepth == 2
+    usbdm.beginBatch()
+    for address in range(5):
+        usbdm.writeBdmByte(0x100+address, address)
+    usbdm.endBatch()
+    assert transport.order() == "wwrrwwrrwr"
+    assert Usbdm(ScriptedTransport([])).pipelinedepth == Usbdm.PIPELINE_DEPTH
+
+# A block larger than the first packet continues in a packet starting with 0
+def test_write_block_packets():
+    transport = ScriptedTransport([b"\x00"])
+    usbdm = Usbdm(transport)
+    data = bytes(range(100))
+    assert usbdm.writeBdmBlock(0x4000, data) == 0
+    first, second = [value for kind, value in transport.events if kind == "write"]
+    assert len(first) == usbdm.firstpacketsize
+    assert first[:8] == bytes([108, 0x20, 0x01, 100, 0x00, 0x00, 0x40, 0x00])
+    assert second[0] == 0 and first[8:]+second[1:] == data
+    assert usbdm.writeBdmBlock(0x4000, bytes(usbdm.maxwritesize+1)) == 0xFF
+
+# The command buffer reported by the probe sets the block sizes
+def test_capabilities():
+    usbdm = Usbdm(ScriptedTransport([]))
+    usbdm.parsecapabilities(bytes.fromhex("0000740101040c01"))
+    assert usbdm.commandbuffersize == 0x101
+    assert usbdm.maxreadsize == Usbdm.MAX_FRAME_SIZE and usbdm.maxwritesize == Usbdm.MAX_FRAME_SIZE-8
+    assert usbdm.firmwareversion == (4, 12, 1)
+    usbdm = Usbdm(ScriptedTransport([]))
+    usbdm.parsecapabilities(bytes.fromhex("01"))
+    assert usbdm.maxreadsize == Usbdm.COMMAND_BUFFER_SIZE-1 and usbdm.maxwritesize == Usbdm.COMMAND_BUFFER_SIZE-9
@@ -7,39 +7,48 @@ import usb.core
 import usb.util
 import struct
 import time
+from array import array
 from helpers import *
 
 
 
-# General interface for usbdm
-# each Command is at least 2 Bytes long
-# tx-command is <length><command><data>
-# rx-command is <status>
-#               <length><data>
-# First one is a placedholder and is reused as status
-class Usbdm():
-    NAME= "USBDM"
-    USBDM_SPEED     = 0x077f   # approx. 4 Mhz, not used
-    def __init__(self):
+# Transport of the usbdm frames over libusb
+# A transport delivers whole frames: write(<frame>), read(<size>) -> <status><data>, readinto(<array>) -> <size>
+# maxpacketsize is the size of a bulk packet of the out endpoint
+# Other transports can be handed to Usbdm, e.g. the simulator in simulator.py
+class LibusbTransport():
+    NAME = "LIBUSB"
+    VENDOR = 0x16D0
+    PRODUCT = 0x06A5
+    # bus and address select one of several probes, see findprobes
+    def __init__(self, dev=None, bus=None, address=None):
         self.inEndpoint = None
         self.outEndpoint = None
-        self.dev = None
-        self.find()
+        self.maxpacketsize = 64
+        # Frames sent before their status is read. The firmware has a single command buffer, whether
+        # it takes further frames while a reply is pending isn't validated on hardware yet: one at a time
+        self.pipelinedepth = 1
+        self.dev = dev
+        if self.dev is None:
+            self.find(bus, address)
         self.reinit()
 
         # specific .dll
         # backend = usb.backend.libusb1.get_backend(find_library=lambda x: "/usr/lib/libusb-1.0.so")
         # dev     = usb.core.find(..., backend=backend)
 
-    def find(self):
+    def find(self, bus=None, address=None):
         #Unknown Phenomenon, Device registers with another VID and PID and does not have an OUT Endpoint
         #Could this be failsafe configuration?
         #usb.core.find(idVendor=0x15A2, idProduct=0x0038)#
-        self.dev  = usb.core.find(idVendor=0x16D0, idProduct=0x06A5)
+        if bus is None:
+            self.dev  = usb.core.find(idVendor=LibusbTransport.VENDOR, idProduct=LibusbTransport.PRODUCT)
+        else:
+            self.dev  = usb.core.find(idVendor=LibusbTransport.VENDOR, idProduct=LibusbTransport.PRODUCT, bus=bus, address=address)
         if self.dev is None:
             raise ValueError('Error: Device not found')
         else:
-            log(self.dev.manufacturer, debugline="Manufacturer:", level=LOGL_NORMAL, tag=Usbdm.NAME)
+            log(self.dev.manufacturer, debugline="Manufacturer:", level=LOGL_NORMAL, tag=self.NAME)
 
     # set the active configuration. With no arguments, the first
     # configuration will be the active one
@@ -59,6 +68,7 @@ class Usbdm():
 
         if self.outEndpoint is None or self.inEndpoint is None:
             raise ValueError('Error: Endpoints not found for the interface')
+        self.maxpacketsize = self.outEndpoint.wMaxPacketSize
 
         readback = self.dev.ctrl_transfer(0xC0, 0x0C, 0x100, 0, 10)   # URB control transfer,  to get the HW and SW versions
         log(readback, level=LOGL_DEBUG ,conv="hex",tag="Hw and Sw")
@@ -66,122 +76,346 @@ class Usbdm():
         if readback[0]:
             raise ValueError('Error: Control Endpoint failed')
 
+    def write(self, data):
+        return self.outEndpoint.write(data)
+
+    def read(self, size):
+        return self.inEndpoint.read(size)
+
+    # Read a frame into the array, returns the number of bytes received
+    def readinto(self, buffer):
+        return self.inEndpoint.read(buffer)
+
+    def ctrlTransfer(self, requesttype, request, value, index, length):
+        return self.dev.ctrl_transfer(requesttype, request, value, index, length)
+
+    def getString(self, index):
+        return usb.util.get_string(self.dev, index)
+
+    # try to reclaim the interface
+    def reattach(self):
+        reattach = False
+        if self.dev.is_kernel_driver_active(0):
+            reattach = True
+            self.dev.detach_kernel_driver(0)
+
+        usb.util.dispose_resources(self.dev)
+
+        # It may raise USBError if there's e.g. no kernel driver loaded at all
+        if reattach:
+            self.dev.attach_kernel_driver(0)
+
+
+# Traces the frames of another transport: every frame and every reply is an event with the
+# opcode, the size and the time spent in the call. Replies are matched to the frames in order and
+# carry the status byte and the latency from the end of the frame's write
+class TracingTransport():
+    NAME = "TRACE"
+    OPCODES = {0x01:"SET TARGET", 0x02:"SET VDD", 0x04:"GET BDM STATUS", 0x05:"GET CAPABILITIES", 0x06:"SET OPTIONS", 0x08:"CONTROL PINS",
+               0x0F:"CONNECT", 0x10:"SET SPEED", 0x11:"GET SPEED", 0x14:"READ BDM STATUS REG", 0x15:"WRITE CONTROL REG",
+               0x16:"RESET TARGET", 0x18:"GO", 0x19:"HALT", 0x1A:"WRITE REG", 0x1B:"READ REG", 0x20:"WRITE MEM", 0x21:"READ MEM"}
+    def __init__(self, transport, tracer):
+        self.transport = transport
+        self.tracer = tracer
+        self.remaining = 0                  # bytes of the frame still to come in continuation packets
+        self.outstanding = []               # [name, end of write] of the frames waiting for their reply
+
+    # everything else, e.g. maxpacketsize or report() of the simulator, is the transport's
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def write(self, data):
+        start = self.tracer.now()
+        written = self.transport.write(data)
+        end = self.tracer.now()
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        if self.remaining > 0:
+            # continuation packets start with a 0 byte
+            self.remaining -= len(data)-1
+            self.outstanding[-1][1] = end
+            self.tracer.complete("continuation", "usb", start, end, {"bytes":len(data)})
+        else:
+            self.remaining = data[0]-len(data)
+            name = self.OPCODES.get(data[1], "%02X"%data[1])
+            self.outstanding.append([name, end])
+            self.tracer.complete(name, "usb", start, end, {"opcode":"%02X"%data[1], "bytes":data[0]})
+        return written
+
+    def reply(self, start, response):
+        end = self.tracer.now()
+        name, written = self.outstanding.pop(0) if self.outstanding else ["?", start]
+        self.tracer.complete("reply "+name, "usb", start, end, {"bytes":len(response), "status":response[0] if len(response) else None,
+                             "latency_us":round(end-written)})
+
+    def read(self, size):
+        start = self.tracer.now()
+        response = self.transport.read(size)
+        self.reply(start, response)
+        return response
+
+    def readinto(self, buffer):
+        start = self.tracer.now()
+        received = self.transport.readinto(buffer)
+        self.reply(start, memoryview(buffer)[:received])
+        return received
+
+    def ctrlTransfer(self, requesttype, request, value, index, length):
+        with self.tracer.span("control %02X"%request, "usb", value="%04X"%value):
+            return self.transport.ctrlTransfer(requesttype, request, value, index, length)
+
+    def getString(self, index):
+        with self.tracer.span("string %d"%index, "usb"):
+            return self.transport.getString(index)
+
+
+# [bus, address] of every connected probe
+def findprobes():
+    return [[dev.bus, dev.address] for dev in usb.core.find(find_all=True, idVendor=LibusbTransport.VENDOR, idProduct=LibusbTransport.PRODUCT)]
+
+
+# General interface for usbdm
+# each Command is at least 2 Bytes long
+# tx-command is <length><command><data>
+# rx-command is <status>
+#               <length><data>
+# First one is a placedholder and is reused as status
+class Usbdm():
+    NAME= "USBDM"
+    USBDM_SPEED     = 0x077f   # approx. 4 Mhz, not used
+    PIPELINE_DEPTH  = 8        # frames sent before their status is collected, unless the transport has its own depth
+    BDMSTS_BDMACT   = 0x40     # BDM status register: target is in background mode
+    COMMAND_BUFFER_SIZE = 0x91 # command buffer of the probe, if the firmware doesn't report it
+    MAX_FRAME_SIZE  = 0xFF     # frame and block lengths are a single byte
+    def __init__(self, transport=None):
+        if transport is None:
+            transport = LibusbTransport()
+        self.transport = transport
+        self.batch = None                       # queued [debugline, packets] while batching
+        self.batchresults = []                  # [debugline, status] of the flushed commands
+        self.batchnesting = 0
+        self.pipelinedepth = getattr(transport, "pipelinedepth", Usbdm.PIPELINE_DEPTH)
+        self.framebuffers = []                  # frames are assembled here, one per queued frame
+        self.capabilities = 0
+        self.firmwareversion = None             # (major, minor, micro)
+        self.memorycache = None                 # MemoryCache of the target memory, None disables it
+        self.setbuffersize(Usbdm.COMMAND_BUFFER_SIZE)
+
+    # The command buffer holds the whole frame of a write and the status and data of a read
+    # The first usb packet of a frame leaves 2 bytes free, the rest goes in a continuation packet
+    def setbuffersize(self, size):
+        self.commandbuffersize = size
+        self.maxreadsize = min(size-1, Usbdm.MAX_FRAME_SIZE)
+        self.maxwritesize = min(size-1, Usbdm.MAX_FRAME_SIZE)-8
+        self.firstpacketsize = self.transport.maxpacketsize-2
+
+    # Commands only answering with a status can be batched:
+    #   beginBatch(), writeBdmByte(..), writeBdmWord(..), ..., endBatch() -> [[debugline, status], ...]
+    # The frames are sent back to back and the statuses collected afterwards, so the run costs
+    # one usb round trip per pipelinedepth commands. Inside a batch those calls return 0.
+    # Batches nest, the outermost endBatch() returns the results.
+    def beginBatch(self):
+        if self.batch is None:
+            self.batch = []
+            self.batchresults = []
+        self.batchnesting += 1
+
+    def endBatch(self):
+        self.batchnesting -= 1
+        if self.batchnesting > 0:
+            return []
+        self.flushBatch()
+        self.batch = None
+        results = self.batchresults
+        self.batchresults = []
+        for idx, (debugline, status) in enumerate(results):
+            if status:
+                log("Batch command %d (%s) failed with status %02X"%(idx, debugline, status), level=LOGL_NORMAL, tag=Usbdm.NAME)
+        return results
+
+    # Replies arrive in order: calls expecting data collect the batched statuses first
+    def flushBatch(self):
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        for debugline, packets in batch:
+            for packet in packets:
+                self.transport.write(packet)
+        for debugline, packets in batch:
+            status = self.transport.read(1)
+            log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline=debugline)
+            self.batchresults.append([debugline, status[0]])
+
+    # Buffer for the next frame, a queued frame keeps its buffer until the batch is flushed
+    # The frame leaves a byte free for the 0 starting a continuation packet
+    def framebuffer(self):
+        slot = len(self.batch) if self.batch != None else 0
+        while slot >= len(self.framebuffers):
+            self.framebuffers.append(bytearray(Usbdm.MAX_FRAME_SIZE+1))
+        return self.framebuffers[slot]
+
+    # Send a command answering with a status only, queued when batching
+    def command(self, debugline, *packets):
+        if self.batch != None:
+            self.batch.append([debugline, packets])
+            if len(self.batch) >= self.pipelinedepth:
+                self.flushBatch()
+            return 0
+
+        for packet in packets:
+            self.transport.write(packet)
+        status = self.transport.read(1)
+        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline=debugline)
+        return status[0]
+
+    # Drop the cached memory a write changes
+    def invalidateCache(self, address, size):
+        if self.memorycache != None:
+            self.memorycache.invalidate(address, size)
+
+    # Target memory is only cached while the target is halted
+    def setTargetRunning(self, running):
+        if self.memorycache != None:
+            self.memorycache.flush()
+            self.memorycache.suspended = running
 
     # Some of those set the target, don't know which ones yet
     def openBdm(self):
+        self.flushBatch()
         # Get String Descriptor Index 2
-        string = usb.util.get_string(self.dev, 2)           # Device String 1
+        string = self.transport.getString(2)           # Device String 1
         log(string, debugline = "Device String1:", level=LOGL_DEBUG, tag=Usbdm.NAME)
 
         # Get String Descriptor Index 3
-        string = usb.util.get_string(self.dev, 3)           # Device String 2
+        string = self.transport.getString(3)           # Device String 2
         log(string, debugline = "Device String2:", level=LOGL_DEBUG,tag=Usbdm.NAME)
 
-        readback = self.dev.ctrl_transfer(0xC0, 0x0C, 0x101, 0, 10)   # URB control transfer, to get the HW and SW versions
+        readback = self.transport.ctrlTransfer(0xC0, 0x0C, 0x101, 0, 10)   # URB control transfer, to get the HW and SW versions
         log(readback,conv = "hex", debugline = "URB Control Transfer:", level=LOGL_DEBUG,tag=Usbdm.NAME)
+        if len(readback) > 1:
+            self.firmwareversion = (readback[1]>>4, readback[1]&0x0F, 0)
 
-        self.outEndpoint.write("\x02\x05")                  # GET CAPABILITIES
-        readback = self.inEndpoint.read(8)
+        self.transport.write("\x02\x05")                  # GET CAPABILITIES
+        readback = self.transport.read(8)
 
         log(readback,conv = "hex", debugline = "Get Capabilities:", level=LOGL_DEBUG, tag=Usbdm.NAME)
+        self.parsecapabilities(readback)
 
         # Write something and read status
         # HCS08 uses 08 06 00 00 ff 02 30 01
         # HCS08 uses 08 06 00 00 ff 02 18 01
-        #self.outEndpoint.write(b"\x08\x06\x00\x00\xff\x02\x18\x01") # SET OPTIONS(SBDFRaddr,autoReconnect,altbdmclock,[cyclevddonreset,cycleonconnect,leavepowered,guessspeedd,useresetsignal])
+        #self.transport.write(b"\x08\x06\x00\x00\xff\x02\x18\x01") # SET OPTIONS(SBDFRaddr,autoReconnect,altbdmclock,[cyclevddonreset,cycleonconnect,leavepowered,guessspeedd,useresetsignal])
 
-        self.outEndpoint.write(b"\x06\x06\x18\x00\xff\x02") # SET OPTIONS(SBDFRaddr,autoReconnect,altbdmclock,[cyclevddonreset,cycleonconnect,leavepowered,guessspeedd,useresetsignal])
+        self.transport.write(b"\x06\x06\x18\x00\xff\x02") # SET OPTIONS(SBDFRaddr,autoReconnect,altbdmclock,[cyclevddonreset,cycleonconnect,leavepowered,guessspeedd,useresetsignal])
         # alternative with autoreconnect
-        #elf.outEndpoint.write(b"\x06\x06\x18\x01\xff\x02")
+        #elf.transport.write(b"\x06\x06\x18\x01\xff\x02")
 
-        readback = self.inEndpoint.read(1)
+        readback = self.transport.read(1)
         log(readback,conv = "hex", debugline = "Set Options:", level=LOGL_DEBUG,tag=Usbdm.NAME)
 
         # Write some more
-        self.outEndpoint.write(b"\x02\x04")                 # GET BDM STATUS
-        status = self.inEndpoint.read(3)
+        self.transport.write(b"\x02\x04")                 # GET BDM STATUS
+        status = self.transport.read(3)
         log(readback, conv = "hex", debugline = "Bdm Status:",level=LOGL_DEBUG, tag=Usbdm.NAME)
 
-        readback = self.dev.ctrl_transfer(0xC0, 0x0C, 0x144, 0, 10)   # URB control transfer, what for ?
+        readback = self.transport.ctrlTransfer(0xC0, 0x0C, 0x144, 0, 10)   # URB control transfer, what for ?
         log(readback,level=LOGL_DEBUG,debugline = "URB Control Transfer:",conv="hex", tag=Usbdm.NAME)
         return status[0]
 
+    # <status><capabilities:2><command buffer size:2><major><minor><micro>
+    # Firmware before 4.0 only reports the capabilities, its buffer is the default one
+    def parsecapabilities(self, readback):
+        if len(readback) < 3 or readback[0]:
+            log("No capabilities reported, using %d byte blocks"%self.maxwritesize, level=LOGL_VERBOSE, tag=Usbdm.NAME)
+            return
+        self.capabilities = (readback[1]<<8)|readback[2]
+        if len(readback) >= 5 and (self.firmwareversion == None or self.firmwareversion[0] >= 4):
+            self.setbuffersize((readback[3]<<8)|readback[4])
+        if len(readback) >= 8:
+            self.firmwareversion = (readback[5], readback[6], readback[7])
+        log("Firmware %s, capabilities %04X, blocks of %d bytes written, %d bytes read"%(
+            ".".join(str(v) for v in self.firmwareversion or ()), self.capabilities, self.maxwritesize, self.maxreadsize), level=LOGL_VERBOSE, tag=Usbdm.NAME)
+
     # try to reclaim the interface
     def reattach(self):
-        reattach = False
-        if self.dev.is_kernel_driver_active(0):
-            reattach = True
-            self.dev.detach_kernel_driver(0)
-
-        usb.util.dispose_resources(self.dev)
-
-        # It may raise USBError if there's e.g. no kernel driver loaded at all
-        if reattach:
-            self.dev.attach_kernel_driver(0)
+        self.transport.reattach()
 
     def closeBdm(self):
-        self.outEndpoint.write(b"\x03\x01\xff")     # SET TARGET 0xFF
-        status = self.inEndpoint.read(1)
+        self.flushBatch()
+        self.setTargetRunning(True)
+        self.transport.write(b"\x03\x01\xff")     # SET TARGET 0xFF
+        status = self.transport.read(1)
         log(status, debugline = "Unset Target:", level=LOGL_DEBUG, conv="hex",tag=Usbdm.NAME)
 
-        self.outEndpoint.write(b"\x04\x02\x00\x00") # SET VDD 0
-        status = self.inEndpoint.read(1)
+        self.transport.write(b"\x04\x02\x00\x00") # SET VDD 0
+        status = self.transport.read(1)
         log(status, debugline = "Unset Vdd:", level=LOGL_DEBUG, conv="hex", tag=Usbdm.NAME)
 
         return status[0]
 
     def connect(self):
-        self.outEndpoint.write(b"\x02\x11") # GET SPEED
-        readback = self.inEndpoint.read(3)  # 0x0 0x7 0x7f  or 0x0 0x7 0x7d or 03 31
+        self.flushBatch()
+        self.setTargetRunning(False)
+        self.transport.write(b"\x02\x11") # GET SPEED
+        readback = self.transport.read(3)  # 0x0 0x7 0x7f  or 0x0 0x7 0x7d or 03 31
         log(readback, debugline = "Speed:",level=LOGL_DEBUG, conv="hex", tag=Usbdm.NAME)
 
         # set speed here
         if readback[1] == 0x00 or readback[2] == 0x00:
             pass
-            #self.outEndpoint.write(b"\x04\x10\x07\x7f") # SET SPEED
-            #readback = self.inEndpoint.read(1)    # status(00), returns 12 if target is secured. Can't connect
+            #self.transport.write(b"\x04\x10\x07\x7f") # SET SPEED
+            #readback = self.transport.read(1)    # status(00), returns 12 if target is secured. Can't connect
             #log(readback, debugline = "Setting Speed:", level=LOGL_DEBUG, conv="hex", tag=Usbdm.NAME)
 
-        self.outEndpoint.write(b"\x02\x0f") # CONNECT
-        readback = self.inEndpoint.read(1)    # status(00), returns 12 if target is secured. Can't connect
+        self.transport.write(b"\x02\x0f") # CONNECT
+        readback = self.transport.read(1)    # status(00), returns 12 if target is secured. Can't connect
         log(readback, debugline = "Connect:", level=LOGL_DEBUG, conv="hex", tag=Usbdm.NAME)
 
-        self.outEndpoint.write(b"\x02\x04") # GET BDM STATUS
-        readback = self.inEndpoint.read(3)  # 0x0 0x0 0x5d
+        self.transport.write(b"\x02\x04") # GET BDM STATUS
+        readback = self.transport.read(3)  # 0x0 0x0 0x5d
         log(readback, debugline = "Bdm Status:",level=LOGL_DEBUG, conv="hex", tag=Usbdm.NAME)
 
         return readback[0]
 
     def getBdmStatus(self):
-        self.outEndpoint.write(b"\x02\x14") # READ BDM STATUS REG
-        readback = self.inEndpoint.read(5)  # 0x0 0x0 0x0 0x0 0xc0
+        self.flushBatch()
+        self.transport.write(b"\x02\x14") # READ BDM STATUS REG
+        readback = self.transport.read(5)  # 0x0 0x0 0x0 0x0 0xc0
         log(readback, debugline = "Bdm Status Reg:", level=LOGL_DEBUG, conv="hex",tag=Usbdm.NAME)
 
-        self.outEndpoint.write(b"\x02\x04") # GET BDM STATUS
-        bdmstatus = self.inEndpoint.read(3)  # 0x0 0x0 0x4d
+        self.transport.write(b"\x02\x04") # GET BDM STATUS
+        bdmstatus = self.transport.read(3)  # 0x0 0x0 0x4d
         log(bdmstatus, debugline = "Bdm Status:", level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME)
 
         return bdmstatus
 
+    # Cheapest way to see if the target has entered background mode
+    def readBdmStatusRegister(self):
+        self.flushBatch()
+        self.transport.write(b"\x02\x14") # READ BDM STATUS REG
+        readback = self.transport.read(5)  # 0x0 0x0 0x0 0x0 0xc0
+        log(readback, debugline = "Bdm Status Reg:", level=LOGL_DEBUG, conv="hex",tag=Usbdm.NAME)
+        return readback
+
     def setBdmTarget(self, target):
         # Write something and read status
-        self.outEndpoint.write(b"\x03\x01"+target.to_bytes(1,"big")) # SET TARGET 0x00: HCS12
-        status = self.inEndpoint.read(1)
-        log(status,level=LOGL_DEBUG, conv="hex",tag =Usbdm.NAME, debugline="Set Target:")
-        return status[0]
+        return self.command("Set Target:", b"\x03\x01"+target.to_bytes(1,"big")) # SET TARGET 0x00: HCS12
 
 
    # Control reset pin
     def resetTarget(self):
-        self.outEndpoint.write(b"\x04\x08\x00\x0a")          # Set reset pin high
-        readback = self.inEndpoint.read(3)  # 0x0 0x0 0x08
+        self.flushBatch()
+        self.setTargetRunning(True)
+        self.transport.write(b"\x04\x08\x00\x0a")          # Set reset pin high
+        readback = self.transport.read(3)  # 0x0 0x0 0x08
         log(readback,level=LOGL_DEBUG, conv="hex",tag =Usbdm.NAME, debugline="Control pins 0:")
-        self.outEndpoint.write(b"\x04\x08\x00\x04")          # Set reset pin tri state
-        readback = self.inEndpoint.read(3)  # 0x0 0x0 0x0c
+        self.transport.write(b"\x04\x08\x00\x04")          # Set reset pin tri state
+        readback = self.transport.read(3)  # 0x0 0x0 0x0c
         log(readback,level=LOGL_DEBUG, conv="hex",tag =Usbdm.NAME, debugline="Control pins 1:")
         time.sleep(1)
-        self.outEndpoint.write(b"\x04\x08\xff\xff")          # RELEASE
-        readback = self.inEndpoint.read(3)  # 0x0 0x0 0x0c
+        self.transport.write(b"\x04\x08\xff\xff")          # RELEASE
+        readback = self.transport.read(3)  # 0x0 0x0 0x0c
         log(readback,level=LOGL_DEBUG, conv="hex",tag =Usbdm.NAME, debugline="Control pins 2:")
         time.sleep(1)
                            # Let the device reset: Can't connect without waiting
@@ -189,106 +423,107 @@ class Usbdm():
 
     # this doesn't seem to work properly
     def resetTargetInternal(self):
-        self.outEndpoint.write(b"\x03\x16\x08") # RESET TARGET
+        self.flushBatch()
+        self.transport.write(b"\x03\x16\x08") # RESET TARGET
         time.sleep(0.5)
-        #readback = self.inEndpoint.read(4)    # 0x3 0x1 0x2 0x3     is what you read when the device is busy
-        readback = self.inEndpoint.read(1)    # 0x01
+        #readback = self.transport.read(4)    # 0x3 0x1 0x2 0x3     is what you read when the device is busy
+        readback = self.transport.read(1)    # 0x01
         log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Reset Target:")
         time.sleep(1)               # Let the device reset
         return readback[0]
 
     # 02 19 sent after connect by hcs08
     def haltTarget(self):
-        self.outEndpoint.write(b"\x02\x19")
-        status = self.inEndpoint.read(1)    # 0x00
-        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Halt target:")
-        return status[0]
+        self.setTargetRunning(False)
+        return self.command("Halt target:", b"\x02\x19")
 
     def runTarget(self):
-        #self.outEndpoint.write(b"\x08\x21\x01\x04\x00\x00"+pc.to_bytes(2,"big")) # Read opcodes to be executed, 4 bytes
-        #status = self.inEndpoint.read(1)    # 0x00
+        #self.transport.write(b"\x08\x21\x01\x04\x00\x00"+pc.to_bytes(2,"big")) # Read opcodes to be executed, 4 bytes
+        #status = self.transport.read(1)    # 0x00
         #log(status,level=LOGL_DEBUG, conv="hex", tag="Read Next Opcodes#")
 
-        self.outEndpoint.write(b"\x02\x18")
-        status = self.inEndpoint.read(1)    # 0x00
-        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Run target:")
-        return status[0]
+        self.setTargetRunning(True)
+        return self.command("Run target:", b"\x02\x18")
 
     def writeRegister(self, register, pc):
-        self.outEndpoint.write(b"\x08\x1a\x00"+register.to_bytes(1,"big")+b"\x00\x00"+pc.to_bytes(2,"big"))
-        status = self.inEndpoint.read(1)    # 0x00
-        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Write Pc Register:")
-        return status[0]
+        return self.command("Write Pc Register:", b"\x08\x1a\x00"+register.to_bytes(1,"big")+b"\x00\x00"+pc.to_bytes(2,"big"))
 
 
     def writeCoreRegister(self):
-        self.outEndpoint.write(b"\x04\x1b\x00\x03")     # What is being set exactly??? In the response is the PC Counter
-        status = self.inEndpoint.read(5)    # 0x00 0x00 0x00 0x(Program) 0x(Counter)
+        self.flushBatch()
+        self.transport.write(b"\x04\x1b\x00\x03")     # What is being set exactly??? In the response is the PC Counter
+        status = self.transport.read(5)    # 0x00 0x00 0x00 0x(Program) 0x(Counter)
         log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Write Core Register:")
         return status[0]
 
     def writeControlRegister(self):
-        self.outEndpoint.write(b"\x06\x15\x00\x00\x00\xc4") # WRITE CONTROL REGISTER c4
-        status = self.inEndpoint.read(1)    # 0x00
-        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Write Control Register:")
-        return status[0]
+        return self.command("Write Control Register:", b"\x06\x15\x00\x00\x00\xc4") # WRITE CONTROL REGISTER c4
 
     def writeControlRegister2(self):
-        self.outEndpoint.write(b"\x06\x15\x00\x00\x00\x04") # WRITE CONTROL REGISTER 4
-        status = self.inEndpoint.read(1)    # 0x00
-        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Write Control Register:")
-        return status[0]
+        return self.command("Write Control Register:", b"\x06\x15\x00\x00\x00\x04") # WRITE CONTROL REGISTER 4
 
 
     def writeBdmBlock(self, address, data):
         size = len(data)
-        if size>0x88:
+        if size>self.maxwritesize:
             return 0xff
-        # max 62 bytes per 1# frame
-        # max ? 2# frame,
-        # max 0x90 total amount
-        # max 0x88 payload
-        if size > 62-8:
-            self.outEndpoint.write((size+8).to_bytes(1,"big")+b"\x20\x01"+size.to_bytes(1,"big") + address.to_bytes(4,"big") + data[:62-8])          # WRITE MEM
-            self.outEndpoint.write(b"\x00"+ data[62-8:])                   # WRITE MEM
+        # max firstpacketsize bytes in the 1# packet, the rest in the 2# packet
+        # max maxwritesize payload, see setbuffersize
+        # The packets are views of the frame buffer, the data is copied once into it
+        first = self.firstpacketsize-8
+        data = memoryview(data)
+        self.invalidateCache(address, size)
+        frame = self.framebuffer()
+        packets = memoryview(frame)
+        struct.pack_into(">BBBBI", frame, 0, size+8, 0x20, 0x01, size, address)                # WRITE MEM
+        if size > first:
+            frame[8:8+first] = data[:first]
+            frame[8+first] = 0x00
+            frame[9+first:9+size] = data[first:]
+            return self.command("Write Block:", packets[:8+first], packets[8+first:9+size])
         else:
-            self.outEndpoint.write((size+8).to_bytes(1,"big")+b"\x20\x01"+size.to_bytes(1,"big") + address.to_bytes(4,"big") + data)          # WRITE MEM
-
-        status = self.inEndpoint.read(1)    # could be 0x11
-        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Write Byte:")
-        return status[0]
+            frame[8:8+size] = data
+            return self.command("Write Block:", packets[:8+size])
 
     def readBdmBlock(self, address, size):
-        if size>0x90:
+        if size>self.maxreadsize:
             return 0xff
-        # max size is 0x90 ->  144 bytes
-        self.outEndpoint.write(b"\x08\x21\x01"+size.to_bytes(1,"big") + address.to_bytes(4,"big"))
-        readback = self.inEndpoint.read(size+1)  # 0x0(status) <bytes>
-        log(readback,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Read Block:")
+        readback = array("B", bytes(size+1))
+        del readback[self.readBdmBlockInto(address, readback):]
         return readback
 
+    # Read len(buffer)-1 bytes into the array: 0x0(status) <bytes>
+    def readBdmBlockInto(self, address, buffer):
+        self.flushBatch()
+        size = len(buffer)-1
+        # max size is maxreadsize, 0x90 -> 144 bytes with the default buffer
+        frame = self.framebuffer()
+        struct.pack_into(">BBBBI", frame, 0, 8, 0x21, 0x01, size, address)                      # READ MEM
+        self.transport.write(memoryview(frame)[:8])
+        received = self.transport.readinto(buffer)
+        log(memoryview(buffer)[:received],level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Read Block:")
+        return received
+
     def writeBdmByte(self, address, byte):
-        self.outEndpoint.write(b"\x09\x20\x01\x01" + address.to_bytes(4,"big") + byte.to_bytes(1,"big"))          # WRITE MEM
-        #readback = self.inEndpoint.read(4)  # 0x3 0x1 0x2 0x3
-        status = self.inEndpoint.read(1)    # could be 0x11
-        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline ="Write Byte")
-        return status[0]
+        #readback = self.transport.read(4)  # 0x3 0x1 0x2 0x3
+        self.invalidateCache(address, 1)
+        return self.command("Write Byte", b"\x09\x20\x01\x01" + address.to_bytes(4,"big") + byte.to_bytes(1,"big"))          # WRITE MEM, status could be 0x11
 
     def writeBdmWord(self, address, word ):
         if isinstance(word, int):
-            self.outEndpoint.write(b"\x0a\x20\x01\x02" + address.to_bytes(4,"big") + word.to_bytes(2,"big"))           # WRITE INTEGER MEM
+            frame = b"\x0a\x20\x01\x02" + address.to_bytes(4,"big") + word.to_bytes(2,"big")           # WRITE INTEGER MEM
         elif len(word) == 2:
-            self.outEndpoint.write(b"\x0a\x20\x01\x02" + address.to_bytes(4,"big") + word)                             # WRITE BYTES MEM
+            frame = b"\x0a\x20\x01\x02" + address.to_bytes(4,"big") + bytes(word)                      # WRITE BYTES MEM
         else:
             raise ValueError("Error: Data is not integer or wrong byte length")
 
-        #readback = self.inEndpoint.read(4)  # 0x3 0x1 0x2 0x3 is what you read when the device is busy
-        status = self.inEndpoint.read(1)    # could be 0x11
-        log(status,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Write Word:")
-        return status[0]
+        #readback = self.transport.read(4)  # 0x3 0x1 0x2 0x3 is what you read when the device is busy
+        self.invalidateCache(address, 2)
+        return self.command("Write Word:", frame)     # status could be 0x11
 
     def readBdmByte(self, address):
-        self.outEndpoint.write(b"\x08\x21\x01\x01" + address.to_bytes(4,"big"))      # READ MEM
-        readback = self.inEndpoint.read(2)  # 0x3 0x1 0x2 0x3
+        self.flushBatch()
+        self.transport.write(b"\x08\x21\x01\x01" + address.to_bytes(4,"big"))      # READ MEM
+        readback = self.transport.read(2)  # 0x3 0x1 0x2 0x3
         log(readback,level=LOGL_DEBUG, conv="hex", tag =Usbdm.NAME, debugline="Read Byte:")
         return readback